@@ -4,11 +4,32 @@ import sys
 import subprocess
 import shutil
 import argparse
-import io
 import time
+import json
+import atexit
+import asyncio
+import math
+import hashlib
+import tempfile
+import signal
+import csv
+import contextlib
+import threading
+import concurrent.futures
+import multiprocessing
+import mmap
+import urllib.request
+import urllib.error
+import http.server
+import socket
+import struct
+import zlib
 from colorama import init, Fore
 import pickle
 from pathlib import Path
+from typing import NamedTuple
+from array import array
+from collections import deque
 
 debug_mode = False
 
@@ -18,15 +39,417 @@ ansi_escape = re.compile(r'\x1B[@-_][0-?]*[ -/]*[@-~]')
 ccld_url = r"https://github.com/UltraTechX/Crowbar-Command-Line/releases/latest"
 vpkedit_url = r"https://github.com/craftablescience/VPKEdit/releases/latest"
 crowbar_appdata_settings = r"%appdata%\ZeqMacaw"
-extracted_vpks_folder_name = f"props_scaling_recompiler_temp_vpk_content"
+scratch_folder_name = f"props_scaling_recompiler_temp"
+
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+
+class LogSink:
+    # Console output is collected in a small buffer and written out when it is full, when flush_interval
+    # has passed or when a warning/error arrives. The log file is written as we go (ANSI-stripped) and
+    # flushed on the same interval, so a killed process loses at most flush_interval seconds of log.
+    # The watch compile logs from its own thread, so the buffers are only touched under the lock.
+    __slots__ = ("level", "file", "console_lines", "console_limit", "flush_interval", "last_flush", "pending_file_lines", "pending_file_limit", "lock")
+
+    def __init__(self, level=LOG_INFO):
+        self.level = level
+        self.file = None
+        self.console_lines = []
+        self.console_limit = 64
+        self.flush_interval = 0.5
+        self.last_flush = time.monotonic()
+        # Lines logged before open() are kept here (bounded) and written when the file is opened
+        self.pending_file_lines = []
+        self.pending_file_limit = 1000
+        self.lock = threading.RLock()
+
+    def open(self, log_path):
+        with self.lock:
+            self.close()
+            self.file = open(log_path, 'w', encoding='utf-8')
+            self.file.writelines(self.pending_file_lines)
+            self.pending_file_lines = []
+
+    def console(self, text):
+        with self.lock:
+            self.console_lines.append(text)
+            if len(self.console_lines) >= self.console_limit or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def write(self, level, message, end='\n'):
+        if level < self.level:
+            return
+        log_message = ansi_escape.sub('', message) + '\n'
+        with self.lock:
+            self.console_lines.append(message + Fore.RESET + end)
+            if self.file is not None:
+                self.file.write(log_message)
+            elif len(self.pending_file_lines) < self.pending_file_limit:
+                self.pending_file_lines.append(log_message)
+            if level >= LOG_WARNING or len(self.console_lines) >= self.console_limit or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.console_lines:
+                sys.stdout.write(''.join(self.console_lines))
+                self.console_lines = []
+            sys.stdout.flush()
+            if self.file is not None:
+                self.file.flush()
+            self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+log_sink = LogSink(LOG_DEBUG if debug_mode else LOG_INFO)
+atexit.register(log_sink.close)
+
+# JSON progress events on stderr (-progress_json 1)
+progress_json = False
+
+def print_and_log(*args, level=LOG_INFO, end='\n'):
+    log_sink.write(level, ' '.join(map(str, args)), end)
+
+def log_debug(message, *args):
+    # Formatting happens only when debug output is enabled
+    if log_sink.level > LOG_DEBUG:
+        return
+    if args:
+        message = message % args
+    log_sink.write(LOG_DEBUG, message)
+
+class ProgressReporter:
+    # Console progress is redrawn only when the percentage moved by min_percent_step or min_interval seconds
+    # passed, and only if stdout is a terminal. With progress_json enabled every redraw is also sent to stderr
+    # as a JSON line for build dashboards.
+    __slots__ = ("name", "total", "count", "start_time", "last_time", "last_percent", "min_interval", "min_percent_step", "console_enabled")
+
+    def __init__(self, name, total, min_interval=0.25, min_percent_step=5):
+        self.name = name
+        self.total = total
+        self.count = 0
+        self.start_time = time.monotonic()
+        self.last_time = self.start_time
+        self.last_percent = 0
+        self.min_interval = min_interval
+        self.min_percent_step = min_percent_step
+        self.console_enabled = sys.stdout.isatty()
+
+    def update(self, count=1):
+        self.count += count
+        if not self.console_enabled and not progress_json:
+            return
+        now = time.monotonic()
+        percent = self.count * 100 // self.total if self.total else 100
+        if percent - self.last_percent < self.min_percent_step and now - self.last_time < self.min_interval:
+            return
+        self.last_percent = percent
+        self.last_time = now
+        self.emit(now, percent)
+
+    def emit(self, now, percent, done=False):
+        elapsed = now - self.start_time
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.count) / rate if rate > 0 else 0.0
+        if self.console_enabled and not done:
+            log_sink.console(f"Progress: {percent}% ({self.count}/{self.total}, {rate:.0f}/s, ETA {eta:.0f}s)    \r")
+        if progress_json:
+            event = {"event": "progress", "stage": self.name, "done": self.count, "total": self.total, "percent": percent, "rate": round(rate, 2), "eta": round(eta, 2), "elapsed": round(elapsed, 2), "finished": done}
+            sys.stderr.write(json.dumps(event) + '\n')
+            sys.stderr.flush()
+
+    def done(self):
+        self.emit(time.monotonic(), 100, done=True)
+        print_and_log(f"Progress: Done!    ")
+
+# False when used as a library (Recompiler): nothing may block on input(), prompt_user raises instead
+interactive = True
+
+class RecompilerError(Exception):
+    pass
+
+def prompt_user(message):
+    log_sink.flush()
+    if not interactive:
+        raise RecompilerError(message.strip())
+    return input(message)
+
+# Log files of the current queue job, collected while it runs so the worker ships exactly these
+job_logs = None
+
+def get_job_log_path(job_name, source_path=None):
+    # studiomdl/Crowbar output goes to its own file instead of the main log. A short hash of the full
+    # path of the source keeps models with the same file name in different folders apart.
+    job_logs_folder = f"{get_script_name()}_job_logs"
+    os.makedirs(job_logs_folder, exist_ok=True)
+    job_name = re.sub(r'[^\w.-]', '_', job_name)
+    if source_path is not None:
+        job_name += "_" + hashlib.sha1(os.path.normcase(os.path.abspath(source_path)).encode('utf-8')).hexdigest()[:8]
+    job_log_path = os.path.join(job_logs_folder, f"{job_name}.log")
+    if job_logs is not None:
+        job_logs.append(job_log_path)
+    return job_log_path
+
+def read_job_log_tail(job_log_path, lines_count=20):
+    try:
+        with open(job_log_path, 'r', encoding='utf-8', errors='replace') as job_log:
+            return ''.join(deque(job_log, maxlen=lines_count))
+    except OSError:
+        return ""
+
+# Per-call timeouts (seconds) for external tools: base + per MB of input, up to max.
+# idle: kill the tool if it prints nothing for that long (hang), None = no hang detection.
+tool_timeouts = {
+    "studiomdl": {"base": 120, "per_mb": 60, "max": 3600, "idle": 600},
+    "ccld": {"base": 60, "per_mb": 30, "max": 1200, "idle": 300},
+    "vpkeditcli": {"base": 60, "per_mb": 2, "max": 900, "idle": None},
+}
+# -timeout_scale multiplies all of them, e.g. for slow build machines
+timeout_scale = 1.0
+
+def get_tool_timeout(tool, input_size=0):
+    settings = tool_timeouts[tool]
+    timeout = min(settings["base"] + settings["per_mb"] * input_size / (1024 * 1024), settings["max"]) * timeout_scale
+    idle_timeout = settings["idle"] * timeout_scale if settings["idle"] else None
+    return timeout, idle_timeout
+
+def get_files_size(paths):
+    size = 0
+    for path in paths:
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+    return size
+
+class ProcessResult(NamedTuple):
+    args: list
+    returncode: int
+    stdout: str
+    stderr: str
+    timed_out: bool
+    duration: float
+    hung: bool = False
+    cancelled: bool = False
+
+class ProcessRunner:
+    # Runs external tools (studiomdl, CrowbarCommandLineDecomp, vpkeditcli) without a shell on one asyncio loop.
+    # Output lines are streamed to an optional job log and on_line callback as they arrive; capture=True also
+    # collects them for the result. At most max_concurrency processes run at once; on timeout, no output for
+    # idle_timeout seconds (hang), Ctrl+C, cancellation or when the cancel callback returns True the whole process tree is killed.
+    # If durations_path is set, every call is appended there as a CSV row so timeouts can be tuned.
+    def __init__(self, max_concurrency=None):
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.loop = None
+        self.semaphore = None
+        self.durations_path = None
+
+    def get_loop(self):
+        if self.loop is None or self.loop.is_closed():
+            self.loop = asyncio.new_event_loop()
+            self.semaphore = None
+        return self.loop
+
+    async def read_stream(self, stream, stream_name, job_log, on_line, captured, activity):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            activity[0] = time.monotonic()
+            if job_log is not None:
+                job_log.write(line)
+            if on_line is not None or captured is not None:
+                text = line.decode('utf-8', errors='replace')
+                if on_line is not None:
+                    on_line(stream_name, text)
+                if captured is not None:
+                    captured.append(text)
+
+    async def watch(self, readers, start_time, timeout, idle_timeout, activity, cancel):
+        # Returns None when the process finished, "timeout", "hung" or "cancelled" when it has to be killed
+        while True:
+            done, _ = await asyncio.wait({readers}, timeout=1.0)
+            if done:
+                readers.result()
+                return None
+            now = time.monotonic()
+            if timeout is not None and now - start_time > timeout:
+                return "timeout"
+            if idle_timeout is not None and now - activity[0] > idle_timeout:
+                return "hung"
+            if cancel is not None and cancel():
+                return "cancelled"
+
+    async def run_async(self, args, timeout=None, idle_timeout=None, input_size=None, job_log_path=None, on_line=None, capture=False, check=False, cancel=None):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        args = [str(arg) for arg in args]
+        stdout_lines = [] if capture else None
+        stderr_lines = [] if capture else None
+        async with self.semaphore:
+            start_time = time.monotonic()
+            activity = [start_time]
+            job_log = open(job_log_path, 'wb') if job_log_path else None
+            try:
+                # Own process group, so the tool can be killed together with everything it started
+                process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=(os.name != 'nt'))
+                readers = asyncio.ensure_future(asyncio.gather(
+                    self.read_stream(process.stdout, "stdout", job_log, on_line, stdout_lines, activity),
+                    self.read_stream(process.stderr, "stderr", job_log, on_line, stderr_lines, activity),
+                    process.wait()
+                ))
+                try:
+                    stopped = await self.watch(readers, start_time, timeout, idle_timeout, activity, cancel)
+                except asyncio.CancelledError:
+                    await self.stop(process, readers)
+                    raise
+                if stopped is not None:
+                    await self.stop(process, readers)
+            finally:
+                if job_log is not None:
+                    job_log.close()
+
+        result = ProcessResult(args, process.returncode, ''.join(stdout_lines or []), ''.join(stderr_lines or []), stopped == "timeout", time.monotonic() - start_time, stopped == "hung", stopped == "cancelled")
+        self.export_duration(result, input_size, timeout)
+        if check and (stopped is not None or result.returncode != 0):
+            raise subprocess.CalledProcessError(result.returncode, args, result.stdout, result.stderr)
+        return result
+
+    async def stop(self, process, readers):
+        self.kill(process)
+        await process.wait()
+        readers.cancel()
+        try:
+            await readers
+        except (asyncio.CancelledError, Exception):
+            pass
 
-log_buffer = io.StringIO()
+    def kill(self, process):
+        if process.returncode is not None:
+            return
+        try:
+            if os.name == 'nt':
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, OSError):
+            pass
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
 
-def print_and_log(*args, **kwargs):
-    message = ' '.join(map(str, args))
-    print(message + Fore.RESET, **kwargs)
-    log_message = ansi_escape.sub('', message)
-    log_buffer.write(log_message + '\n')
+    def export_duration(self, result, input_size, timeout):
+        if self.durations_path is None:
+            return
+        status = "timeout" if result.timed_out else "hung" if result.hung else "cancelled" if result.cancelled else result.returncode
+        try:
+            new_file = not os.path.exists(self.durations_path)
+            with open(self.durations_path, 'a', newline='') as durations_file:
+                writer = csv.writer(durations_file)
+                if new_file:
+                    writer.writerow(["time", "tool", "input", "input_size", "timeout", "duration", "status"])
+                writer.writerow([time.strftime("%Y-%m-%d %H:%M:%S"), get_file_name(result.args[0]), result.args[-1], input_size if input_size is not None else "", f"{timeout:.0f}" if timeout else "", f"{result.duration:.2f}", status])
+        except OSError as e:
+            log_debug("Tool durations can't be written: %s", e)
+
+    def run_until_complete(self, coroutine):
+        loop = self.get_loop()
+        task = loop.create_task(coroutine)
+        try:
+            return loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            # Ctrl+C: cancel everything that is running so no tool is left behind
+            task.cancel()
+            try:
+                loop.run_until_complete(task)
+            except (asyncio.CancelledError, Exception):
+                pass
+            raise
+
+    def run(self, args, **kwargs):
+        return self.run_until_complete(self.run_async(args, **kwargs))
+
+    def run_many(self, calls, return_exceptions=False):
+        # calls: list of (args, kwargs); results are returned in the same order
+        async def run_all():
+            return await asyncio.gather(*(self.run_async(args, **kwargs) for args, kwargs in calls), return_exceptions=True)
+        results = self.run_until_complete(run_all())
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+        return results
+
+process_runner = ProcessRunner()
+
+class ScratchManager:
+    # Every job (one source model) gets its own folder for decompiled and extracted files, so models with the same name
+    # and runs started at the same time don't touch each other. The root can be put on a RAM disk with -scratch_dir.
+    __slots__ = ("root", "keep_on_failure", "run_dir", "kept_jobs")
+
+    def __init__(self, root=None, keep_on_failure=False):
+        self.root = root
+        self.keep_on_failure = keep_on_failure
+        self.run_dir = None
+        self.kept_jobs = []
+
+    def configure(self, root=None, keep_on_failure=False):
+        root = os.path.abspath(root) if root else None
+        if root != self.root:
+            self.close()
+            self.root = root
+        self.keep_on_failure = keep_on_failure
+
+    def get_run_dir(self):
+        if self.run_dir is None:
+            root = self.root or os.path.join(get_script_path(), scratch_folder_name)
+            os.makedirs(root, exist_ok=True)
+            self.remove_stale_runs(root)
+            self.run_dir = tempfile.mkdtemp(prefix=f"run_{os.getpid()}_", dir=root)
+            log_debug("scratch run_dir: %s", self.run_dir)
+        return self.run_dir
+
+    def remove_stale_runs(self, root, max_age=24 * 3600):
+        # Folders of runs that crashed or were killed, other running jobs are much younger than that
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                if name.startswith("run_") and os.path.isdir(path) and time.time() - os.path.getmtime(path) > max_age:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def create_job(self, job_name):
+        job_name = re.sub(r'[^\w.-]', '_', job_name)
+        return tempfile.mkdtemp(prefix=f"{job_name}_", dir=self.get_run_dir())
+
+    def release_job(self, job_dir, failed=False):
+        if failed and journal.is_resumable(job_dir):
+            # An interrupted run goes on from this decompile, the run folder is kept with it
+            self.kept_jobs.append(job_dir)
+            log_debug("Job files kept to resume: %s", job_dir)
+            return
+        if failed and self.keep_on_failure:
+            self.kept_jobs.append(job_dir)
+            print_and_log(Fore.YELLOW + f"Job files kept for debugging:\n{job_dir}")
+            return
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    def close(self):
+        if self.run_dir is None:
+            return
+        if not self.kept_jobs:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.run_dir = None
+
+scratch = ScratchManager()
+atexit.register(scratch.close)
 
 def get_script_path():
     if getattr(sys, 'frozen', False):
@@ -120,49 +543,356 @@ def check_psr_data(psr_cache_data_check, psr_cache_data_ready):
             return False
 
         colors_check = model_data.get('colors', [])
-        colors_ready = psr_cache_data_ready[model].get('colors', [])
-        if not any(color_check in colors_ready for color_check in colors_check):
-            return False
+        for modelscale in scales_check:
+            if not any(is_color_compiled(psr_cache_data_ready[model], modelscale, color_check) for color_check in colors_check):
+                return False
     return True
 
+def get_lookup_miss_reason(psr_cache_data_ready, model, modelscale, rendercolor, skin):
+    # Why check_psr_data did not find a variant: the model has nothing compiled, or not this scale, or not this color,
+    # or the color is known but the model of this scale was compiled before it was added to the palette
+    model_data = psr_cache_data_ready.get(model.lower())
+    if model_data is None:
+        return "not in cache"
+    if modelscale not in model_data.get("scales", []):
+        return "scale mismatch"
+    if [[rendercolor], [skin]] not in model_data.get("colors", []):
+        return "color mismatch"
+    return "palette mismatch"
+
+class LookupStats:
+    # Outcome of every variant lookup and the stage that found every source model, printed for the run and
+    # appended to a history file (JSON lines) for -stats
+    __slots__ = ("path", "outcomes", "sources")
+
+    hit_outcomes = ("cache hit", "output on disk")
+
+    def __init__(self, path):
+        self.path = path
+        self.outcomes = {}
+        self.sources = {}
+
+    def record_outcome(self, outcome):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def record_source(self, stage):
+        self.sources[stage] = self.sources.get(stage, 0) + 1
+
+    def report_outcomes(self, save=True):
+        total = sum(self.outcomes.values())
+        if not total:
+            return
+        hits = sum(self.outcomes.get(outcome, 0) for outcome in self.hit_outcomes)
+        details = ", ".join(f"{count} {outcome}" for outcome, count in sorted(self.outcomes.items(), key=lambda item: -item[1]))
+        print_and_log(f"Variant lookups: {hits * 100 / total:.0f}% hits ({details}).")
+        if save:
+            self.save("lookup", self.outcomes)
+        self.outcomes = {}
+
+    def report_sources(self):
+        if not self.sources:
+            return
+        details = ", ".join(f"{count} {stage}" for stage, count in sorted(self.sources.items(), key=lambda item: -item[1]))
+        print_and_log(f"Source models found in: {details}.")
+        self.save("sources", self.sources)
+        self.sources = {}
+
+    def save(self, kind, counts):
+        try:
+            with open(self.path, 'a', encoding='utf-8') as history_file:
+                history_file.write(json.dumps({"time": time.time(), "kind": kind, "counts": counts}) + "\n")
+        except OSError as e:
+            log_debug("Stats history can't be written: %s", e)
+
+    def load_history(self):
+        history = []
+        if not os.path.exists(self.path):
+            return history
+        with open(self.path, 'r', encoding='utf-8') as history_file:
+            for line in history_file:
+                try:
+                    history.append(json.loads(line))
+                except ValueError:
+                    # A line cut by an interrupted run
+                    continue
+        return history
+
+lookup_stats = LookupStats('props_scaling_recompiler_stats.jsonl')
+
+# Colors are compiled into the scaled models as extra skin families ($texturegroup) that use tinted copies of
+# the materials. The "colors" list of a cache entry is append-only, so the position of a tinted color in it fixes
+# its skin index: skin_families (original families of the model) + index among the tinted colors.
+# palette_sizes[scale] is how many tinted colors the model of that scale was compiled with.
+white_rendercolor = "255 255 255"
+
+def get_tinted_colors(model_data):
+    return [color_pair for color_pair in model_data.get("colors", []) if color_pair[0][0] != white_rendercolor]
+
+def is_color_compiled(model_data, modelscale, color_pair):
+    if color_pair not in model_data.get("colors", []):
+        return False
+    if color_pair[0][0] == white_rendercolor:
+        return True
+    tinted_index = get_tinted_colors(model_data).index(color_pair)
+    return tinted_index < model_data.get("palette_sizes", {}).get(modelscale, 0)
+
+def set_compiled_palette(psr_cache_data, model, modelscale, tinted_count, skin_families):
+    model_data = psr_cache_data[model.lower()]
+    if "palette_sizes" not in model_data:
+        model_data["palette_sizes"] = {}
+    model_data["palette_sizes"][modelscale] = tinted_count
+    model_data["skin_families"] = skin_families
+
+def get_entity_skin_index(model_data, modelscale, rendercolor, skin):
+    # Skin of the scaled model for this rendercolor, or None if the entity keeps its own skin
+    color_pair = [[rendercolor], [skin]]
+    if rendercolor == white_rendercolor or not is_color_compiled(model_data, modelscale, color_pair):
+        return None
+    return model_data.get("skin_families", 1) + get_tinted_colors(model_data).index(color_pair)
+
+@contextlib.contextmanager
+def open_atomic(path, mode='w', **kwargs):
+    # Writes to a temp file next to path and renames it over path only when everything is written,
+    # so an interrupted write never leaves a half-written file behind
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, mode, **kwargs) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+cache_file = 'props_scaling_recompiler_cache.pkl'
+
 def save_global_cache(psr_cache_data_ready):
-    with open('props_scaling_recompiler_cache.pkl', 'wb') as f:
+    with open_atomic(cache_file, 'wb') as f:
         pickle.dump(psr_cache_data_ready, f)
-        print_and_log(f"Cache saved.")
+    print_and_log(f"Cache saved.")
 
 def load_global_cache():
-    if os.path.exists('props_scaling_recompiler_cache.pkl'):
-            with open('props_scaling_recompiler_cache.pkl', 'rb') as f:
+    if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
                 psr_cache_data_ready = pickle.load(f)
                 return psr_cache_data_ready
     else:
         return None
 
-def process_vmf(game_dir, file_path, psr_cache_data_ready, force_recompile=False, classnames = ["prop_static_scalable", "prop_dynamic_scalable", "prop_physics_scalable"]):
-    entities_raw = []
-    entities_ready = []
-    entities_todo = []
-    psr_cache_data_raw = {}
-    psr_cache_data_todo = {}
-    
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
+class NegativeCache:
+    # Models that could not be found, decompiled or compiled. An entry is only trusted while its fingerprint
+    # (search paths and VPKs, or the source model and the tools) is the same, so it resolves instantly until the content changes.
+    __slots__ = ("path", "entries", "hits")
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+
+    def load(self):
+        self.entries = {}
+        self.hits = 0
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    self.entries = pickle.load(f)
+            except Exception as e:
+                print_and_log(Fore.YELLOW + f"Warning! Negative cache can't be loaded, ignoring it: {e}")
+                self.entries = {}
+
+    def save(self):
+        with open_atomic(self.path, 'wb') as f:
+            pickle.dump(self.entries, f)
+
+    def clear(self):
+        self.entries = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def check(self, model, kind, fingerprint):
+        # Returns the recorded failure reason, or None if there is no valid entry
+        entry = self.entries.get((model.lower(), kind))
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return None
+        self.hits += 1
+        return entry["reason"]
+
+    def record(self, model, kind, fingerprint, reason):
+        self.entries[(model.lower(), kind)] = {"fingerprint": fingerprint, "reason": reason, "time": time.time()}
+        self.save()
+
+    def forget(self, model, kind):
+        if self.entries.pop((model.lower(), kind), None) is not None:
+            self.save()
+
+negative_cache = NegativeCache('props_scaling_recompiler_negative_cache.pkl')
+
+class Journal:
+    # Append-only log of planned, started, completed and failed decompile/compile jobs. After an interrupted run
+    # (power loss, Ctrl+C, crash) recover() deletes the outputs of compiles that were started but never finished,
+    # so they can't be taken for valid models, and keeps finished decompiles to be reused.
+    # While a run goes on, the job folders of finished decompiles and the compiles still pending per model are
+    # tracked, so an interrupted job keeps its folder for the next run (is_resumable).
+    __slots__ = ("path", "file", "decompiled", "reused_dirs", "decompile_dirs", "pending_compiles")
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.decompiled = {}
+        self.reused_dirs = []
+        self.decompile_dirs = {}
+        self.pending_compiles = {}
+
+    def read(self):
+        states = {}
+        if not os.path.exists(self.path):
+            return states
+        with open(self.path, 'r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line can be cut by a power loss
+                    continue
+                states[(record["job"], record["model"], record.get("scale"))] = record
+        return states
 
+    def recover(self):
+        states = self.read()
+        if not states:
+            return
+        print_and_log(f" ")
+        print_and_log(Fore.YELLOW + f"Previous run was interrupted, resuming...")
+        finished = planned = cleaned = 0
+        for (job, model, scale), record in states.items():
+            if record["state"] in ("completed", "failed"):
+                finished += 1
+                if job == "decompile" and record["state"] == "completed" and os.path.isfile(record.get("qc_path", "")):
+                    self.decompiled[(model, record["fingerprint"])] = record["qc_path"]
+            elif record["state"] == "planned":
+                planned += 1
+            elif record["state"] == "started" and job == "compile":
+                remove_compiled_model_files(record.get("outputs", []), record["time"])
+                cleaned += 1
+            elif record["state"] == "started":
+                planned += 1
+        print_and_log(f"{finished} jobs were finished, {planned} were not started yet, {cleaned} interrupted compiles were cleaned up.")
+        if not self.decompiled:
+            # Nothing left to resume, the next run must not clean up the same compiles again
+            self.finish()
+            return
+        print_and_log(f"{len(self.decompiled)} decompiled models will be reused.")
+        # Only the decompiles to reuse are kept, the interrupted compiles are cleaned up once
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        with open_atomic(self.path, 'w', encoding='utf-8') as journal_file:
+            for (job, model, scale), record in states.items():
+                if job == "decompile" and (model, record.get("fingerprint")) in self.decompiled:
+                    journal_file.write(json.dumps(record) + "\n")
+
+    def write(self, job, model, state, scale=None, **fields):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        record = {"job": job, "model": model.lower(), "scale": scale, "state": state, "time": time.time()}
+        record.update(fields)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if job == "decompile" and state == "completed":
+            # decomp folder is in the job folder
+            self.decompile_dirs[model.lower()] = os.path.dirname(os.path.dirname(fields.get("qc_path", "")))
+        elif job == "compile":
+            pending = self.pending_compiles.setdefault(model.lower(), set())
+            if state in ("planned", "started"):
+                pending.add(scale)
+            else:
+                pending.discard(scale)
+
+    def is_resumable(self, job_dir):
+        # The job folder holds a finished decompile of a model with compiles still to do
+        job_dir = os.path.normcase(os.path.abspath(job_dir))
+        return any(os.path.normcase(os.path.abspath(decompile_dir)) == job_dir and self.pending_compiles.get(model)
+                   for model, decompile_dir in self.decompile_dirs.items())
+
+    def get_decompiled(self, model, fingerprint):
+        qc_path = self.decompiled.get((model.lower(), fingerprint))
+        if qc_path is None or not os.path.isfile(qc_path):
+            return None
+        # decomp folder is in the job folder of the interrupted run
+        self.reused_dirs.append(os.path.dirname(os.path.dirname(qc_path)))
+        return qc_path
+
+    def finish(self):
+        # Everything is done, nothing to resume
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        for reused_dir in self.reused_dirs:
+            shutil.rmtree(reused_dir, ignore_errors=True)
+        self.decompiled = {}
+        self.reused_dirs = []
+        self.decompile_dirs = {}
+        self.pending_compiles = {}
+
+journal = Journal('props_scaling_recompiler_journal.jsonl')
+
+def get_file_stat(path):
+    try:
+        stat = os.stat(path)
+        return (path, stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        return (path, None, None)
+
+def get_search_fingerprint(game_dir, search_paths, vpk_paths):
+    # Search paths from gameinfo.txt and the size/date of every VPK, a model missing from all of them stays missing while this is the same
+    fingerprint = hashlib.sha1()
+    fingerprint.update(repr((game_dir, search_paths)).encode('utf-8'))
+    for vpk_path in sorted(vpk_paths):
+        fingerprint.update(repr(get_file_stat(vpk_path)).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def get_source_hash(mdl_path):
+    # Content hash of the source .mdl (it holds the checksum of its .vvd/.vtx files), the same model
+    # copied to another path or packed into a VPK has the same hash
+    source_hash = hashlib.sha1()
+    try:
+        with open(mdl_path, 'rb') as f:
+            source_hash.update(f.read())
+    except OSError:
+        source_hash.update(mdl_path.encode('utf-8'))
+    return source_hash.hexdigest()
+
+def get_source_fingerprint(mdl_path, *tool_paths):
+    # Content of the source .mdl (extracted files get a new date every run) and the size/date of the tools
+    fingerprint = hashlib.sha1()
+    fingerprint.update(get_source_hash(mdl_path).encode('utf-8'))
+    for tool_path in tool_paths:
+        fingerprint.update(repr(get_file_stat(tool_path)).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def is_mdl_in_search_roots(game_dir, search_paths, hammer_mdl_path):
+    # Cheap check for a model added at its usual place, so a new loose file is picked up without a fingerprint change
+    roots = [game_dir] + [parts[1] for parts in search_paths if len(parts) == 3]
+    return any(os.path.isfile(os.path.join(root, hammer_mdl_path)) for root in roots)
+
+class ScalableEntity(NamedTuple):
+    id: str
+    classname: str
+    model: str
+    modelscale: str
+    rendercolor: str
+    skin: str
+    origin: str
+
+def extract_scalable_entities(content, classnames):
+    # One pass over the VMF: "rendercolor" and "skin" are optional groups, so entities saved with
+    # the old FGD (without these keyvalues) are matched by the same regex and get default values here.
     classnames_pattern = '|'.join(classnames)
 
-    pattern_old_fgd = re.compile(
-        rf'entity\s*\{{'
-        rf'[^\{{}}]*"id"\s*"(?P<id>\d+)"\s*'
-        rf'[^\{{}}]*"classname"\s*\"(?P<classname>{classnames_pattern})\"\s*'
-        rf'[^\{{}}]*"model"\s*"(?P<model>[^"]+)"\s*'
-        rf'[^\{{}}]*"modelscale"\s*"(?P<modelscale>[^"]+)"\s*'
-        rf'[^\{{}}]*"origin"\s*"(?P<origin>[^"]+)"\s*',
-        re.DOTALL | re.MULTILINE
-    )
-    matches_old_fgd = list(pattern_old_fgd.finditer(content))
-    
-    entities_matches_old_fgd_len = len(matches_old_fgd)
-    
     pattern = re.compile(
         rf'entity\s*\{{'
         rf'[^\{{}}]*"id"\s*"(?P<id>\d+)"\s*'
@@ -170,55 +900,382 @@ def process_vmf(game_dir, file_path, psr_cache_data_ready, force_recompile=False
         rf'[^\{{}}]*"model"\s*"(?P<model>[^"]+)"\s*'
         rf'[^\{{}}]*"modelscale"\s*"(?P<modelscale>[^"]+)"\s*'
         # "rendercolor" "222 22 22"
-        rf'[^\{{}}]*"rendercolor"\s*"(?P<rendercolor>[^"]+)"\s*'
+        rf'(?:[^\{{}}]*"rendercolor"\s*"(?P<rendercolor>[^"]+)"\s*)?'
         #"skin" "0"
-        rf'[^\{{}}]*"skin"\s*"(?P<skin>[^"]+)"\s*'
+        rf'(?:[^\{{}}]*"skin"\s*"(?P<skin>[^"]+)"\s*)?'
         rf'[^\{{}}]*"origin"\s*"(?P<origin>[^"]+)"\s*',
         re.DOTALL | re.MULTILINE
     )
-    matches = list(pattern.finditer(content))
-    
-    entities_matches_len = len(matches)
-    
-    if entities_matches_old_fgd_len == 0:
+
+    entities = []
+    for match in pattern.finditer(content):
+        entity_id, classname, model, modelscale, rendercolor, skin, origin = match.group('id', 'classname', 'model', 'modelscale', 'rendercolor', 'skin', 'origin')
+        entities.append(ScalableEntity(entity_id, classname, model, modelscale, rendercolor or "255 255 255", skin or "0", origin))
+    return entities
+
+def get_instance_files(content):
+    # "file" values of the func_instance entities, each one once
+    return list(dict.fromkeys(re.findall(r'entity\s*\{[^\{}]*"classname"\s*"func_instance"[^\{}]*"file"\s*"([^"]+)"', content)))
+
+def resolve_instance_path(vmf_path, instance_file):
+    # Relative to the VMF folder or one of its parents (the mapsrc root)
+    folder = os.path.dirname(os.path.abspath(vmf_path))
+    while True:
+        instance_path = os.path.normpath(os.path.join(folder, instance_file))
+        if os.path.isfile(instance_path):
+            return instance_path
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            log_debug("Instance not found: %s", instance_file)
+            return None
+        folder = parent
+
+# -parallel_scan_mb: VMFs from this size on are scanned by several processes, 0 = never
+parallel_scan_threshold = 64 * 1024 * 1024
+
+def get_vmf_chunks(view, chunk_count):
+    # (start, end) byte ranges of about the same size, each one starting at a top-level entity/world block
+    # (nested blocks are indented), so no block is cut in two
+    block_pattern = re.compile(rb'\n(?:entity|world)[ \t]*\r?\n')
+    size = len(view)
+    starts = [0]
+    for chunk in range(1, chunk_count):
+        match = block_pattern.search(view, max(size * chunk // chunk_count, starts[-1]))
+        if match is None:
+            break
+        if match.start() + 1 > starts[-1]:
+            starts.append(match.start() + 1)
+    return list(zip(starts, starts[1:] + [size]))
+
+def scan_vmf_chunk(vmf_path, start, end, classnames):
+    # Runs in a scan process: maps the VMF and decodes only its own part of it
+    with open(vmf_path, 'rb') as vmf_file, mmap.mmap(vmf_file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        content = view[start:end].decode('utf-8', errors='replace')
+    return extract_scalable_entities(content, classnames), get_instance_files(content)
+
+def scan_vmf(vmf_path, classnames, content=None):
+    # Scalable entities and func_instance files of a VMF, in file order
+    if content is None:
+        size = os.path.getsize(vmf_path)
+        if parallel_scan_threshold and size >= parallel_scan_threshold and (os.cpu_count() or 1) > 1:
+            return scan_vmf_parallel(vmf_path, classnames, size)
+        with open(vmf_path, 'r', encoding='utf-8', errors='replace') as vmf_file:
+            content = vmf_file.read()
+    return extract_scalable_entities(content, classnames), get_instance_files(content)
+
+def scan_vmf_parallel(vmf_path, classnames, size):
+    worker_count = min(os.cpu_count() or 1, 8)
+    with open(vmf_path, 'rb') as vmf_file, mmap.mmap(vmf_file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        # More chunks than processes, so one slow chunk does not hold the others up
+        chunks = get_vmf_chunks(view, worker_count * 4)
+    print_and_log(f"Scanning {os.path.basename(vmf_path)} ({size / (1024 * 1024):.0f} MB) in {len(chunks)} parts with {worker_count} processes...")
+    entities = []
+    instance_files = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count) as executor:
+        futures = [executor.submit(scan_vmf_chunk, vmf_path, start, end, classnames) for start, end in chunks]
+        for future in futures:
+            chunk_entities, chunk_instance_files = future.result()
+            entities.extend(chunk_entities)
+            instance_files.extend(chunk_instance_files)
+    return entities, list(dict.fromkeys(instance_files))
+
+def get_vmf_hash(vmf_path):
+    content_hash = hashlib.sha1()
+    with open(vmf_path, 'rb') as vmf_file:
+        for block in iter(lambda: vmf_file.read(1024 * 1024), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+class VmfInstance(NamedTuple):
+    path: str
+    content_hash: str
+    entities: list
+    # ("file" value, resolved path or None) of the func_instance entities
+    instance_files: list
+
+class InstanceCache:
+    # Scalable entities and func_instance files of the instance VMFs, so an instance kit used in hundreds of places
+    # and many maps is parsed once until it is edited. One entry per instance path, replaced when the file's hash changes.
+    __slots__ = ("path", "entries", "dirty")
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+
+    def load(self):
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    # Entries of the older cache (one per content hash) are dropped
+                    self.entries = {key: entry for key, entry in pickle.load(f).items() if len(entry) == 3}
+            except Exception as e:
+                print_and_log(Fore.YELLOW + f"Warning! Instance cache can't be loaded, ignoring it: {e}")
+                self.entries = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        with open_atomic(self.path, 'wb') as f:
+            pickle.dump(self.entries, f)
+        self.dirty = False
+
+    def get(self, path, content_hash, classnames):
+        entry = self.entries.get((os.path.normcase(path), tuple(classnames)))
+        if entry is None or entry[0] != content_hash:
+            return None
+        _, entities, instance_files = entry
+        return [ScalableEntity(*entity) for entity in entities], instance_files
+
+    def put(self, path, content_hash, classnames, entities, instance_files):
+        self.entries[(os.path.normcase(path), tuple(classnames))] = (content_hash, [tuple(entity) for entity in entities], instance_files)
+        self.dirty = True
+
+instance_cache = InstanceCache('props_scaling_recompiler_instances.pkl')
+
+def read_vmf_tree(vmf_path, content=None, classnames=["prop_static_scalable"]):
+    # The VMF and every instance VMF it uses (recursively), each unique file read and parsed once however often it is placed.
+    # Entity ids of the instances get the instance number as a prefix ("2:154"), so they stay unique in one entity table.
+    # Only the instances are hashed (for the cache and their copies), the main VMF has no content_hash.
+    instance_cache.load()
+    vmf_tree = []
+    seen = set()
+    todo = [(os.path.abspath(vmf_path), content)]
+    while todo:
+        path, content = todo.pop(0)
+        if os.path.normcase(path) in seen:
+            continue
+        seen.add(os.path.normcase(path))
+        is_instance = len(vmf_tree) > 0
+        try:
+            content_hash = get_vmf_hash(path) if is_instance else None
+            cached = instance_cache.get(path, content_hash, classnames) if is_instance else None
+            if cached is None:
+                entities, instance_files = scan_vmf(path, classnames, content)
+        except OSError as e:
+            log_debug("VMF can't be read: %s", e)
+            continue
+        if cached is not None:
+            entities, instance_files = cached
+        else:
+            if is_instance:
+                instance_cache.put(path, content_hash, classnames, entities, instance_files)
+        if is_instance:
+            # Values from the func_instance parameters differ per placement, there is no single variant to compile
+            parametrized = [entity for entity in entities if any(value.startswith("$") for value in (entity.model, entity.modelscale, entity.rendercolor, entity.skin))]
+            if parametrized:
+                print_and_log(Fore.YELLOW + f"Warning! {len(parametrized)} scalable entities of the instance {os.path.basename(path)} use instance parameters, skipping them.")
+            entities = [entity._replace(id=f"{len(vmf_tree)}:{entity.id}") for entity in entities if entity not in parametrized]
+        instance_files = [(instance_file, resolve_instance_path(path, instance_file)) for instance_file in instance_files]
+        vmf_tree.append(VmfInstance(path, content_hash, entities, instance_files))
+        todo.extend((instance_path, None) for instance_file, instance_path in instance_files if instance_path is not None)
+    instance_cache.save()
+    return vmf_tree
+
+# Variants the watched VMF still uses: {model: ({scale * 100}, {(packed rendercolor, skin)})}, None means every variant is wanted
+wanted_variants = None
+
+def get_color_key(rendercolor, skin):
+    try:
+        skin = int(skin)
+    except ValueError:
+        skin = 0
+    return pack_rendercolor(rendercolor), skin
+
+def is_variant_wanted(model, scale=None, colors=None):
+    # colors: the color pairs ([[rendercolor], [skin]]) this compile adds to the model, a tinted one that
+    # is not used anymore makes the whole variant unwanted, its palette has to be compiled again
+    wanted = wanted_variants
+    if wanted is None:
+        return True
+    model_variants = wanted.get(model.lower())
+    if model_variants is None:
+        return False
+    scales, wanted_colors = model_variants
+    if scale is not None and round(float(scale) * 100) not in scales:
+        return False
+    return all(get_color_key(rendercolor[0], skin[0]) in wanted_colors for rendercolor, skin in get_tinted_colors({"colors": colors or []}))
+
+def get_wanted_variants(entities, scale_policy=None):
+    # The same scale fixes and snapping as process_entities
+    scale_snapper = None
+    if scale_policy is not None and scale_policy.is_enabled():
+        scale_snapper = ScaleSnapper(scale_policy, {})
+    wanted = {}
+    for entity in entities:
+        modelscale = "1.0" if "," in entity.modelscale else entity.modelscale
+        try:
+            scale = float(modelscale)
+        except ValueError:
+            continue
+        if scale < 0.01:
+            continue
+        if scale_snapper is not None:
+            scale = scale_snapper.snap(entity.model, scale)
+        scales, colors = wanted.setdefault(entity.model.lower(), (set(), set()))
+        scales.add(round(scale * 100))
+        colors.add(get_color_key(entity.rendercolor, entity.skin))
+    return wanted
+
+def pack_rendercolor(rendercolor):
+    try:
+        r, g, b = (min(max(int(float(c)), 0), 255) for c in rendercolor.split()[:3])
+    except ValueError:
+        return 0xFFFFFF
+    return (r << 16) | (g << 8) | b
+
+def unpack_rendercolor(packed):
+    return f"{(packed >> 16) & 0xFF} {(packed >> 8) & 0xFF} {packed & 0xFF}"
+
+class EntityTable:
+    # Column storage for the scalable entities of one VMF. Model paths are interned, scale/color/skin are
+    # kept as numbers, and the todo/ready subsets are arrays of row indices into the same table.
+    __slots__ = ("ids", "models", "scales", "colors", "skins", "todo", "ready")
+
+    def __init__(self):
+        self.ids = []
+        self.models = []
+        self.scales = array('d')
+        self.colors = array('I')
+        self.skins = array('i')
+        self.todo = array('I')
+        self.ready = array('I')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, entity_id, model, modelscale, rendercolor, skin):
+        try:
+            skin = int(skin)
+        except ValueError:
+            skin = 0
+        self.ids.append(entity_id)
+        self.models.append(sys.intern(model))
+        self.scales.append(float(modelscale))
+        self.colors.append(pack_rendercolor(rendercolor))
+        self.skins.append(skin)
+        return len(self.ids) - 1
+
+    # String views in the same format as the cache keys
+    def modelscale(self, index):
+        return str(self.scales[index])
+
+    def rendercolor(self, index):
+        return unpack_rendercolor(self.colors[index])
+
+    def skin(self, index):
+        return str(self.skins[index])
+
+    def unique_models(self):
+        return list(dict.fromkeys(self.models))
+
+class ScalePolicy(NamedTuple):
+    # Only one of them is used, in this order: palette, step, tolerance
+    step: float = 0.0
+    tolerance: float = 0.0
+    palette: tuple = ()
+
+    def is_enabled(self):
+        return bool(self.palette) or self.step > 0 or self.tolerance > 0
+
+class ScaleSnapper:
+    # Collapses near-identical scales of a model into one variant before cache lookup and todo planning.
+    # With a tolerance, a scale snaps to the nearest scale of the same model that is already compiled (cache)
+    # or already used in this VMF, if it differs by no more than the tolerance (relative).
+    def __init__(self, policy, psr_cache_data_ready):
+        self.policy = policy
+        self.psr_cache_data_ready = psr_cache_data_ready
+        self.known_scales = {}
+        self.variants_raw = set()
+        self.variants_snapped = set()
+
+    def snap(self, model, scale):
+        model = model.lower()
+        policy = self.policy
+        if policy.palette:
+            snapped = min(policy.palette, key=lambda allowed: abs(math.log(allowed / scale)))
+        elif policy.step > 0:
+            snapped = max(round(scale / policy.step) * policy.step, policy.step)
+        elif policy.tolerance > 0:
+            if model not in self.known_scales:
+                self.known_scales[model] = [float(known) for known in self.psr_cache_data_ready.get(model, {}).get("scales", [])]
+            candidates = [known for known in self.known_scales[model] if abs(known - scale) <= policy.tolerance * known]
+            snapped = min(candidates, key=lambda known: abs(known - scale)) if candidates else scale
+            if snapped not in self.known_scales[model]:
+                self.known_scales[model].append(snapped)
+        else:
+            snapped = scale
+        # Variant names only keep two decimals, so that is the precision of a variant
+        snapped = round(snapped, 2)
+        self.variants_raw.add((model, int(scale * 100)))
+        self.variants_snapped.add((model, int(snapped * 100)))
+        return snapped
+
+    def report(self):
+        merged = len(self.variants_raw) - len(self.variants_snapped)
+        print_and_log(f"Scale snapping: {len(self.variants_raw)} scale variants merged into {len(self.variants_snapped)}.")
+        if merged <= 0:
+            return
+        compile_time, variant_size = get_variant_cost_estimate(self.psr_cache_data_ready)
+        print_and_log(Fore.GREEN + f"Up to {merged} compiles saved (about {merged * compile_time / 60:.1f} minutes and {merged * variant_size / (1024 * 1024):.1f} MB).")
+
+def get_variant_compile_time(model_data):
+    # Average seconds of one variant of the model ("compile_times" per scale), None before its first compile
+    compile_times = model_data.get("compile_times")
+    if compile_times:
+        return sum(compile_times.values()) / len(compile_times)
+    # Caches written before the times were kept per scale: the time of the last compiled variant
+    return model_data.get("compile_time")
+
+def get_variant_cost_estimate(psr_cache_data_ready):
+    # Average compile time (seconds) and size (bytes) of one scaled variant, from what the cache recorded
+    compile_times = [get_variant_compile_time(model_data) for model_data in psr_cache_data_ready.values() if get_variant_compile_time(model_data)]
+    variant_sizes = [model_data["variant_size"] for model_data in psr_cache_data_ready.values() if model_data.get("variant_size")]
+    compile_time = sum(compile_times) / len(compile_times) if compile_times else 20.0
+    # About 4 variants per MB when nothing was recorded yet
+    variant_size = sum(variant_sizes) / len(variant_sizes) if variant_sizes else 256 * 1024
+    return compile_time, variant_size
+
+def parse_scale_policy(scale_step, scale_tolerance, scale_palette):
+    palette = ()
+    if scale_palette:
+        try:
+            palette = tuple(sorted({float(value) for value in scale_palette.replace(',', ' ').split() if float(value) >= 0.01}))
+        except ValueError:
+            print_and_log(Fore.RED + f"ERROR! Wrong scale palette: '{scale_palette}'. Scale snapping by palette is disabled.")
+    return ScalePolicy(max(scale_step, 0.0), max(scale_tolerance, 0.0), palette)
+
+def process_vmf(game_dir, file_path, psr_cache_data_ready, force_recompile=False, classnames = ["prop_static_scalable", "prop_dynamic_scalable", "prop_physics_scalable"], scale_policy=None, instances=True, vmf_tree=None):
+    entity_table = EntityTable()
+    psr_cache_data_raw = {}
+    psr_cache_data_todo = {}
+
+    # Read by scan_vmf, in parallel for a big VMF. vmf_tree: the VMF and its instances when the caller already read them
+    if instances:
+        if vmf_tree is None:
+            vmf_tree = read_vmf_tree(file_path, None, classnames)
+        entities = [entity for vmf_instance in vmf_tree for entity in vmf_instance.entities]
+        if len(vmf_tree) > 1:
+            print_and_log(f"{len(vmf_tree) - 1} instance VMFs read, {len(entities) - len(vmf_tree[0].entities)} scalable entities in them.")
+    else:
+        entities = scan_vmf(file_path, classnames)[0]
+    entities_matches_len = len(entities)
+
+    if entities_matches_len == 0:
             print_and_log(f"No prop_static_scalable entities found.")
-            return entities_raw, entities_ready, entities_todo, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo
-    
-    if entities_matches_len < entities_matches_old_fgd_len:
-        ids_new = {m.group('id') for m in matches}
-
-        for old in matches_old_fgd:
-            old_id = old.group('id')
-            if old_id not in ids_new:
-                gd = old.groupdict()
-
-                rendercolor = gd.get('rendercolor', '255 255 255')
-                skin        = gd.get('skin',        '0')
-                origin      = gd.get('origin',      '0 0 0')
-
-                entity_str = (
-                    f'entity {{ '
-                    f'"id" "{gd["id"]}" '
-                    f'"classname" "{gd["classname"]}" '
-                    f'"model" "{gd["model"]}" '
-                    f'"modelscale" "{gd["modelscale"]}" '
-                    f'"rendercolor" "{rendercolor}" '
-                    f'"skin" "{skin}" '
-                    f'"origin" "{origin}" '
-                    f'}}'
-                )
-
-                new_m = pattern.search(entity_str)
-                if new_m:
-                    matches.append(new_m)
-
-        entities_matches_len = len(matches)
-        if entities_matches_len != entities_matches_old_fgd_len:
-            print_and_log("\n" + Fore.RED + "ERROR: Old keyvalues transformation failed!")
-            print_and_log(Fore.RED + "Props will not be scaled!\n")
-            input("Press any key to continue.")
-            return entities_raw, entities_ready, entities_todo, \
-                   psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo
+            return entity_table, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo
+
+    return process_entities(game_dir, entities, psr_cache_data_ready, force_recompile, scale_policy)
+
+def process_entities(game_dir, entities, psr_cache_data_ready, force_recompile=False, scale_policy=None, record_history=True):
+    # Sorts the entities into ready (cache or disk) and todo, the order of entities is the order models are compiled in.
+    # record_history=False keeps the lookups out of the -stats history (watch mode looks the same map up on every save)
+    entity_table = EntityTable()
+    psr_cache_data_raw = {}
+    psr_cache_data_todo = {}
+    entities_matches_len = len(entities)
 
     psr_cache_data_ready_load = load_global_cache()
     if psr_cache_data_ready_load != None: psr_cache_data_ready = psr_cache_data_ready_load
@@ -227,27 +1284,30 @@ def process_vmf(game_dir, file_path, psr_cache_data_ready, force_recompile=False
     print_and_log(f"{entities_matches_len} prop_static_scalable entities found.")
     print_and_log(f"Reading VMF, please wait...")
 
-    entities_matches_progress = 0
-    for match in matches:
-        print(f"Progress: {int(entities_matches_progress*100/entities_matches_len)}%", end="\r")
-        entities_matches_progress += 1
+    scale_snapper = None
+    if scale_policy is not None and scale_policy.is_enabled():
+        scale_snapper = ScaleSnapper(scale_policy, psr_cache_data_ready)
+
+    progress = ProgressReporter("read_vmf", entities_matches_len)
+    for entity in entities:
+        progress.update()
 
-        if debug_mode: print_and_log(f"                ")
+        log_debug("                ")
         
-        entity_id = match.group('id')
-        if debug_mode: print_and_log(f"id: {entity_id}")
+        entity_id = entity.id
+        log_debug("id: %s", entity_id)
         
-        classname = match.group('classname')
-        if debug_mode: print_and_log(f"classname: {classname}")
+        classname = entity.classname
+        log_debug("classname: %s", classname)
         
-        model = match.group('model')
-        if debug_mode: print_and_log(f"model: {model}")
+        model = entity.model
+        log_debug("model: %s", model)
         
-        origin = match.group('origin')
+        origin = entity.origin
         #if debug_mode: print_and_log(f"origin: {origin}")
         
-        modelscale = match.group('modelscale')
-        if debug_mode: print_and_log(f"modelscale: {modelscale}")
+        modelscale = entity.modelscale
+        log_debug("modelscale: %s", modelscale)
         if "," in modelscale:
             print_and_log(Fore.YELLOW + f"Warning! Model scale of {get_file_name(model)}.mdl has a comma! Entity ID: {entity_id}. Entity origin: '{origin}'. Compiling with scale 1.")
             modelscale = "1.0"
@@ -256,34 +1316,26 @@ def process_vmf(game_dir, file_path, psr_cache_data_ready, force_recompile=False
             print_and_log(Fore.RED + f"ERROR! {get_file_name(model)}.mdl has wrong scale: {modelscale}. Should be more than 0.01. Entity ID: {entity_id}. Entity origin: '{origin}'. Skipping!")
             continue
 
+        if scale_snapper is not None:
+            modelscale = scale_snapper.snap(model, float(modelscale))
+
         # Funny fix
-        modelscale = float(modelscale) 
-        modelscale = str(modelscale)
-        
-        rendercolor = match.group('rendercolor')
-        
+        row = entity_table.append(entity_id, model, modelscale, entity.rendercolor, entity.skin)
+        modelscale = entity_table.modelscale(row)
+        rendercolor = entity_table.rendercolor(row)
         #print_and_log(f"                                ")
         #print_and_log(f"242! rendercolor: {rendercolor}")
         
-        skin = match.group('skin')
+        skin = entity_table.skin(row)
         #print_and_log(f"245! skin: {skin}")
 
         psr_cache_data_raw = add_to_cache(psr_cache_data_raw, model, modelscale, rendercolor, skin)
         #print_and_log(f"248! psr_cache_data_raw: {psr_cache_data_raw}")
 
-        entity_dict = {
-            "id": entity_id,
-            "model": model,
-            "modelscale": modelscale,
-            "rendercolor": rendercolor,
-            "skin": skin
-        }
-        
-        entities_raw.append(entity_dict)
-
         if force_recompile:
-            entities_todo.append(entity_dict)
+            entity_table.todo.append(row)
             psr_cache_data_todo = psr_cache_data_raw
+            lookup_stats.record_outcome("forced")
             continue
         else:
             if len(psr_cache_data_ready) != 0:
@@ -295,7 +1347,8 @@ def process_vmf(game_dir, file_path, psr_cache_data_ready, force_recompile=False
                 # Если собранная энтитя в psr_cache_data_check уже есть в глобальном кэше - добавляем в реди и нет смысла это компилить
                 # вот тут надо проверять единичные статичные модели, должны попадать в реди, в прошлый раз ошибка была связана с тем что check_psr_data видит скейл 1 отличным от 1.0
                 if check_psr_data(psr_cache_data_check, psr_cache_data_ready):
-                    #entities_ready.append(entity_dict)
+                    entity_table.ready.append(row)
+                    lookup_stats.record_outcome("cache hit")
                     #print_and_log(f"check_psr_data: True")
                     is_static = psr_cache_data_ready.get(model, {}).get("is_static", None)
                     #print_and_log(f"model: {model}")
@@ -320,16 +1373,16 @@ def process_vmf(game_dir, file_path, psr_cache_data_ready, force_recompile=False
                 #    print_and_log(f"is_static from global cache: {is_static}")
             mdl_name = get_file_name(model)
             mdl_name_scaled = process_mdl_name(mdl_name, modelscale)
-            mdl_scaled_path = find_mdl_file(game_dir, mdl_name_scaled)
+            # A scaled model on disk only proves the untinted variant, tinted skins are known from the cache only
+            if rendercolor == white_rendercolor:
+                mdl_scaled_path = find_mdl_file(game_dir, mdl_name_scaled)
+            else:
+                mdl_scaled_path = None
             if mdl_scaled_path is None:
-                entities_todo.append(entity_dict)
+                entity_table.todo.append(row)
                 psr_cache_data_todo = add_to_cache(psr_cache_data_todo, model, modelscale, rendercolor, skin)
+                lookup_stats.record_outcome(get_lookup_miss_reason(psr_cache_data_ready, model, modelscale, rendercolor, skin))
                 #print_and_log(f"304! psr_cache_data_todo: {psr_cache_data_todo}")
-            #elif rendercolor is not f"255 255 255": #вот тут чота происходит непонятновое((((
-            #    entities_todo.append(entity_dict)
-            #    print_and_log(f"entity_dict: {entity_dict}                         ")
-            #    print_and_log(f"rendercolor: '{rendercolor}'                         ")
-            #    input("zfsfgh                         ")
             else:
                 # Почему-то казалось что в реди нужно добавлять уже трансформированное имя, но это ошибка, финальное имя генерируется перед встраиванием в VMF
                 '''
@@ -341,47 +1394,296 @@ def process_vmf(game_dir, file_path, psr_cache_data_ready, force_recompile=False
                     "skin": skin
                 }
                 '''
-                #entities_ready.append(entity_dict_ready)
-                #entities_ready.append(entity_dict)
+                entity_table.ready.append(row)
+                lookup_stats.record_outcome("output on disk")
                 is_static = psr_cache_data_ready.get(model, {}).get("is_static", None)
                 psr_cache_data_ready = add_to_cache(psr_cache_data_ready, model, modelscale, rendercolor, skin, is_static=is_static)
                 #print_and_log(f"255! psr_cache_data_ready: {psr_cache_data_ready}")
 
-    print_and_log(f"Progress: Done!")
+    progress.done()
     
     print_and_log(f" ")
 
+    if scale_snapper is not None:
+        scale_snapper.report()
+        print_and_log(f" ")
+
     if force_recompile: print_and_log(Fore.YELLOW + f"Force recompile mode: scaled and static assets removing from project files...")
-    if force_recompile and os.path.exists('props_scaling_recompiler_cache.pkl'):
-        os.remove('props_scaling_recompiler_cache.pkl')
-    if force_recompile: remove_vmf_assets(entities_raw, game_dir, remove_static=True)
+    if force_recompile and os.path.exists(cache_file):
+        os.remove(cache_file)
+    if force_recompile: negative_cache.clear()
+    if force_recompile: remove_vmf_assets(entity_table, game_dir, remove_static=True)
     if force_recompile: print_and_log(f" ")
 
     print_and_log(f"{len(psr_cache_data_ready)} models in cache.")
     print_and_log(f"{len(psr_cache_data_raw)} original models in this VMF.")
-    print_and_log(f"{len(entities_raw)} models variations in this VMF.")
+    print_and_log(f"{len(entity_table)} models variations in this VMF.")
     print_and_log(f"{len(psr_cache_data_todo)} models to recompile for this VMF.")
+    lookup_stats.report_outcomes(save=record_history)
     print_and_log(f" ")
 
     save_global_cache(psr_cache_data_ready)
     
-    return entities_raw, entities_ready, entities_todo, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo
+    return entity_table, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo
+
+class VariantPack:
+    # Scaled variants packed into one VPK (version 1): <name>_dir.vpk holds the file tree, the data goes into
+    # <name>_000.vpk, <name>_001.vpk... New variants are appended to the last archive and only the tree is
+    # rewritten; a variant packed again after a recompile points to its new data. The size and mtime of every
+    # packed loose file are kept in <name>_stamps.json, so unchanged files are skipped without reading them.
+    __slots__ = ("dir_path", "entries", "names", "loaded", "archive_size", "stamps")
+
+    signature = 0x55AA1234
+    embedded_archive = 0x7FFF
+
+    def __init__(self, dir_path=None, archive_size=200 * 1024 * 1024):
+        self.dir_path = dir_path
+        self.entries = {}
+        self.names = {}
+        self.loaded = False
+        self.archive_size = archive_size
+        self.stamps = {}
+
+    def configure(self, dir_path):
+        if dir_path != self.dir_path:
+            self.dir_path = dir_path
+            self.entries = {}
+            self.names = {}
+            self.stamps = {}
+            self.loaded = False
+
+    def get_stamps_path(self):
+        return f"{self.dir_path[:-len('_dir.vpk')]}_stamps.json"
+
+    def get_archive_path(self, archive_index):
+        return f"{self.dir_path[:-len('_dir.vpk')]}_{archive_index:03d}.vpk"
+
+    def load(self):
+        # entries: {"models/props/scaled/rock_scaled_50.mdl": (crc, archive index, offset, length, preload data)}
+        if self.loaded:
+            return
+        self.loaded = True
+        self.entries = {}
+        self.names = {}
+        self.stamps = {}
+        if self.dir_path is None or not os.path.isfile(self.dir_path):
+            return
+        try:
+            with open(self.get_stamps_path(), 'r', encoding='utf-8') as stamps_file:
+                self.stamps = json.load(stamps_file)
+        except (OSError, ValueError):
+            pass
+        with open(self.dir_path, 'rb') as vpk_file:
+            data = vpk_file.read()
+        signature, version, tree_size = struct.unpack_from('<III', data, 0)
+        if signature != self.signature:
+            print_and_log(Fore.YELLOW + f"Warning! {self.dir_path} is not a VPK, ignoring it.")
+            return
+        position = 12 if version == 1 else 28
+        def read_string():
+            nonlocal position
+            end = data.index(b"\0", position)
+            text = data[position:end].decode('utf-8', errors='replace')
+            position = end + 1
+            return text
+        while True:
+            extension = read_string()
+            if not extension:
+                break
+            while True:
+                folder = read_string()
+                if not folder:
+                    break
+                while True:
+                    name = read_string()
+                    if not name:
+                        break
+                    crc, preload_size, archive_index, offset, length, _ = struct.unpack_from('<IHHIIH', data, position)
+                    position += 18
+                    preload = data[position:position + preload_size]
+                    position += preload_size
+                    if archive_index == self.embedded_archive:
+                        offset += (12 if version == 1 else 28) + tree_size
+                    self.add_entry(self.join_path(folder, name, extension), (crc, archive_index, offset, length, preload))
+
+    @staticmethod
+    def join_path(folder, name, extension):
+        path = name if folder.strip() == "" else f"{folder}/{name}"
+        return path if extension.strip() == "" else f"{path}.{extension}"
+
+    def add_entry(self, path, entry):
+        path = path.replace('\\', '/').lower()
+        self.entries[path] = entry
+        self.names[path.rsplit('/', 1)[-1]] = path
+
+    def find(self, path):
+        self.load()
+        path = path.replace('\\', '/').lower()
+        return path if path in self.entries else None
+
+    def find_name(self, file_name):
+        self.load()
+        return self.names.get(file_name.lower())
+
+    def read(self, path):
+        # find() loads the tree first, which replaces self.entries
+        path = self.find(path)
+        crc, archive_index, offset, length, preload = self.entries[path]
+        archive_path = self.dir_path if archive_index == self.embedded_archive else self.get_archive_path(archive_index)
+        with open(archive_path, 'rb') as archive_file:
+            archive_file.seek(offset)
+            return preload + archive_file.read(length)
+
+    def extract(self, path, target_path):
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        with open_atomic(target_path, 'wb') as target_file:
+            target_file.write(self.read(path))
+
+    def append(self, files):
+        # files: {path in the game file system: loose file}. Returns how many were packed, unchanged ones are skipped
+        self.load()
+        archive_indices = [entry[1] for entry in self.entries.values() if entry[1] != self.embedded_archive]
+        archive_index = max(archive_indices, default=0)
+        archive_path = self.get_archive_path(archive_index)
+        archive_size = os.path.getsize(archive_path) if os.path.exists(archive_path) else 0
+        packed = 0
+        stamps_changed = False
+        archive_file = None
+        try:
+            for path, file_path in sorted(files.items()):
+                path = path.replace('\\', '/').lower()
+                file_stat = os.stat(file_path)
+                stamp = [file_stat.st_size, file_stat.st_mtime_ns]
+                entry = self.entries.get(path)
+                if entry is not None and self.stamps.get(path) == stamp:
+                    continue
+                with open(file_path, 'rb') as source_file:
+                    data = source_file.read()
+                crc = zlib.crc32(data)
+                self.stamps[path] = stamp
+                stamps_changed = True
+                if entry is not None and entry[0] == crc and entry[3] + len(entry[4]) == len(data):
+                    continue
+                if archive_size > 0 and archive_size + len(data) > self.archive_size:
+                    if archive_file is not None:
+                        archive_file.close()
+                        archive_file = None
+                    archive_index += 1
+                    archive_size = 0
+                if archive_file is None:
+                    archive_file = open(self.get_archive_path(archive_index), 'ab')
+                archive_file.write(data)
+                self.add_entry(path, (crc, archive_index, archive_size, len(data), b""))
+                archive_size += len(data)
+                packed += 1
+        finally:
+            if archive_file is not None:
+                archive_file.close()
+        if packed:
+            # The archives are complete before the tree points into them
+            self.write_tree()
+        if stamps_changed:
+            with open_atomic(self.get_stamps_path(), 'w', encoding='utf-8') as stamps_file:
+                json.dump(self.stamps, stamps_file)
+        return packed
+
+    def write_tree(self):
+        tree = {}
+        for path, entry in self.entries.items():
+            folder, _, file_name = path.rpartition('/')
+            name, dot, extension = file_name.rpartition('.')
+            if not dot:
+                name, extension = extension, ""
+            tree.setdefault(extension or " ", {}).setdefault(folder or " ", []).append((name, entry))
+        data = bytearray()
+        for extension, folders in sorted(tree.items()):
+            data += extension.encode('utf-8') + b"\0"
+            for folder, names in sorted(folders.items()):
+                data += folder.encode('utf-8') + b"\0"
+                for name, (crc, archive_index, offset, length, preload) in sorted(names):
+                    data += name.encode('utf-8') + b"\0"
+                    data += struct.pack('<IHHIIH', crc, len(preload), archive_index, offset, length, 0xFFFF) + preload
+                data += b"\0"
+            data += b"\0"
+        data += b"\0"
+        with open_atomic(self.dir_path, 'wb') as vpk_file:
+            vpk_file.write(struct.pack('<III', self.signature, 1, len(data)) + data)
+
+variant_pack = VariantPack()
+variant_pack_name = "props_scaling_recompiler_variants"
+
+def register_variant_pack(gameinfo_path, vpk_name):
+    # The pack is mounted right after the mod folder itself, so a loose variant (just recompiled) wins over the packed one.
+    # Returns True if GameInfo.txt was changed, the original is kept next to it.
+    search_path = f"|gameinfo_path|{vpk_name}.vpk"
+    with open(gameinfo_path, 'r', encoding='utf-8', errors='replace') as gameinfo_file:
+        lines = gameinfo_file.readlines()
+    if any(search_path.lower() in line.lower() for line in lines):
+        return False
+    search_paths_index = next((index for index, line in enumerate(lines) if line.strip().lower().startswith("searchpaths")), None)
+    if search_paths_index is None:
+        print_and_log(Fore.YELLOW + f"Warning! SearchPaths not found in {gameinfo_path}, add the VPK to it yourself: {search_path}")
+        return False
+    insert_index = next((index for index in range(search_paths_index, len(lines)) if "{" in lines[index]), search_paths_index) + 1
+    for index in range(insert_index, len(lines)):
+        line = lines[index].split("//")[0].strip()
+        if line.startswith("}"):
+            break
+        if line.lower().endswith("|gameinfo_path|."):
+            insert_index = index + 1
+            break
+    previous_line = lines[insert_index - 1]
+    indent = re.match(r'\s*', previous_line).group(0) if "|" in previous_line else "\t\t\t"
+    lines.insert(insert_index, f"{indent}game+mod\t\t\t{search_path}\n")
+    backup_path = gameinfo_path + ".psr_backup"
+    if not os.path.exists(backup_path):
+        shutil.copyfile(gameinfo_path, backup_path)
+    with open_atomic(gameinfo_path, 'w', encoding='utf-8') as gameinfo_file:
+        gameinfo_file.writelines(lines)
+    return True
+
+def pack_variants(game_dir, gameinfo_path, subfolders, psr_cache_data_ready, remove_loose=False):
+    # Every compiled variant of the cache that is a loose file goes into the pack
+    files = {}
+    for model, model_data in psr_cache_data_ready.items():
+        for modelscale in model_data.get("scales", []):
+            base_path = os.path.splitext(os.path.join(game_dir, get_scaled_hammer_model(model, modelscale, subfolders)))[0]
+            for ext in compiled_model_extensions:
+                if os.path.isfile(base_path + ext):
+                    files[os.path.relpath(base_path + ext, game_dir).replace('\\', '/')] = base_path + ext
+    print_and_log(f" ")
+    print_and_log(f"Packing scaled variants into {variant_pack.dir_path}...")
+    packed = variant_pack.append(files)
+    if register_variant_pack(gameinfo_path, variant_pack_name):
+        print_and_log(Fore.YELLOW + f"{variant_pack_name}.vpk added to the search paths of {gameinfo_path}, the original is saved as GameInfo.txt.psr_backup.")
+    removed = 0
+    if remove_loose:
+        for path, file_path in files.items():
+            # Only what the pack really holds now
+            if variant_pack.find(path) is not None:
+                os.remove(file_path)
+                removed += 1
+    print_and_log(f"{packed} files packed, {len(variant_pack.entries)} files in the VPK, {removed} loose files removed.")
 
 def find_mdl_file(game_dir, mdl_name):
     mdl_filename = f"{mdl_name}.mdl"
+    packed_path = variant_pack.find_name(mdl_filename)
+    if packed_path is not None:
+        # Where the model is in the game file system, the file itself is in the pack
+        return os.path.join(game_dir, packed_path)
     for root, dirs, files in os.walk(game_dir):
         if mdl_filename in files:
             full_path = os.path.join(root, mdl_filename)
             if full_path.startswith(os.path.join(game_dir, "models")):
-                if debug_mode: print_and_log(f"[find_mdl_file] {mdl_name}.mdl full_path: {full_path}")
+                log_debug("[find_mdl_file] %s.mdl full_path: %s", mdl_name, full_path)
                 return full_path
             else:
                 models_index = full_path.find("\\models\\")
                 if models_index != -1:
                     mdl_path_custom = os.path.join(game_dir, full_path[models_index + 1:])
-                    if debug_mode: print_and_log(f"Warning! {mdl_name}.mdl found in some custom folder!")
-                    if debug_mode: print_and_log(f"[find_mdl_file] {mdl_name}.mdl full_path: {full_path}")
-                    if debug_mode: print_and_log(f"[find_mdl_file] Hammer {mdl_name}.mdl path: {transform_mdl_path_to_hammer_style(mdl_path_custom)}")
+                    log_debug("Warning! %s.mdl found in some custom folder!", mdl_name)
+                    log_debug("[find_mdl_file] %s.mdl full_path: %s", mdl_name, full_path)
+                    log_debug("[find_mdl_file] Hammer %s.mdl path: %s", mdl_name, transform_mdl_path_to_hammer_style(mdl_path_custom))
                     return mdl_path_custom
     return None
 
@@ -411,6 +1713,16 @@ def find_real_mdl_path(game_dir: str, hammer_mdl_path: str) -> str | None:
 
         if rel_parts[-len(hammer_parts):] == hammer_parts:
             return str(candidate)
+
+    packed_path = variant_pack.find(hammer_mdl_path)
+    if packed_path is not None:
+        # Decompiling needs real files, the model is extracted from the pack
+        extract_folder = os.path.join(scratch.get_run_dir(), "packed")
+        base_path = os.path.splitext(packed_path)[0]
+        for ext in compiled_model_extensions:
+            if variant_pack.find(base_path + ext) is not None:
+                variant_pack.extract(base_path + ext, os.path.join(extract_folder, base_path + ext))
+        return os.path.join(extract_folder, packed_path)
     
     return None
 
@@ -462,7 +1774,7 @@ def remove_all_scaled_files(game_dir):
             if "_scaled_" in file and file.endswith(('.vtx', '.mdl', '.phy', '.vvd')):
                 file_path = os.path.join(root, file)
                 os.remove(file_path)
-                if debug_mode: print_and_log(f"Scaled file removed: {file_path}")
+                log_debug("Scaled file removed: %s", file_path)
 
 def remove_scaled_files(game_dir, mdl_name, remove_static=False):
     mdl_name = mdl_name.lower()
@@ -473,49 +1785,76 @@ def remove_scaled_files(game_dir, mdl_name, remove_static=False):
                 if "_scaled_" in file_lower and file_lower.endswith(('.vtx', '.mdl', '.phy', '.vvd')):
                     file_path = os.path.join(root, file)
                     os.remove(file_path)
-                    if debug_mode: print_and_log(f"Scaled file removed: {file_path}")
+                    log_debug("Scaled file removed: %s", file_path)
                 elif remove_static:
                     if "_static" in file_lower and file_lower.endswith(('.vtx', '.mdl', '.phy', '.vvd')):
                         file_path = os.path.join(root, file)
                         os.remove(file_path)
-                        if debug_mode: print_and_log(f"Static file removed: {file_path}")
+                        log_debug("Static file removed: %s", file_path)
 
 
-def remove_vmf_assets(entities_raw, game_dir, remove_static=False):
-    entities_raw_len = len(entities_raw)
-    entities_raw_progress = 0
+def remove_vmf_assets(entity_table, game_dir, remove_static=False):
+    # Every variant of a model is removed by one walk, so each unique model is visited once
+    models = entity_table.unique_models()
+    progress = ProgressReporter("remove_assets", len(models))
     
-    for entity in entities_raw:
-        if debug_mode: print_and_log(f"[remove_vmf_assets] entity: {entity}")
-        model = entity['model']
-        if debug_mode: print_and_log(f"[remove_vmf_assets] model: {model}")
+    for model in models:
+        log_debug("[remove_vmf_assets] model: %s", model)
         mdl_name = get_file_name(model)
-        if debug_mode: print_and_log(f"[remove_vmf_assets] mdl_name: {mdl_name}")
+        log_debug("[remove_vmf_assets] mdl_name: %s", mdl_name)
         remove_scaled_files(game_dir, mdl_name, remove_static)
-        
-        entities_raw_progress += 1
-        
-        if entities_raw_progress >= entities_raw_len:
-            print_and_log(f"Progress: Done!")
-        else:
-            print(f"Progress: {int(entities_raw_progress*100/entities_raw_len)}%", end="\r")
+        progress.update()
 
-def run_ccld(mdl_path, ccld_path, decomp_folder):
+    progress.done()
+
+def run_ccld(mdl_path, ccld_path, decomp_folder, cancel=None):
     print_and_log(f"\nDecompilation started with CrowbarCommandLineDecomp:\n")
     try:
-        command = f'"{ccld_path}" -p "{mdl_path}" -o "{decomp_folder}"'
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        if result.returncode == 0:
-            if debug_mode: print_and_log(f"\nEnd of decompilation")
-            #print_and_log(f"CrowbarCommandLineDecomp out: {result.stdout}")
+        command = [ccld_path, "-p", mdl_path, "-o", decomp_folder]
+        job_log_path = get_job_log_path(f"ccld_{get_file_name(mdl_path)}", mdl_path)
+        base_path = os.path.splitext(mdl_path)[0]
+        input_size = get_files_size([base_path + ext for ext in (".mdl", ".vvd", ".phy", ".dx90.vtx")])
+        timeout, idle_timeout = get_tool_timeout("ccld", input_size)
+        result = process_runner.run(command, timeout=timeout, idle_timeout=idle_timeout, input_size=input_size, job_log_path=job_log_path, cancel=cancel)
+        if result.cancelled:
+            print_and_log(Fore.YELLOW + f"\nDecompilation cancelled, {get_file_name(mdl_path)}.mdl is not used anymore.")
+        elif result.timed_out:
+            print_and_log(Fore.RED + f"\nERROR decompilation! CrowbarCommandLineDecomp timed out after {timeout:.0f} seconds. Log: {job_log_path}", level=LOG_ERROR)
+        elif result.hung:
+            print_and_log(Fore.RED + f"\nERROR decompilation! CrowbarCommandLineDecomp printed nothing for {idle_timeout:.0f} seconds and was stopped. Log: {job_log_path}", level=LOG_ERROR)
+        elif result.returncode == 0:
+            log_debug("\nEnd of decompilation")
+            log_debug("CrowbarCommandLineDecomp log: %s", job_log_path)
         else:
-            print_and_log(Fore.RED + f"\nERROR decompilation!")
-            #print_and_log(f"CrowbarCommandLineDecomp Error: {result.stderr}")
+            print_and_log(Fore.RED + f"\nERROR decompilation! CrowbarCommandLineDecomp log: {job_log_path}", level=LOG_ERROR)
     
     except Exception as e:
         print_and_log(Fore.RED + f"ERROR: {e}")
 
-def compile_model(compiler_path, game_folder, qc_path, hammer_mdl_path, scale, rendercolor, skin, psr_cache_data_todo, psr_cache_data_ready):
+compiled_model_extensions = (".mdl", ".vvd", ".phy", ".dx80.vtx", ".dx90.vtx", ".sw.vtx", ".vtx")
+
+def get_compiled_model_files(game_folder, qc_path):
+    # The .mdl/.vvd/.vtx/.phy files studiomdl writes for the $modelname of this QC
+    with open(qc_path, 'r') as file:
+        modelname = next((line.split('"')[1] for line in file if line.strip().startswith("$modelname") and line.count('"') >= 2), None)
+    if modelname is None:
+        return []
+    mdl_path = os.path.join(game_folder, "models", modelname)
+    base_path = os.path.splitext(mdl_path)[0]
+    return [base_path + ext for ext in compiled_model_extensions]
+
+def get_compiled_model_size(game_folder, qc_path):
+    return get_files_size(get_compiled_model_files(game_folder, qc_path))
+
+def remove_compiled_model_files(output_paths, since):
+    # Only the files written after the compile started, an older valid variant stays
+    for output_path in output_paths:
+        if os.path.exists(output_path) and os.path.getmtime(output_path) >= since - 1:
+            os.remove(output_path)
+            log_debug("Partial output removed: %s", output_path)
+
+# Returns None on success, otherwise the reason of the failure
+def compile_model(compiler_path, game_folder, qc_path, hammer_mdl_path, scale, colors, tinted_count, skin_families, psr_cache_data_todo, psr_cache_data_ready):
     command = [
         compiler_path,
         "-game", game_folder,
@@ -524,20 +1863,85 @@ def compile_model(compiler_path, game_folder, qc_path, hammer_mdl_path, scale, r
         qc_path
     ]
 
-    try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print_and_log("Output:", result.stdout.decode())
-        output = result.stdout.decode('utf-8')
-        if f'Completed "{os.path.basename(qc_path)}"' in output:
-            is_static = psr_cache_data_ready.get(hammer_mdl_path, {}).get("is_static", None)
-            psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, scale, rendercolor, skin, is_static=is_static)
-            save_global_cache(psr_cache_data_ready)
-        #else:
-        #    print_and_log(Fore.RED + f"Model compilation failed!")
-    except subprocess.CalledProcessError as e:
-        print_and_log(Fore.RED + f"Model compilation failed! An error occurred: {e}")
-        print_and_log("Output:", e.stdout.decode())
-        #print_and_log("Errors:", e.stderr.decode())
+    # Spot the 'Completed "<qc>"' line while studiomdl is still writing its output
+    completed_line = f'Completed "{os.path.basename(qc_path)}"'
+    completed = False
+
+    def on_line(stream_name, line):
+        nonlocal completed
+        if completed_line in line:
+            completed = True
+
+    job_log_path = get_job_log_path(f"studiomdl_{get_file_name(qc_path)}", qc_path)
+    # Source meshes next to the QC are what studiomdl spends its time on
+    qc_folder = os.path.dirname(qc_path)
+    input_size = get_files_size([os.path.join(qc_folder, name) for name in os.listdir(qc_folder) if name.lower().endswith((".smd", ".dmx", ".vta"))])
+    timeout, idle_timeout = get_tool_timeout("studiomdl", input_size)
+    modelscale = str(float(scale))
+    output_paths = get_compiled_model_files(game_folder, qc_path)
+    for output_path in output_paths:
+        # Shared with an identical model by a hardlink, studiomdl must not write into the other model's file
+        if os.path.exists(output_path) and os.stat(output_path).st_nlink > 1:
+            os.remove(output_path)
+    start_time = time.time()
+    journal.write("compile", hammer_mdl_path, "started", scale=modelscale, outputs=output_paths)
+    new_colors = get_new_colors(hammer_mdl_path, colors, psr_cache_data_ready)
+    result = process_runner.run(command, timeout=timeout, idle_timeout=idle_timeout, input_size=input_size, job_log_path=job_log_path, on_line=on_line,
+                                cancel=lambda: not is_variant_wanted(hammer_mdl_path, scale, new_colors))
+    failure = get_compile_failure(result, timeout, idle_timeout, job_log_path, completed)
+    if failure is not None:
+        # Whatever studiomdl managed to write is not a valid model
+        remove_compiled_model_files(output_paths, start_time)
+        journal.write("compile", hammer_mdl_path, "failed", scale=modelscale, reason=failure)
+        return failure
+
+    print_and_log(f"studiomdl log: {job_log_path}")
+    is_static = psr_cache_data_ready.get(hammer_mdl_path, {}).get("is_static", None)
+    for rendercolor, skin in colors:
+        psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale, rendercolor[0], skin[0], is_static=is_static)
+    set_compiled_palette(psr_cache_data_ready, hammer_mdl_path, modelscale, tinted_count, skin_families)
+    model_data = psr_cache_data_ready[hammer_mdl_path.lower()]
+    model_data.setdefault("compile_times", {})[modelscale] = result.duration
+    model_data.pop("compile_time", None)
+    model_data["input_size"] = input_size
+    variant_size = get_files_size(output_paths)
+    if variant_size:
+        model_data["variant_size"] = variant_size
+    if job_outputs is not None:
+        job_outputs.extend(output_paths)
+    # Journal first: if the run dies in between, the variant is only compiled once more
+    journal.write("compile", hammer_mdl_path, "completed", scale=modelscale)
+    save_global_cache(psr_cache_data_ready)
+    return None
+
+def get_compile_failure(result, timeout, idle_timeout, job_log_path, completed):
+    if result.cancelled:
+        print_and_log(Fore.YELLOW + f"Model compilation cancelled, the variant is not used anymore.")
+        return "cancelled"
+
+    if result.timed_out:
+        print_and_log(Fore.RED + f"Model compilation failed! studiomdl timed out after {timeout:.0f} seconds.", level=LOG_ERROR)
+        print_and_log(f"studiomdl log: {job_log_path}")
+        return "timed out"
+
+    if result.hung:
+        print_and_log(Fore.RED + f"Model compilation failed! studiomdl printed nothing for {idle_timeout:.0f} seconds and was stopped.", level=LOG_ERROR)
+        print_and_log(f"studiomdl log: {job_log_path}")
+        return "hung"
+
+    if result.returncode != 0:
+        print_and_log(Fore.RED + f"Model compilation failed! studiomdl returned exit status {result.returncode}.", level=LOG_ERROR)
+        print_and_log(f"studiomdl log: {job_log_path}")
+        print_and_log("Output (last lines):\n" + read_job_log_tail(job_log_path))
+        return f"exit status {result.returncode}"
+
+    if not completed:
+        print_and_log(f"studiomdl log: {job_log_path}")
+        print_and_log(Fore.RED + f"Model compilation failed!", level=LOG_ERROR)
+        print_and_log("Output (last lines):\n" + read_job_log_tail(job_log_path))
+        return "compilation failed"
+
+    return None
 
 def fix_phys_collision_smd(qc_path):
     try:
@@ -591,14 +1995,247 @@ def fix_phys_collision_smd(qc_path):
         print_and_log(Fore.RED + f"ERROR: {e}")
         return False
 
-def rescale_qc_file(qc_path, scale, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, convert_to_static=False, subfolders=True):
-    prop_physics = False
-    prop_dynamic = False
-    prop_static = False
-    new_qc_path = qc_path
-    new_scale = scale
-    new_hammer_modelname = None
+def get_tint_suffix(rendercolor):
+    return f"_tint_{pack_rendercolor(rendercolor):06x}"
 
+def read_smd_materials(smd_path):
+    materials = []
+    with open(smd_path, 'r', encoding='utf-8', errors='replace') as smd_file:
+        in_triangles = False
+        triangle_line = 0
+        for line in smd_file:
+            line = line.strip()
+            if not in_triangles:
+                if line == "triangles":
+                    in_triangles = True
+                    triangle_line = 0
+                continue
+            if line == "end":
+                in_triangles = False
+                continue
+            # material name, then three vertex lines
+            if triangle_line % 4 == 0:
+                material = re.sub(r'\.(bmp|tga|vmt)$', '', line, flags=re.IGNORECASE)
+                if material not in materials:
+                    materials.append(material)
+            triangle_line += 1
+    return materials
+
+def read_qc_skin_data(qc_document):
+    # Returns the $cdmaterials folders and the skin families of the model. Without a $texturegroup the model
+    # has one family made of every material used by its meshes.
+    qc_path = qc_document.path
+    lines = qc_document.lines
+
+    cdmaterials = []
+    smd_files = []
+    texturegroup_text = None
+    brace_depth = 0
+    for line in lines:
+        stripped = line.strip()
+        if texturegroup_text is not None and brace_depth >= 0:
+            texturegroup_text += stripped + "\n"
+            brace_depth += stripped.count("{") - stripped.count("}")
+            if brace_depth == 0 and "}" in stripped:
+                brace_depth = -1
+            continue
+        keyword = stripped.split(maxsplit=1)[0].lower() if stripped else ""
+        if keyword == "$cdmaterials":
+            cdmaterials += re.findall(r'"([^"]*)"', stripped)
+        elif keyword == "$texturegroup":
+            texturegroup_text = stripped + "\n"
+            brace_depth = stripped.count("{") - stripped.count("}")
+        elif keyword in ("$body", "$model", "studio", "replacemodel"):
+            smd_files += [name for name in re.findall(r'"([^"]*)"', stripped) if name.lower().endswith(".smd")]
+
+    if texturegroup_text is not None:
+        families = [re.findall(r'"([^"]*)"', family) for family in re.findall(r'\{([^{}]*)\}', texturegroup_text)]
+        families = [family for family in families if family]
+        if families:
+            return cdmaterials, families
+
+    materials = []
+    for smd_file in smd_files:
+        smd_path = os.path.join(os.path.dirname(qc_path), smd_file)
+        if os.path.exists(smd_path):
+            for material in read_smd_materials(smd_path):
+                if material not in materials:
+                    materials.append(material)
+    return cdmaterials, [materials]
+
+def build_skin_families(families, tinted_colors):
+    skin_families = [list(family) for family in families]
+    for rendercolor, skin in tinted_colors:
+        skin_index = int(skin[0]) if skin[0].isdigit() else 0
+        base_family = families[skin_index] if skin_index < len(families) else families[0]
+        tint_suffix = get_tint_suffix(rendercolor[0])
+        skin_families.append([material + tint_suffix for material in base_family])
+    return skin_families
+
+def format_texturegroup(skin_families):
+    lines = ['$texturegroup "skinfamilies"\n', '{\n']
+    for family in skin_families:
+        lines.append('\t{ ' + ' '.join(f'"{material}"' for material in family) + ' }\n')
+    lines.append('}\n')
+    return lines
+
+# Set to a list by a queue worker to collect the files a job wrote (compiled models, tinted materials), they are sent back to the coordinator
+job_outputs = None
+
+def write_tinted_materials(game_dir, cdmaterials, materials, rendercolor):
+    # Tinted materials are "patch" VMTs that include the original material, so textures are never copied
+    # and the original may live in a VPK. They are written once per model and color.
+    red, green, blue = ((pack_rendercolor(rendercolor) >> shift) & 0xFF for shift in (16, 8, 0))
+    color2 = f"[{red / 255:.4f} {green / 255:.4f} {blue / 255:.4f}]"
+    tint_suffix = get_tint_suffix(rendercolor)
+    cdmaterials = [cdmaterial.replace('\\', '/').strip('/') for cdmaterial in cdmaterials] or [""]
+
+    for material in materials:
+        material = material.replace('\\', '/')
+        material_folder = cdmaterials[0]
+        for cdmaterial in cdmaterials:
+            if os.path.exists(os.path.join(game_dir, "materials", cdmaterial, material + ".vmt")):
+                material_folder = cdmaterial
+                break
+
+        tinted_vmt_path = os.path.join(game_dir, "materials", material_folder, material + tint_suffix + ".vmt")
+        if job_outputs is not None:
+            job_outputs.append(tinted_vmt_path)
+        if os.path.exists(tinted_vmt_path):
+            continue
+        os.makedirs(os.path.dirname(tinted_vmt_path), exist_ok=True)
+        include_path = "/".join(part for part in ("materials", material_folder, material + ".vmt") if part)
+        with open_atomic(tinted_vmt_path, 'w', encoding='utf-8') as vmt_file:
+            vmt_file.write(f'"patch"\n{{\n\t"include" "{include_path}"\n\t"insert"\n\t{{\n\t\t"$color2" "{color2}"\n\t}}\n}}\n')
+        log_debug("Tinted material written: %s", tinted_vmt_path)
+
+class QcDocument:
+    # Decompiled QC read once, with $include files inlined. Every scale variant is emitted from it
+    # instead of copying the QC and parsing the copy again for each scale. The file paths of an included file
+    # from another folder are rewritten relative to the main QC, where the variants are written.
+    __slots__ = ("path", "lines", "modelname", "modelname_index", "scale_index", "staticprop_index",
+                 "staticprop_found", "keyvalues_found", "prop_data_found", "scale_found",
+                 "lod_indices", "commented_indices", "texturegroup_range", "mesh_indices", "lod_blocks",
+                 "collision_index", "collision_smd", "collision_concave", "smd_triangles")
+
+    def __init__(self, path, lines):
+        self.path = path
+        self.lines = lines
+        self.modelname = None
+        self.modelname_index = -1
+        self.scale_index = -1
+        self.staticprop_index = -1
+        self.lod_indices = set()
+        self.commented_indices = set()
+        self.texturegroup_range = None
+        # {line index: SMD} of the $body/$model/studio meshes, and (start, end, [(mesh, LOD mesh)]) of the $lod blocks
+        self.mesh_indices = {}
+        self.lod_blocks = []
+        self.collision_index = -1
+        self.collision_smd = None
+        self.collision_concave = False
+        # {SMD: triangles} of the meshes counted or read so far
+        self.smd_triangles = {}
+
+        self.staticprop_found = any("$staticprop" in line for line in lines)
+        self.keyvalues_found = any("$keyvalues" in line for line in lines)
+        self.prop_data_found = any("prop_data" in line for line in lines)
+        self.scale_found = any("$scale" in line for line in lines)
+
+        for index, line in enumerate(lines):
+            stripped = line.strip()
+            if stripped.startswith("$modelname"):
+                self.modelname = stripped.split('"')[1] if stripped.count('"') >= 2 else None
+                self.modelname_index = index
+            if stripped.startswith("$scale"):
+                self.scale_index = index
+            if stripped.startswith("$staticprop"):
+                self.staticprop_index = index
+            if stripped.startswith("$lod"):
+                self.lod_indices.add(index)
+                self.lod_blocks.append(self.read_lod_block(lines, index))
+            if stripped.lower().startswith("$collisionmodel"):
+                smd_names = re.findall(r'"([^"]*)"', stripped)
+                if smd_names:
+                    self.collision_index = index
+                    self.collision_smd = smd_names[0]
+                    _, block_end, _ = self.read_lod_block(lines, index)
+                    self.collision_concave = any(block_line.strip().lower().startswith("$concave") for block_line in lines[index + 1:block_end])
+            if stripped.lower().startswith(("$body", "$model", "studio")):
+                smd_names = [name for name in re.findall(r'"([^"]*)"', stripped) if name.lower().endswith(".smd")]
+                if smd_names:
+                    self.mesh_indices[index] = smd_names[-1]
+            if stripped.startswith(("$bbox", "$cbox", "$illumposition", "$definebone", "$hboxset")):
+                self.commented_indices.add(index)
+            if self.texturegroup_range is None and stripped.lower().startswith("$texturegroup"):
+                brace_depth = 0
+                texturegroup_end = index
+                for end_index in range(index, len(lines)):
+                    brace_depth += lines[end_index].count("{") - lines[end_index].count("}")
+                    texturegroup_end = end_index + 1
+                    if brace_depth == 0 and "}" in lines[end_index]:
+                        break
+                self.texturegroup_range = (index, texturegroup_end)
+
+    @staticmethod
+    def read_lod_block(lines, start):
+        brace_depth = 0
+        end = start + 1
+        replacements = []
+        for end_index in range(start, len(lines)):
+            line = lines[end_index]
+            if line.strip().lower().startswith("replacemodel"):
+                names = re.findall(r'"([^"]*)"', line)
+                if len(names) >= 2:
+                    replacements.append((names[0], names[1]))
+            brace_depth += line.count("{") - line.count("}")
+            end = end_index + 1
+            if brace_depth == 0 and "}" in line:
+                break
+        return start, end, replacements
+
+    # Quoted source files in QC commands ($body, $model, replacemodel, $collisionmodel, $sequence...)
+    file_name_pattern = re.compile(r'"([^"]+\.(?:smd|dmx|vta|vrd|qci|qc))"', re.IGNORECASE)
+
+    @classmethod
+    def parse(cls, qc_path):
+        return cls(qc_path, cls.read_lines(qc_path, set()))
+
+    @classmethod
+    def read_lines(cls, qc_path, included, main_folder=None):
+        included.add(os.path.normcase(os.path.abspath(qc_path)))
+        with open(qc_path, 'r') as file:
+            lines = [line if line.endswith("\n") else line + "\n" for line in file]
+
+        folder = os.path.dirname(qc_path)
+        if main_folder is None:
+            main_folder = folder
+        rebase = os.path.normcase(os.path.abspath(folder)) != os.path.normcase(os.path.abspath(main_folder))
+        result = []
+        for line in lines:
+            stripped = line.strip()
+            if stripped.lower().startswith("$include"):
+                include_names = re.findall(r'"([^"]*)"', stripped) or stripped.split()[1:2]
+                include_path = os.path.join(folder, include_names[0]) if include_names else ""
+                if os.path.isfile(include_path) and os.path.normcase(os.path.abspath(include_path)) not in included:
+                    result.append(f"// {line}")
+                    result += cls.read_lines(include_path, included, main_folder)
+                    continue
+            if rebase:
+                line = cls.rebase_file_names(line, folder, main_folder)
+            result.append(line)
+        return result
+
+    @classmethod
+    def rebase_file_names(cls, line, folder, main_folder):
+        def replacer(match):
+            file_name = match.group(1)
+            if os.path.isabs(file_name):
+                return match.group(0)
+            return '"' + os.path.relpath(os.path.join(folder, file_name), main_folder).replace('\\', '/') + '"'
+        return cls.file_name_pattern.sub(replacer, line)
+
+    @staticmethod
     def scale_values(line, scale):
         numbers = re.findall(r"[-+]?\d*\.\d+|\d+", line)
         scaled_numbers = [str(float(num) * scale) for num in numbers]
@@ -611,23 +2248,455 @@ def rescale_qc_file(qc_path, scale, hammer_mdl_path, psr_cache_data_todo, psr_ca
                 new_line += part
         return new_line
 
-    def comment_line(line):
-        return f"// {line}"
+    def emit(self, new_model_path, scale_multi, skin_families=None, mesh_optimization=None):
+        # Lines of one variant: new $modelname, $scale and $staticprop, scaled $lod distances, commented out
+        # bounding boxes and bones, the skin families with the tinted ones, and the decimated meshes without the dropped LODs
+        staticprop_lines = ["$staticprop\n"] if self.staticprop_index == -1 else []
+        texturegroup_start, texturegroup_end = self.texturegroup_range or (-1, -1)
+        mesh_replacements = mesh_optimization.replacements if mesh_optimization else {}
+        dropped_ranges = mesh_optimization.dropped_ranges if mesh_optimization else []
+        lines = []
+        for index, line in enumerate(self.lines):
+            if any(start <= index < end for start, end in dropped_ranges):
+                lines.append(f"// {line}")
+                continue
+            if index in mesh_replacements:
+                line = line.replace(*mesh_replacements[index])
+            if skin_families and texturegroup_start <= index < texturegroup_end:
+                if index == texturegroup_start:
+                    lines += format_texturegroup(skin_families)
+                continue
+            if index == self.modelname_index:
+                lines.append(f'$modelname "{new_model_path}"\n')
+                if self.scale_index == -1:
+                    lines += ['\n', f"$scale {scale_multi}\n"] + staticprop_lines
+            elif index == self.scale_index:
+                lines += [f"$scale {scale_multi}\n"] + staticprop_lines
+            elif index in self.lod_indices:
+                lines.append(self.scale_values(line, scale_multi))
+            elif index in self.commented_indices:
+                lines.append(f"// {line}")
+            else:
+                lines.append(line)
+        if skin_families and self.texturegroup_range is None:
+            lines += ['\n'] + format_texturegroup(skin_families)
+        return lines
+
+    def get_triangle_count(self):
+        # Triangles of the reference meshes and their LODs, animation SMDs have none
+        smd_names = set(self.mesh_indices.values())
+        for _, _, replacements in self.lod_blocks:
+            smd_names.update(lod_name if lod_name.lower().endswith(".smd") else lod_name + ".smd" for _, lod_name in replacements)
+        qc_folder = os.path.dirname(self.path)
+        for smd_name in smd_names:
+            if smd_name not in self.smd_triangles:
+                self.smd_triangles[smd_name] = get_smd_triangle_count(os.path.join(qc_folder, smd_name))
+        return sum(self.smd_triangles[smd_name] for smd_name in smd_names)
+
+# -min_feature_size: details smaller than this (world units, after scaling) are merged away in down-scaled variants, None = off
+mesh_min_feature_size = None
+# Part of the variant key of decimated variants, changed when decimate_triangles gives other meshes
+mesh_decimation_version = "winding kept"
+# (model, variant, triangles before, triangles after, dropped LODs) of this run
+mesh_report = []
+
+class MeshOptimization(NamedTuple):
+    replacements: dict
+    dropped_ranges: list
+    triangles_before: int
+    triangles_after: int
+
+def read_smd(smd_path):
+    # Lines before the triangles block, the triangles (material, three vertex lines split into fields) and the lines after it
+    header, triangles, trailer = [], [], []
+    with open(smd_path, 'r', encoding='utf-8', errors='replace') as smd_file:
+        lines = smd_file.readlines()
+    index = 0
+    while index < len(lines) and lines[index].strip().lower() != "triangles":
+        header.append(lines[index])
+        index += 1
+    index += 1
+    while index < len(lines) and lines[index].strip().lower() != "end":
+        if not lines[index].strip():
+            index += 1
+            continue
+        material = lines[index].strip()
+        vertices = [line.split() for line in lines[index + 1:index + 4]]
+        if len(vertices) == 3 and all(len(vertex) >= 9 for vertex in vertices):
+            triangles.append((material, vertices))
+        index += 4
+    trailer = lines[index + 1:]
+    return header, triangles, trailer
+
+def write_smd(smd_path, header, triangles, trailer):
+    with open(smd_path, 'w', encoding='utf-8') as smd_file:
+        smd_file.writelines(header)
+        smd_file.write("triangles\n")
+        for material, vertices in triangles:
+            smd_file.write(material + "\n")
+            for vertex in vertices:
+                smd_file.write("  " + " ".join(vertex) + "\n")
+        smd_file.write("end\n")
+        smd_file.writelines(trailer)
+
+def decimate_triangles(triangles, cell_size):
+    # Vertex clustering with quadric error metrics (Lindstrom, "Out-of-core simplification of large polygonal models"):
+    # the vertices of one grid cell merge into the point that fits the planes of their triangles best,
+    # triangles that lose a corner disappear. One pass over the triangles, no mesh connectivity needed.
+    clusters = {}
+    triangle_keys = []
+    for material, vertices in triangles:
+        points = [(float(vertex[1]), float(vertex[2]), float(vertex[3])) for vertex in vertices]
+        keys = [(math.floor(x / cell_size), math.floor(y / cell_size), math.floor(z / cell_size)) for x, y, z in points]
+        triangle_keys.append(keys)
+        (x0, y0, z0), (x1, y1, z1), (x2, y2, z2) = points
+        ux, uy, uz, vx, vy, vz = x1 - x0, y1 - y0, z1 - z0, x2 - x0, y2 - y0, z2 - z0
+        nx, ny, nz = uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx
+        length = math.sqrt(nx * nx + ny * ny + nz * nz)
+        for key, point in zip(keys, points):
+            cluster = clusters.get(key)
+            if cluster is None:
+                cluster = clusters[key] = [0.0] * 13
+            cluster[9] += point[0]
+            cluster[10] += point[1]
+            cluster[11] += point[2]
+            cluster[12] += 1
+            if length > 0:
+                # Plane quadric weighted by the triangle area
+                a, b, c = nx / length, ny / length, nz / length
+                d = -(a * x0 + b * y0 + c * z0)
+                weight = length / 2
+                for slot, value in enumerate((a * a, a * b, a * c, b * b, b * c, c * c, a * d, b * d, c * d)):
+                    cluster[slot] += value * weight
+
+    positions = {}
+    for key, (aa, ab, ac, bb, bc, cc, ad, bd, cd, sum_x, sum_y, sum_z, count) in clusters.items():
+        mean = (sum_x / count, sum_y / count, sum_z / count)
+        determinant = aa * (bb * cc - bc * bc) - ab * (ab * cc - bc * ac) + ac * (ab * bc - bb * ac)
+        position = mean
+        if abs(determinant) > 1e-9:
+            # Cramer's rule for A * p = -b
+            position = ((-ad * (bb * cc - bc * bc) + ab * (bd * cc - bc * cd) - ac * (bd * bc - bb * cd)) / determinant,
+                        (aa * (-bd * cc + bc * cd) + ad * (ab * cc - bc * ac) + ac * (ab * -cd + bd * ac)) / determinant,
+                        (aa * (bb * -cd + bd * bc) - ab * (ab * -cd + bd * ac) - ad * (ab * bc - bb * ac)) / determinant)
+            # A point far outside its cell (nearly flat area) is worse than the mean
+            if any(abs(coordinate - key[axis] * cell_size - cell_size / 2) > cell_size for axis, coordinate in enumerate(position)):
+                position = mean
+        positions[key] = " ".join(f"{coordinate:.6f}" for coordinate in position).split()
 
-    with open(qc_path, 'r') as file:
-        lines = file.readlines()
-        #content = file.read()
+    result = []
+    seen = set()
+    for (material, vertices), keys in zip(triangles, triangle_keys):
+        if len(set(keys)) < 3:
+            continue
+        # Same cells in the same winding order, rotated to start at the smallest cell. The back face of a
+        # double-sided card has the opposite winding and stays.
+        first = keys.index(min(keys))
+        signature = (material, tuple(keys[first:] + keys[:first]))
+        if signature in seen:
+            continue
+        seen.add(signature)
+        result.append((material, [vertex[:1] + positions[key] + vertex[4:] for vertex, key in zip(vertices, keys)]))
+    return result
+
+def optimize_variant_meshes(qc_document, scale, variant_suffix):
+    # Decimates the meshes of a down-scaled variant and drops the LODs that are not lighter than the decimated mesh.
+    # Returns None when there is nothing to do.
+    if not mesh_min_feature_size or scale >= 1.0 or not qc_document.mesh_indices:
+        return None
+    cell_size = mesh_min_feature_size / scale
+    qc_folder = os.path.dirname(qc_document.path)
+    replacements = {}
+    mesh_triangles = {}
+    triangles_before = 0
+    triangles_after = 0
+    for index, smd_name in qc_document.mesh_indices.items():
+        smd_path = os.path.join(qc_folder, smd_name)
+        if not os.path.isfile(smd_path):
+            continue
+        header, triangles, trailer = read_smd(smd_path)
+        qc_document.smd_triangles[smd_name] = len(triangles)
+        decimated = decimate_triangles(triangles, cell_size)
+        triangles_before += len(triangles)
+        mesh_name = os.path.splitext(os.path.basename(smd_name))[0].lower()
+        # Not worth another file, or the mesh would fall apart
+        if len(decimated) > len(triangles) * 0.95 or len(decimated) < 4:
+            mesh_triangles[mesh_name] = len(triangles)
+            triangles_after += len(triangles)
+            continue
+        new_smd_name = f"{os.path.splitext(smd_name)[0]}_opt_{variant_suffix}.smd"
+        write_smd(os.path.join(qc_folder, new_smd_name), header, decimated, trailer)
+        replacements[index] = (smd_name, new_smd_name)
+        mesh_triangles[mesh_name] = len(decimated)
+        triangles_after += len(decimated)
+
+    dropped_ranges = []
+    for start, end, lod_replacements in qc_document.lod_blocks:
+        redundant = bool(lod_replacements)
+        for mesh_name, lod_name in lod_replacements:
+            mesh_name = os.path.splitext(os.path.basename(mesh_name))[0].lower()
+            lod_path = os.path.join(qc_folder, lod_name if lod_name.lower().endswith(".smd") else lod_name + ".smd")
+            if mesh_name not in mesh_triangles or not os.path.isfile(lod_path) or len(read_smd(lod_path)[1]) < mesh_triangles[mesh_name]:
+                redundant = False
+                break
+        if redundant:
+            dropped_ranges.append((start, end))
+    if not replacements and not dropped_ranges:
+        return None
+    return MeshOptimization(replacements, dropped_ranges, triangles_before, triangles_after)
+
+def report_mesh_optimization(hammer_mdl_path, new_model_name, mesh_optimization):
+    before, after = mesh_optimization.triangles_before, mesh_optimization.triangles_after
+    reduction = (before - after) * 100 / before if before else 0
+    print_and_log(f"{os.path.basename(new_model_name)}: {before} -> {after} triangles (-{reduction:.0f}%), {len(mesh_optimization.dropped_ranges)} LODs dropped.")
+    mesh_report.append((hammer_mdl_path, new_model_name, before, after, len(mesh_optimization.dropped_ranges)))
+
+def print_mesh_report():
+    if not mesh_report:
+        return
+    before = sum(entry[2] for entry in mesh_report)
+    after = sum(entry[3] for entry in mesh_report)
+    dropped = sum(entry[4] for entry in mesh_report)
+    print_and_log(f"Mesh optimization: {len(mesh_report)} variants, {before} -> {after} triangles (-{(before - after) * 100 / before if before else 0:.0f}%), {dropped} LODs dropped.")
+    mesh_report.clear()
+
+# -collision_hulls: the convex hulls of the collision model are computed once per source model and reused by every variant
+collision_hulls = False
+# -max_hulls/-max_hull_vertices: hull budget of the variants scaled below 1, 0 = no limit
+max_collision_hulls = 0
+max_hull_vertices = 0
+# Folder of the computed hull SMDs, named by the hash of the collision SMD, the budget and the version of the hull building
+hull_cache_dir = None
+collision_hull_version = "concave only"
+
+def get_convex_hull(points):
+    # Incremental 3D convex hull. Returns the outward facing triangles as index triples into points,
+    # None when the points are flat or too few.
+    if len(points) < 4:
+        return None
+    extent = max(max(point[axis] for point in points) - min(point[axis] for point in points) for axis in range(3))
+    epsilon = max(extent, 1.0) * 1e-6
 
-    staticprop_found = any("$staticprop" in line for line in lines)
-    keyvalues_found = any("$keyvalues" in line for line in lines)
-    prop_data_found = any("prop_data" in line for line in lines)
-    scale_found = any("$scale" in line for line in lines)
+    def subtract(a, b):
+        return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+    def cross(a, b):
+        return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+    def dot(a, b):
+        return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+    def get_plane(face):
+        a, b, c = (points[index] for index in face)
+        normal = cross(subtract(b, a), subtract(c, a))
+        length = math.sqrt(dot(normal, normal)) or 1.0
+        normal = (normal[0] / length, normal[1] / length, normal[2] / length)
+        return normal, dot(normal, a)
+
+    # Starting tetrahedron from the most distant points
+    first = 0
+    second = max(range(len(points)), key=lambda index: dot(subtract(points[index], points[first]), subtract(points[index], points[first])))
+    line = subtract(points[second], points[first])
+
+    def line_distance(index):
+        offset = cross(line, subtract(points[index], points[first]))
+        return dot(offset, offset)
+
+    third = max(range(len(points)), key=line_distance)
+    if line_distance(third) <= epsilon * epsilon * dot(line, line):
+        return None
+    normal, offset = get_plane((first, second, third))
+    fourth = max(range(len(points)), key=lambda index: abs(dot(normal, points[index]) - offset))
+    if abs(dot(normal, points[fourth]) - offset) <= epsilon:
+        return None
+    if dot(normal, points[fourth]) - offset > 0:
+        second, third = third, second
+    faces = [(first, second, third), (first, fourth, second), (second, fourth, third), (third, fourth, first)]
+    planes = {face: get_plane(face) for face in faces}
+
+    for index, point in enumerate(points):
+        if index in (first, second, third, fourth):
+            continue
+        visible = [face for face in faces if dot(planes[face][0], point) - planes[face][1] > epsilon]
+        if not visible:
+            continue
+        visible_edges = {(face[edge], face[(edge + 1) % 3]) for face in visible for edge in range(3)}
+        horizon = [(a, b) for a, b in visible_edges if (b, a) not in visible_edges]
+        visible = set(visible)
+        faces = [face for face in faces if face not in visible]
+        for a, b in horizon:
+            face = (a, b, index)
+            planes[face] = get_plane(face)
+            faces.append(face)
+    return faces
+
+def get_hull_points(points, max_vertices=0):
+    # Vertices of the convex hull of points, at most max_vertices of them (the most extreme ones in evenly spread directions)
+    unique_points = list(dict.fromkeys((round(x, 4), round(y, 4), round(z, 4)) for x, y, z in points))
+    faces = get_convex_hull(unique_points)
+    if faces is None:
+        return unique_points
+    hull_points = [unique_points[index] for index in sorted({index for face in faces for index in face})]
+    if not max_vertices or len(hull_points) <= max_vertices:
+        return hull_points
+    kept = []
+    directions = max_vertices * 2
+    for step in range(directions):
+        # Fibonacci sphere
+        z = 1 - 2 * (step + 0.5) / directions
+        radius = math.sqrt(1 - z * z)
+        angle = step * math.pi * (3 - math.sqrt(5))
+        direction = (radius * math.cos(angle), radius * math.sin(angle), z)
+        extreme = max(hull_points, key=lambda point: point[0] * direction[0] + point[1] * direction[1] + point[2] * direction[2])
+        if extreme not in kept:
+            kept.append(extreme)
+            if len(kept) == max_vertices:
+                break
+    return kept if get_convex_hull(kept) is not None else hull_points
+
+def read_collision_pieces(triangles):
+    # Splits the collision mesh into its solids: [(bone, material, points, triangles)]. Triangles are joined only
+    # across edges that exactly two triangles use, so solids touching at a corner, or face to face
+    # (their common edges have four triangles), stay apart.
+    parents = list(range(len(triangles)))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    vertex_keys = []
+    edge_triangles = {}
+    for index, (material, vertices) in enumerate(triangles):
+        keys = [(vertex[0], round(float(vertex[1]), 3), round(float(vertex[2]), 3), round(float(vertex[3]), 3)) for vertex in vertices]
+        vertex_keys.append(keys)
+        for edge in range(3):
+            edge_key = frozenset((keys[edge], keys[(edge + 1) % 3]))
+            if len(edge_key) == 2:
+                edge_triangles.setdefault(edge_key, []).append(index)
+    for indices in edge_triangles.values():
+        if len(indices) == 2:
+            parents[find(indices[1])] = find(indices[0])
+
+    pieces = {}
+    for index, ((material, vertices), keys) in enumerate(zip(triangles, vertex_keys)):
+        piece = pieces.setdefault(find(index), (keys[0][0], material, [], []))
+        piece[2].extend(key[1:] for key in keys)
+        piece[3].append((material, vertices))
+    return list(pieces.values())
+
+def get_mesh_volume(faces):
+    # Enclosed volume of a closed mesh given as point triples (divergence theorem)
+    volume = 0.0
+    for a, b, c in faces:
+        volume += (a[0] * (b[1] * c[2] - b[2] * c[1]) - a[1] * (b[0] * c[2] - b[2] * c[0]) + a[2] * (b[0] * c[1] - b[1] * c[0])) / 6
+    return abs(volume)
+
+def build_collision_hulls(triangles, max_hulls=0, max_vertices=0):
+    # Convex hull of every piece, the smallest pieces merged into their nearest neighbour (same bone) until max_hulls are left.
+    # A concave piece (its hull clearly bigger than the piece) is kept as it is, its hull would change the collision shape.
+    # Returns the SMD triangles of the hulls and the kept pieces, and their count.
+    hulls = []
+    kept_triangles = []
+    kept_count = 0
+    for bone, material, points, piece_triangles in read_collision_pieces(triangles):
+        hull_points = get_hull_points(points)
+        hull_faces = get_convex_hull(hull_points)
+        piece_volume = get_mesh_volume([[tuple(float(value) for value in vertex[1:4]) for vertex in vertices] for _, vertices in piece_triangles])
+        if hull_faces is not None and get_mesh_volume([[hull_points[index] for index in face] for face in hull_faces]) > piece_volume * 1.1 + 1e-3:
+            kept_triangles.extend(piece_triangles)
+            kept_count += 1
+            continue
+        hulls.append((bone, material, hull_points))
+
+    def get_size(points):
+        return math.prod(max(point[axis] for point in points) - min(point[axis] for point in points) + 1e-3 for axis in range(3))
+
+    def get_center(points):
+        return tuple(sum(point[axis] for point in points) / len(points) for axis in range(3))
+
+    while max_hulls and len(hulls) > max_hulls:
+        smallest = min(range(len(hulls)), key=lambda index: get_size(hulls[index][2]))
+        bone, material, points = hulls[smallest]
+        center = get_center(points)
+        neighbours = [index for index in range(len(hulls)) if index != smallest and hulls[index][0] == bone]
+        if not neighbours:
+            break
+        nearest = min(neighbours, key=lambda index: math.dist(center, get_center(hulls[index][2])))
+        hulls[nearest] = (bone, hulls[nearest][1], get_hull_points(hulls[nearest][2] + points))
+        del hulls[smallest]
+
+    result = []
+    for bone, material, points in hulls:
+        points = get_hull_points(points, max_vertices)
+        faces = get_convex_hull(points)
+        if faces is None:
+            continue
+        for face in faces:
+            a, b, c = (points[index] for index in face)
+            normal = ((b[1] - a[1]) * (c[2] - a[2]) - (b[2] - a[2]) * (c[1] - a[1]),
+                      (b[2] - a[2]) * (c[0] - a[0]) - (b[0] - a[0]) * (c[2] - a[2]),
+                      (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0]))
+            length = math.sqrt(sum(value * value for value in normal)) or 1.0
+            normal_fields = [f"{value / length:.6f}" for value in normal]
+            result.append((material, [[bone, f"{x:.6f}", f"{y:.6f}", f"{z:.6f}", *normal_fields, "0", "0"] for x, y, z in (a, b, c)]))
+    return result + kept_triangles, len(hulls) + kept_count
+
+def get_collision_hulls(qc_document, scale):
+    # Writes the hulled collision SMD of a variant next to the QC and returns the (old, new) SMD names for the QC.
+    # The hulls are in model space and $scale applies to them like to the original mesh (a uniform scale keeps them convex),
+    # so they are computed once per source model and budget and copied for every scale.
+    # Without $concave studiomdl builds a single hull of the whole collision mesh anyway, there is nothing to split.
+    if not collision_hulls or qc_document.collision_smd is None or not qc_document.collision_concave:
+        return None
+    qc_folder = os.path.dirname(qc_document.path)
+    smd_path = os.path.join(qc_folder, qc_document.collision_smd)
+    if not os.path.isfile(smd_path):
+        return None
+    budget = (max_collision_hulls, max_hull_vertices) if scale < 1.0 else (0, 0)
+    hasher = hashlib.sha1()
+    with open(smd_path, 'rb') as smd_file:
+        hasher.update(smd_file.read())
+    hasher.update(json.dumps(budget).encode())
+    hasher.update(collision_hull_version.encode())
+    key = hasher.hexdigest()
+    new_smd_name = f"{os.path.splitext(qc_document.collision_smd)[0]}_hulls_{key[:8]}.smd"
+    new_smd_path = os.path.join(qc_folder, new_smd_name)
+    cached_path = os.path.join(hull_cache_dir, f"{key}.smd") if hull_cache_dir else None
+
+    if cached_path and os.path.isfile(cached_path):
+        log_debug(Fore.YELLOW + "Collision hulls from the cache: %s", cached_path)
+        shutil.copyfile(cached_path, new_smd_path)
+        return qc_document.collision_smd, new_smd_name
+
+    header, triangles, trailer = read_smd(smd_path)
+    hull_triangles, hull_count = build_collision_hulls(triangles, *budget)
+    if not hull_triangles:
+        return None
+    write_smd(new_smd_path, header, hull_triangles, trailer)
+    print_and_log(f"{os.path.basename(qc_document.collision_smd)}: {len(triangles)} -> {len(hull_triangles)} collision triangles in {hull_count} hulls.")
+    if cached_path:
+        os.makedirs(hull_cache_dir, exist_ok=True)
+        temp_path = f"{cached_path}.{os.getpid()}.tmp"
+        shutil.copyfile(new_smd_path, temp_path)
+        os.replace(temp_path, cached_path)
+    return qc_document.collision_smd, new_smd_name
+
+def get_variant_qc_path(qc_path, scale):
+    dir_name, file_name = os.path.split(qc_path)
+    base_name, ext = os.path.splitext(file_name)
+    return os.path.join(dir_name, f"{base_name}_scaled_{int(scale*100)}{ext}")
+
+def rescale_qc_file(qc_document, new_qc_path, scale, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, convert_to_static=False, subfolders=True, skin_families=None):
+    staticprop_found = qc_document.staticprop_found
+    prop_data_found = qc_document.prop_data_found
     
-    if debug_mode: print_and_log(Fore.YELLOW + f"qc_path: {qc_path}")
-    if debug_mode: print_and_log(Fore.YELLOW + f"staticprop_found: {staticprop_found}")
-    if debug_mode: print_and_log(Fore.YELLOW + f"keyvalues_found: {keyvalues_found}")
-    if debug_mode: print_and_log(Fore.YELLOW + f"prop_data_found: {prop_data_found}")
-    if debug_mode: print_and_log(Fore.YELLOW + f"scale_found: {scale_found}")
+    log_debug(Fore.YELLOW + "qc_path: %s", qc_document.path)
+    log_debug(Fore.YELLOW + "staticprop_found: %s", staticprop_found)
+    log_debug(Fore.YELLOW + "keyvalues_found: %s", qc_document.keyvalues_found)
+    log_debug(Fore.YELLOW + "prop_data_found: %s", prop_data_found)
+    log_debug(Fore.YELLOW + "scale_found: %s", qc_document.scale_found)
 
     #if not staticprop_found:
     #    cls_fixed = fix_phys_collision_smd(qc_path)
@@ -638,89 +2707,60 @@ def rescale_qc_file(qc_path, scale, hammer_mdl_path, psr_cache_data_todo, psr_ca
     if prop_data_found and not staticprop_found:
         scale_multi = scale ** 2
 
-    modelname_line = ""
-    modelname_index = -1
-    scale_line_index = -1
-    staticprop_line_index = -1
-
-    for index, line in enumerate(lines):
-        if line.strip().startswith("$modelname"):
-            modelname_line = line.strip()
-            modelname_index = index
-        if line.strip().startswith("$scale"):
-            scale_line_index = index
-        if line.strip().startswith("$staticprop"):
-            staticprop_line_index = index
-
-    if modelname_line:
-        parts = modelname_line.split('"')
-        model_path = parts[1]
-        model_name = os.path.basename(model_path).replace(".mdl", "")
-        
-        if debug_mode: print_and_log(Fore.YELLOW + f"!!! model_name: {model_name}")
-        if debug_mode: print_and_log(Fore.YELLOW + f"!!! float(scale): {float(scale)}")
+    if qc_document.modelname is None:
+        print_and_log(Fore.RED + f"$modelname not found in {get_file_name(qc_document.path)} QC!")
+        return None
 
-        if subfolders == True and float(scale) != 1.0:
-            if debug_mode: print_and_log(Fore.YELLOW + f"!!! subfolders == True and float(scale) != 1.0")
-            new_model_name = f"scaled/{model_name}_scaled_{int(scale * 100)}.mdl"
-        else:
-            if float(scale) == 1.0 and staticprop_found == False:
-                if debug_mode: print_and_log(Fore.YELLOW + f"!!! float(scale) != 1.0 and staticprop_found == False")
-                new_model_name = f"{model_name}_static.mdl"
-            elif float(scale) == 1.0:
-                if debug_mode: print_and_log(Fore.YELLOW + f"!!! float(scale) != 1.0")
-                new_model_name = f"_do_not_compile_me!"
-                print_and_log(Fore.GREEN + f"{model_name}.mdl is already a static prop. Updating cache.")
-                #real_mdl_path = psr_cache_data_ready.get(hammer_mdl_path, {}).get("real_mdl_path")
-                psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", is_static=True)
-                save_global_cache(psr_cache_data_ready)
-                #print_and_log(f"psr_cache_data_ready: {psr_cache_data_ready}")
-                return f"static_prop"
-            else:
-                if debug_mode: print_and_log(Fore.YELLOW + f"!!! blyat")
-                new_model_name = f"{model_name}_scaled_{int(scale * 100)}.mdl"
-        if debug_mode: print_and_log(f"new_model_name: {new_model_name}")
-        new_model_path = model_path.replace(f"{model_name}.mdl", new_model_name)
-        if debug_mode: print_and_log(f"new_model_path: {new_model_path}")
-        new_modelname_line = f'$modelname "{new_model_path}"\n'
-
-        lines[modelname_index] = new_modelname_line
-        
-        if scale_line_index != -1:
-            lines[scale_line_index] = f"$scale {scale_multi}\n"
+    model_path = qc_document.modelname
+    model_name = os.path.basename(model_path).replace(".mdl", "")
+    
+    log_debug(Fore.YELLOW + "!!! model_name: %s", model_name)
+    log_debug(Fore.YELLOW + "!!! float(scale): %s", float(scale))
+
+    if subfolders == True and float(scale) != 1.0:
+        log_debug(Fore.YELLOW + "!!! subfolders == True and float(scale) != 1.0")
+        new_model_name = f"scaled/{model_name}_scaled_{int(scale * 100)}.mdl"
+    else:
+        if float(scale) == 1.0 and staticprop_found == False:
+            log_debug(Fore.YELLOW + "!!! float(scale) != 1.0 and staticprop_found == False")
+            new_model_name = f"{model_name}_static.mdl"
+        elif float(scale) == 1.0 and skin_families:
+            # Already a static prop, but the colors need the tinted skin families, so a _static copy is compiled
+            new_model_name = f"{model_name}_static.mdl"
+            psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", is_static=True)
+        elif float(scale) == 1.0:
+            log_debug(Fore.YELLOW + "!!! float(scale) != 1.0")
+            new_model_name = f"_do_not_compile_me!"
+            print_and_log(Fore.GREEN + f"{model_name}.mdl is already a static prop. Updating cache.")
+            #real_mdl_path = psr_cache_data_ready.get(hammer_mdl_path, {}).get("real_mdl_path")
+            psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", is_static=True)
+            save_global_cache(psr_cache_data_ready)
+            #print_and_log(f"psr_cache_data_ready: {psr_cache_data_ready}")
+            return f"static_prop"
         else:
-            lines.insert(modelname_index + 1, '\n')
-            lines.insert(modelname_index + 2, f"$scale {scale_multi}\n")
-            scale_line_index = modelname_index + 2
+            log_debug(Fore.YELLOW + "!!! blyat")
+            new_model_name = f"{model_name}_scaled_{int(scale * 100)}.mdl"
+    log_debug("new_model_name: %s", new_model_name)
+    new_model_path = model_path.replace(f"{model_name}.mdl", new_model_name)
+    log_debug("new_model_path: %s", new_model_path)
 
-        if staticprop_line_index == -1:
-            lines.insert(scale_line_index + 1, "$staticprop\n")
+    mesh_optimization = optimize_variant_meshes(qc_document, scale_multi, int(scale * 100))
+    if mesh_optimization is not None:
+        report_mesh_optimization(hammer_mdl_path, new_model_name, mesh_optimization)
 
-        for index, line in enumerate(lines):
-            if line.strip().startswith(("$lod")):
-                lines[index] = scale_values(line, scale_multi)
-            if line.strip().startswith(("$bbox", "$cbox", "$illumposition")):
-                lines[index] = comment_line(line)
-            if line.strip().startswith(("$definebone", "$hboxset")):
-                lines[index] = comment_line(line)
-
-        with open(qc_path, 'w') as file:
-            file.writelines(lines)
-    else:
-        print_and_log(Fore.RED + f"$modelname not found in {model_name} QC!")
+    collision_replacement = get_collision_hulls(qc_document, scale_multi)
+    if collision_replacement is not None:
+        if mesh_optimization is None:
+            mesh_optimization = MeshOptimization({}, [], 0, 0)
+        mesh_optimization.replacements[qc_document.collision_index] = collision_replacement
 
-    return new_qc_path
+    with open(new_qc_path, 'w') as file:
+        file.writelines(qc_document.emit(new_model_path, scale_multi, skin_families, mesh_optimization))
 
-def copy_and_rescale_qc(qc_path, scale, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready):
-    dir_name, file_name = os.path.split(qc_path)
-    base_name, ext = os.path.splitext(file_name)
-    new_file_name = f"{base_name}_scaled_{int(scale*100)}{ext}"
-    new_qc_path = os.path.join(dir_name, new_file_name)
-    shutil.copy(qc_path, new_qc_path)
-    new_qc_path = rescale_qc_file(new_qc_path, scale, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, convert_to_static, subfolders)
     return new_qc_path
 
 def rescale_and_compile_models(qc_path, compiler_path, game_folder, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready):    
+    # Returns the failed scales {scale: reason}, the LOD count and the triangle count of the decompiled model
     #print_and_log(f" ")
     #print_and_log(f"RESCALE AND COMPILE:")
     #print_and_log(f"scales: {scales}")
@@ -729,42 +2769,138 @@ def rescale_and_compile_models(qc_path, compiler_path, game_folder, scales, conv
     scales = list(set(map(float, scales.split())))
     scales.sort()
 
-    # temp
-    # где-то вот тут надо добывать из raw или todo все rendercolor и все skin
-    # создавать материалы
-    # после этого надо добавлять всё сначала в оригинальный qc и только потом копировать набор qc для поскейленных
-    rendercolor = "255 255 255"
-    skin = "0"
-
+    qc_document = QcDocument.parse(qc_path)
+
+    # Every scale is compiled with all colors known for the model: the ones from the cache keep their skin index,
+    # new ones from this VMF are appended after them
+    colors = get_model_colors(hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready)
+    tinted_colors = get_tinted_colors({"colors": colors})
+
+    skin_families = None
+    families_count = 1
+    if tinted_colors:
+        cdmaterials, families = read_qc_skin_data(qc_document)
+        families_count = len(families)
+        # studiomdl supports 32 skin families
+        max_tinted_colors = 32 - families_count
+        if len(tinted_colors) > max_tinted_colors:
+            print_and_log(Fore.RED + f"ERROR! {get_file_name(hammer_mdl_path)}.mdl has too many colors, only the first {max(max_tinted_colors, 0)} will be compiled!", level=LOG_ERROR)
+            tinted_colors = tinted_colors[:max(max_tinted_colors, 0)]
+            colors = [color_pair for color_pair in colors if color_pair[0][0] == white_rendercolor or color_pair in tinted_colors]
+        if not families[0]:
+            print_and_log(Fore.YELLOW + f"Warning! No materials found in the {get_file_name(qc_path)}.qc meshes, colors will not be compiled.")
+            tinted_colors = []
+            colors = [color_pair for color_pair in colors if color_pair[0][0] == white_rendercolor]
+        for rendercolor, skin in tinted_colors:
+            skin_index = int(skin[0]) if skin[0].isdigit() else 0
+            write_tinted_materials(game_folder, cdmaterials, families[skin_index] if skin_index < families_count else families[0], rendercolor[0])
+        if tinted_colors:
+            skin_families = build_skin_families(families, tinted_colors)
+
+    failed_scales = {}
     for scale in scales:
-        new_qc_path = copy_and_rescale_qc(qc_path, scale, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready)
+        new_qc_path = rescale_qc_file(qc_document, get_variant_qc_path(qc_path, scale), scale, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, convert_to_static, subfolders, skin_families)
         if new_qc_path == None:
             print_and_log(Fore.YELLOW + f"Skip QC compiling (new_qc_path is none for some reason):\n{qc_path}")
         elif new_qc_path == "static_prop":
             print_and_log(f'Skip QC compiling, "{hammer_mdl_path}" is static prop and has scale 1.')
             pass
+        elif not is_variant_wanted(hammer_mdl_path, scale, get_new_colors(hammer_mdl_path, colors, psr_cache_data_ready)):
+            print_and_log(Fore.YELLOW + f"Skip QC compiling, scale {scale} of {get_file_name(hammer_mdl_path)}.mdl (or one of its new colors) is not used anymore.")
         else:
-            compile_model(compiler_path, game_folder, new_qc_path, hammer_mdl_path, scale, rendercolor, skin, psr_cache_data_todo, psr_cache_data_ready)
-            
+            failure = compile_model(compiler_path, game_folder, new_qc_path, hammer_mdl_path, scale, colors, len(tinted_colors), families_count, psr_cache_data_todo, psr_cache_data_ready)
+            # A cancelled variant did not fail, it may be wanted again later
+            if failure is not None and failure != "cancelled":
+                failed_scales[scale] = failure
+
+    return failed_scales, len(qc_document.lod_indices), qc_document.get_triangle_count()
+
+
+def get_smd_triangle_count(smd_path):
+    # Triangles of an SMD without splitting its vertex lines, 0 when it is missing
+    triangle_lines = 0
+    in_triangles = False
+    if not os.path.isfile(smd_path):
+        return 0
+    with open(smd_path, 'r', encoding='utf-8', errors='replace') as smd_file:
+        for line in smd_file:
+            stripped = line.strip()
+            if in_triangles:
+                if stripped == "end":
+                    break
+                if stripped:
+                    triangle_lines += 1
+            elif stripped.lower() == "triangles":
+                in_triangles = True
+    # A material line and three vertex lines per triangle
+    return triangle_lines // 4
+
+def get_vvd_vertex_count(mdl_path):
+    # vertexFileHeader_t: id, version, checksum, numLODs, numLODVertexes[8]; LOD 0 has all vertices
+    try:
+        with open(os.path.splitext(mdl_path)[0] + ".vvd", 'rb') as vvd_file:
+            header = vvd_file.read(20)
+    except OSError:
+        return None
+    if len(header) < 20 or header[:4] != b"IDSV":
+        return None
+    return int.from_bytes(header[16:20], 'little')
+
+def get_compile_rates(psr_cache_data_ready):
+    # Seconds of studiomdl per triangle and triangles per source vertex, learned from the compiled models
+    timed = [model_data for model_data in psr_cache_data_ready.values() if get_variant_compile_time(model_data) and model_data.get("triangles")]
+    seconds_per_triangle = sum(get_variant_compile_time(model_data) for model_data in timed) / sum(model_data["triangles"] for model_data in timed) if timed else None
+    counted = [model_data for model_data in psr_cache_data_ready.values() if model_data.get("triangles") and model_data.get("vertices")]
+    # Split vertices along UV and normal seams, about 1.2 triangles each when nothing was recorded yet
+    triangles_per_vertex = sum(model_data["triangles"] for model_data in counted) / sum(model_data["vertices"] for model_data in counted) if counted else 1.2
+    return seconds_per_triangle, triangles_per_vertex
+
+def estimate_compile_cost(game_dir, hammer_mdl_path, scales_count, psr_cache_data_ready, compile_rates, average_compile_time):
+    # Seconds to compile the scales of a model: the average time of its compiled variants, or its triangle count
+    # (from the QC of an earlier decompile, or estimated from the source .vvd) times the learned rate
+    model_data = psr_cache_data_ready.get(hammer_mdl_path.lower(), {})
+    seconds_per_triangle, triangles_per_vertex = compile_rates
+    variant_compile_time = get_variant_compile_time(model_data)
+    if variant_compile_time:
+        return variant_compile_time * scales_count
+    triangles = model_data.get("triangles")
+    if not triangles:
+        vertices = get_vvd_vertex_count(model_data.get("real_mdl_path") or os.path.join(game_dir, hammer_mdl_path))
+        triangles = vertices * triangles_per_vertex if vertices else None
+    if triangles and seconds_per_triangle:
+        return triangles * seconds_per_triangle * scales_count
+    return average_compile_time * scales_count
+
+def plan_compile_order(game_dir, psr_cache_data_todo, psr_cache_data_ready):
+    # Longest jobs first, so parallel workers are not left waiting for one huge model at the end
+    # while the cheap ones fill the gaps. Local compiles run one model at a time, there the order changes
+    # nothing, it pays off for the queue workers only. Returns the ordered models and the total estimated seconds.
+    compile_rates = get_compile_rates(psr_cache_data_ready)
+    average_compile_time, _ = get_variant_cost_estimate(psr_cache_data_ready)
+    costs = {}
+    for hammer_mdl_path, model_data in psr_cache_data_todo.items():
+        costs[hammer_mdl_path] = estimate_compile_cost(game_dir, hammer_mdl_path, len(model_data.get("scales", [])), psr_cache_data_ready, compile_rates, average_compile_time)
+    return sorted(costs, key=lambda hammer_mdl_path: -costs[hammer_mdl_path]), sum(costs.values())
 
 def get_valid_path(prompt_message, valid_extension):
     while True:
-        path = input(prompt_message).strip().strip('"')
+        path = prompt_user(prompt_message).strip().strip('"')
         if os.path.isfile(path) and path.lower().endswith(valid_extension):
             return path
         else:
             print_and_log(Fore.RED + f"File not found, path is incorrect, or file does not have {valid_extension} extension. Try again.")
 
-def decompile_dialog(mdl_path, ccld_path, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready):    
+def decompile_dialog(mdl_path, ccld_path, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, job_dir=None):    
     model_name = os.path.splitext(os.path.basename(mdl_path))[0]
-    decomp_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mdl_scaler_decomp")
+    if job_dir is None:
+        job_dir = scratch.create_job(model_name)
     #decomp_folder = r"C:\Code\PYTHON\PROP_STATIC_SCALABLE\props_scaling_recompiler_temp\decomp_folder_debug"
-    decomp_folder = os.path.join(decomp_folder, model_name)
-    if debug_mode: print_and_log(f"decomp_folder: {decomp_folder}")
+    decomp_folder = os.path.join(job_dir, "decomp")
+    log_debug("decomp_folder: %s", decomp_folder)
     
     if os.path.exists(mdl_path):
-        if debug_mode: print_and_log(f"mdl_path exist: {mdl_path}")
-        if debug_mode: print_and_log(f"running decompilation...")
+        log_debug("mdl_path exist: %s", mdl_path)
+        log_debug("running decompilation...")
     else:
         print_and_log(Fore.RED + f"ERROR! mdl_path does not exist: {mdl_path}")
         #print_and_log(f"823 test! psr_cache_data_ready: {psr_cache_data_ready}")
@@ -773,13 +2909,15 @@ def decompile_dialog(mdl_path, ccld_path, hammer_mdl_path, psr_cache_data_todo,
         #print_and_log(f"825 test! psr_cache_data_ready: {psr_cache_data_ready}")
         return None
     
-    run_ccld(mdl_path, ccld_path, decomp_folder)
+    run_ccld(mdl_path, ccld_path, decomp_folder, cancel=lambda: not is_variant_wanted(hammer_mdl_path))
+    if not is_variant_wanted(hammer_mdl_path):
+        return None
     
     qc_path = decomp_folder + "/" + model_name + ".qc"
-    if debug_mode: print_and_log(f"qc_path: {qc_path}")
+    log_debug("qc_path: %s", qc_path)
     if os.path.isfile(qc_path) and qc_path.lower().endswith(".qc"):
-        if debug_mode: print_and_log(f"qc_path is correct!")
-        if debug_mode: print_and_log(f"\n")
+        log_debug("qc_path is correct!")
+        log_debug("\n")
         return qc_path
     else:
         print_and_log(Fore.RED + f"ERROR! qc_path is not correct: {qc_path}")
@@ -814,26 +2952,717 @@ def find_file_in_subfolders(directory, filename_with_extension):
                 result.append(os.path.join(root, file))
     return result
 
-def decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, mdl_path, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready):
-    if debug_mode: print_and_log(f"ccld_path: {ccld_path}")
-    if debug_mode: print_and_log(f"gameinfo_path: {gameinfo_path}")
-    if debug_mode: print_and_log(f"compiler_path: {compiler_path}")
-    if debug_mode: print_and_log(f"mdl_path: {mdl_path}")
-    if debug_mode: print_and_log(f"scales: {scales}")
-    qc_path = decompile_dialog(mdl_path, ccld_path, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready)
-    if qc_path is None: return
-    if debug_mode: print_and_log(f"qc_path: {qc_path}")
-    game_folder = gameinfo_path.rsplit('\\', 1)[0]
-    if debug_mode: print_and_log(f"game_folder: {game_folder}")
-    rescale_and_compile_models(qc_path, compiler_path, game_folder, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready)
-
-def get_vpkeditcli_tree(vpkeditcli_path, vpk_file):
-    result = subprocess.run(
-        [vpkeditcli_path, '--file-tree', vpk_file],
-        check=True,
-        text=True,
-        capture_output=True
-    )
+def find_identical_variant(source_hash, hammer_mdl_path, modelscale, colors, psr_cache_data_ready):
+    # Another model with the same source content that already has this scale compiled with all the colors,
+    # and whose colors list starts like ours so the skin indices are the same
+    model = hammer_mdl_path.lower()
+    own_colors = psr_cache_data_ready.get(model, {}).get("colors", [])
+    for other_model, other_data in psr_cache_data_ready.items():
+        if other_model == model or other_data.get("source_hash") != source_hash:
+            continue
+        if modelscale not in other_data.get("scales", []):
+            continue
+        if other_data.get("colors", [])[:len(own_colors)] != own_colors:
+            continue
+        if all(is_color_compiled(other_data, modelscale, color_pair) for color_pair in colors):
+            return other_model
+    return None
+
+def set_mdl_name(mdl_data, name):
+    # studiohdr_t: id, version, checksum, then name[64]
+    name = name.encode('utf-8')
+    if mdl_data[:4] != b"IDST" or len(name) > 63:
+        return mdl_data
+    return mdl_data[:12] + name.ljust(64, b"\0") + mdl_data[76:]
+
+def link_or_copy(source_path, target_path):
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copy2(source_path, target_path)
+
+def install_model_files(source_files, game_folder, target_hammer_model):
+    # source_files: {extension: path} of one compiled model
+    target_base = os.path.splitext(os.path.join(game_folder, target_hammer_model))[0]
+    os.makedirs(os.path.dirname(target_base), exist_ok=True)
+    for ext, source_path in source_files.items():
+        if ext == ".mdl":
+            # The .mdl is copied with its own name, the other files only carry the checksum and are hardlinked
+            with open(source_path, 'rb') as source_file:
+                mdl_data = source_file.read()
+            mdl_name = target_hammer_model[len("models/"):] if target_hammer_model.lower().startswith("models/") else target_hammer_model
+            with open_atomic(target_base + ext, 'wb') as target_file:
+                target_file.write(set_mdl_name(mdl_data, mdl_name))
+        else:
+            link_or_copy(source_path, target_base + ext)
+
+def materialize_variant(game_folder, source_model, target_model, modelscale, subfolders):
+    source_base = os.path.splitext(os.path.join(game_folder, get_scaled_hammer_model(source_model, modelscale, subfolders)))[0]
+    if not os.path.isfile(source_base + ".mdl"):
+        packed_base = os.path.splitext(get_scaled_hammer_model(source_model, modelscale, subfolders))[0]
+        if variant_pack.find(packed_base + ".mdl") is None:
+            return False
+        source_base = os.path.join(scratch.get_run_dir(), "packed", packed_base)
+        for ext in compiled_model_extensions:
+            if variant_pack.find(packed_base + ext) is not None:
+                variant_pack.extract(packed_base + ext, source_base + ext)
+    source_files = {ext: source_base + ext for ext in compiled_model_extensions if os.path.isfile(source_base + ext)}
+    install_model_files(source_files, game_folder, get_scaled_hammer_model(target_model, modelscale, subfolders))
+    return True
+
+def share_identical_variants(source_hash, game_folder, subfolders, hammer_mdl_path, scales, psr_cache_data_todo, psr_cache_data_ready):
+    # Scales already compiled for a model with identical source content are materialized instead of compiled.
+    # Returns the scales that still have to be compiled.
+    model = hammer_mdl_path.lower()
+    colors = psr_cache_data_todo.get(model, {}).get("colors", [])
+    scales_left = []
+    shared_from = set()
+    for modelscale in scales.split():
+        other_model = find_identical_variant(source_hash, model, modelscale, colors, psr_cache_data_ready)
+        if other_model is None:
+            scales_left.append(modelscale)
+            continue
+        other_data = psr_cache_data_ready[other_model]
+        tinted_count = other_data.get("palette_sizes", {}).get(modelscale, 0)
+        # An already static model at scale 1 has no compiled variant, the original is used
+        nothing_compiled = float(modelscale) == 1.0 and other_data.get("is_static") and not tinted_count
+        if not nothing_compiled and not materialize_variant(game_folder, other_model, model, modelscale, subfolders):
+            scales_left.append(modelscale)
+            continue
+        for rendercolor, skin in other_data["colors"]:
+            psr_cache_data_ready = add_to_cache(psr_cache_data_ready, model, modelscale, rendercolor[0], skin[0], is_static=other_data.get("is_static"))
+        set_compiled_palette(psr_cache_data_ready, model, modelscale, tinted_count, other_data.get("skin_families", 1))
+        psr_cache_data_ready[model]["source_hash"] = source_hash
+        shared_from.add(other_model)
+    if shared_from:
+        print_and_log(Fore.GREEN + f"{get_file_name(model)}.mdl is identical to {', '.join(sorted(shared_from))}, {len(scales.split()) - len(scales_left)} scales shared without compiling.")
+        save_global_cache(psr_cache_data_ready)
+    return " ".join(scales_left)
+
+def get_variant_key(source_hash, modelscale, convert_to_static, tool_version, tinted_colors=()):
+    # Same source content, scale (variant precision), colors and studiomdl give the same compiled files
+    key = f"{source_hash}|{round(float(modelscale) * 100)}|{int(bool(convert_to_static))}|{tool_version}|{json.dumps(list(tinted_colors))}"
+    if mesh_min_feature_size:
+        # Decimated variants differ from the full ones
+        key += f"|{mesh_min_feature_size}|{mesh_decimation_version}"
+    if collision_hulls:
+        key += f"|hulls{max_collision_hulls},{max_hull_vertices}|{collision_hull_version}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+class VariantStore:
+    # Content-addressed store of compiled variants shared by a team or a build farm: a folder on a shared drive or
+    # an HTTP server (see serve_variant_store), keyed by get_variant_key. Fetched variants are kept in a local
+    # mirror, the least recently used ones are removed when it grows over mirror_limit bytes.
+    # The store only speeds things up: when it can't be reached, variants are compiled as usual.
+    __slots__ = ("location", "mirror_dir", "mirror_limit", "known", "tool_versions", "fetched", "uploaded", "upload_count")
+
+    # A variant is model.mdl, model.vvd... and its meta.json, nothing else is read from a store
+    file_names = {"model" + ext for ext in compiled_model_extensions}
+
+    def __init__(self):
+        self.location = None
+        self.mirror_dir = None
+        self.mirror_limit = 0
+        self.known = {}
+        self.tool_versions = {}
+        self.fetched = 0
+        self.uploaded = 0
+        self.upload_count = 0
+
+    def configure(self, location, mirror_dir=None, mirror_limit=0):
+        if location != self.location:
+            self.known = {}
+        self.location = location
+        self.mirror_dir = mirror_dir
+        self.mirror_limit = mirror_limit
+
+    def is_enabled(self):
+        return bool(self.location)
+
+    def is_remote(self):
+        return self.location.lower().startswith(("http://", "https://"))
+
+    def get_tool_version(self, tool_path):
+        if tool_path not in self.tool_versions:
+            self.tool_versions[tool_path] = get_source_hash(tool_path)
+        return self.tool_versions[tool_path]
+
+    def get_path(self, key):
+        return os.path.join(self.location, key[:2], key)
+
+    def request(self, method, path, data=None, timeout=60, headers=None):
+        request = urllib.request.Request(self.location.rstrip('/') + path, data=data, method=method, headers=headers or {})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read()
+
+    def lookup(self, keys):
+        # Keys not asked before are looked up at once (one request for an HTTP store), returns the keys the store has
+        keys = list(keys)
+        unknown = [key for key in keys if key not in self.known]
+        if unknown:
+            try:
+                if self.is_remote():
+                    found = set(json.loads(self.request("POST", "/lookup", json.dumps({"keys": unknown}).encode('utf-8')))["found"])
+                else:
+                    found = {key for key in unknown if os.path.isfile(os.path.join(self.get_path(key), "meta.json"))}
+            except (OSError, urllib.error.URLError, ValueError, KeyError) as e:
+                print_and_log(Fore.YELLOW + f"Warning! Variant store can't be reached: {e}")
+                return set()
+            for key in unknown:
+                self.known[key] = key in found
+        return {key for key in keys if self.known[key]}
+
+    @classmethod
+    def get_file_names(cls, meta_data):
+        # File names of a meta.json from the store; a name that is not one of file_names (a path) is refused
+        names = json.loads(meta_data)["files"]
+        if not isinstance(names, list) or not all(isinstance(name, str) and name in cls.file_names for name in names):
+            raise ValueError(f"wrong file names in meta.json: {names}")
+        return names
+
+    def fetch(self, key):
+        # Returns the mirror folder of the variant and its meta, or None
+        mirror_path = os.path.join(self.mirror_dir, key)
+        meta_path = os.path.join(mirror_path, "meta.json")
+        if not os.path.isfile(meta_path):
+            temp_path = f"{mirror_path}.{os.getpid()}.tmp"
+            try:
+                shutil.rmtree(temp_path, ignore_errors=True)
+                os.makedirs(temp_path)
+                if self.is_remote():
+                    meta_data = self.request("GET", f"/objects/{key}/meta.json")
+                    for name in self.get_file_names(meta_data):
+                        with open(os.path.join(temp_path, name), 'wb') as target_file:
+                            target_file.write(self.request("GET", f"/objects/{key}/{name}"))
+                else:
+                    with open(os.path.join(self.get_path(key), "meta.json"), 'rb') as meta_file:
+                        meta_data = meta_file.read()
+                    for name in self.get_file_names(meta_data):
+                        shutil.copyfile(os.path.join(self.get_path(key), name), os.path.join(temp_path, name))
+                # meta.json last, a mirror entry without it is incomplete
+                with open(os.path.join(temp_path, "meta.json"), 'wb') as meta_file:
+                    meta_file.write(meta_data)
+                os.replace(temp_path, mirror_path)
+            except (OSError, urllib.error.URLError, ValueError, KeyError) as e:
+                print_and_log(Fore.YELLOW + f"Warning! Variant {key} can't be fetched from the store: {e}")
+                shutil.rmtree(temp_path, ignore_errors=True)
+                return None
+            self.trim_mirror(keep=key)
+        else:
+            # Most recently used
+            os.utime(meta_path)
+        with open(meta_path, 'r', encoding='utf-8') as meta_file:
+            return mirror_path, json.load(meta_file)
+
+    def upload(self, key, files, meta):
+        # files: {name: path}; the variant is complete in the store once its meta.json is there
+        if self.lookup([key]):
+            return
+        meta = dict(meta, files=sorted(files))
+        meta_data = json.dumps(meta).encode('utf-8')
+        try:
+            if self.is_remote():
+                # The server stages the files of one upload apart from other uploads of the same variant
+                self.upload_count += 1
+                headers = {"X-Upload-Id": f"{socket.gethostname()}_{os.getpid()}_{self.upload_count}"}
+                for name, path in files.items():
+                    with open(path, 'rb') as source_file:
+                        self.request("PUT", f"/objects/{key}/{name}", source_file.read(), headers=headers)
+                self.request("PUT", f"/objects/{key}/meta.json", meta_data, headers=headers)
+            else:
+                store_path = self.get_path(key)
+                temp_path = f"{store_path}.{os.getpid()}.tmp"
+                os.makedirs(temp_path, exist_ok=True)
+                for name, path in files.items():
+                    shutil.copyfile(path, os.path.join(temp_path, name))
+                with open(os.path.join(temp_path, "meta.json"), 'wb') as meta_file:
+                    meta_file.write(meta_data)
+                try:
+                    os.replace(temp_path, store_path)
+                except OSError:
+                    # Another machine uploaded the same variant first
+                    shutil.rmtree(temp_path, ignore_errors=True)
+        except (OSError, urllib.error.URLError) as e:
+            print_and_log(Fore.YELLOW + f"Warning! Variant can't be uploaded to the store: {e}")
+            return
+        self.known[key] = True
+        self.uploaded += 1
+
+    def trim_mirror(self, keep=None):
+        entries = []
+        for name in os.listdir(self.mirror_dir):
+            if name == keep:
+                continue
+            meta_path = os.path.join(self.mirror_dir, name, "meta.json")
+            if os.path.isfile(meta_path):
+                entries.append((os.path.getmtime(meta_path), name, get_files_size(os.path.join(self.mirror_dir, name, file) for file in os.listdir(os.path.join(self.mirror_dir, name)))))
+        total_size = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total_size <= self.mirror_limit:
+                break
+            shutil.rmtree(os.path.join(self.mirror_dir, name), ignore_errors=True)
+            total_size -= size
+            log_debug("Variant removed from the store mirror: %s", name)
+
+variant_store = VariantStore()
+
+def serve_variant_store(root, port=8765, host=""):
+    # Minimal HTTP front of a store folder, a stand-in for a real artifact server:
+    # POST /lookup {"keys": [...]} -> {"found": [...]}, GET and PUT /objects/<key>/<file>
+    store = VariantStore()
+    store.configure(root)
+    object_path = re.compile(r'^/objects/([0-9a-f]{40})/([\w.]+)$')
+    upload_id_pattern = re.compile(r'^[\w.-]{1,100}$')
+
+    class VariantStoreHandler(http.server.BaseHTTPRequestHandler):
+        def send_data(self, code, data=b""):
+            self.send_response(code)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_data(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_POST(self):
+            if self.path != "/lookup":
+                return self.send_data(404)
+            keys = json.loads(self.read_data())["keys"]
+            found = [key for key in keys if re.match(r'^[0-9a-f]{40}$', key) and os.path.isfile(os.path.join(store.get_path(key), "meta.json"))]
+            self.send_data(200, json.dumps({"found": found}).encode('utf-8'))
+
+        def do_GET(self):
+            match = object_path.match(self.path)
+            file_path = os.path.join(store.get_path(match.group(1)), match.group(2)) if match else None
+            if file_path is None or not os.path.isfile(file_path):
+                return self.send_data(404)
+            with open(file_path, 'rb') as file:
+                self.send_data(200, file.read())
+
+        def do_PUT(self):
+            match = object_path.match(self.path)
+            if match is None or (match.group(2) != "meta.json" and match.group(2) not in VariantStore.file_names):
+                return self.send_data(404)
+            key, name = match.groups()
+            store_path = store.get_path(key)
+            # Every upload is staged in its own folder, concurrent uploads of one variant never mix their files
+            upload_id = self.headers.get("X-Upload-Id", "")
+            if not upload_id_pattern.match(upload_id):
+                upload_id = re.sub(r'[^\w.-]', '_', self.client_address[0])
+            upload_path = f"{store_path}.upload.{upload_id}"
+            os.makedirs(upload_path, exist_ok=True)
+            with open(os.path.join(upload_path, name), 'wb') as file:
+                file.write(self.read_data())
+            if name == "meta.json":
+                try:
+                    os.replace(upload_path, store_path)
+                except OSError:
+                    shutil.rmtree(upload_path, ignore_errors=True)
+            self.send_data(200)
+
+    os.makedirs(root, exist_ok=True)
+    server = http.server.ThreadingHTTPServer((host, port), VariantStoreHandler)
+    print_and_log(f"Variant store {root} served on port {server.server_address[1]}, press Ctrl+C to stop...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def get_model_colors(hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready):
+    # All colors a model is compiled with: the ones from the cache keep their skin index, new ones are appended
+    colors = list(psr_cache_data_ready.get(hammer_mdl_path.lower(), {}).get("colors", []))
+    for color_pair in psr_cache_data_todo.get(hammer_mdl_path.lower(), {}).get("colors", []):
+        if color_pair not in colors:
+            colors.append(color_pair)
+    return colors
+
+def get_new_colors(hammer_mdl_path, colors, psr_cache_data_ready):
+    # The colors a compile adds to the ones the cache already has
+    ready_colors = psr_cache_data_ready.get(hammer_mdl_path.lower(), {}).get("colors", [])
+    return [color_pair for color_pair in colors if color_pair not in ready_colors]
+
+def prefetch_stored_variants(compiler_path, convert_to_static, psr_cache_data_todo, psr_cache_data_ready):
+    # One store lookup for every todo variant of the models whose source is known from the cache
+    tool_version = variant_store.get_tool_version(compiler_path)
+    keys = []
+    for hammer_mdl_path, model_data in psr_cache_data_todo.items():
+        real_mdl_path = psr_cache_data_ready.get(hammer_mdl_path, {}).get("real_mdl_path")
+        if real_mdl_path is None or not os.path.isfile(real_mdl_path):
+            continue
+        source_hash = get_source_hash(real_mdl_path)
+        for modelscale in model_data.get("scales", []):
+            keys.append(get_variant_key(source_hash, modelscale, convert_to_static, tool_version))
+    if keys:
+        found = variant_store.lookup(keys)
+        print_and_log(f"{len(found)} of {len(keys)} variants found in the variant store.")
+
+def fetch_stored_variants(source_hash, compiler_path, game_folder, subfolders, hammer_mdl_path, scales, convert_to_static, psr_cache_data_todo, psr_cache_data_ready):
+    # Scales compiled by another machine are installed from the store instead of compiled.
+    # Returns the scales that still have to be compiled.
+    model = hammer_mdl_path.lower()
+    colors = get_model_colors(model, psr_cache_data_todo, psr_cache_data_ready)
+    if not variant_store.is_enabled() or get_tinted_colors({"colors": colors}):
+        # Tinted skins need tinted materials that are written from the decompiled QC
+        return scales
+    tool_version = variant_store.get_tool_version(compiler_path)
+    keys = {modelscale: get_variant_key(source_hash, modelscale, convert_to_static, tool_version) for modelscale in scales.split()}
+    found = variant_store.lookup(keys.values())
+    scales_left = []
+    for modelscale in scales.split():
+        stored = variant_store.fetch(keys[modelscale]) if keys[modelscale] in found else None
+        if stored is None:
+            scales_left.append(modelscale)
+            continue
+        mirror_path, meta = stored
+        source_files = {name[len("model"):]: os.path.join(mirror_path, name) for name in meta["files"]}
+        install_model_files(source_files, game_folder, get_scaled_hammer_model(model, modelscale, subfolders))
+        for rendercolor, skin in colors:
+            psr_cache_data_ready = add_to_cache(psr_cache_data_ready, model, modelscale, rendercolor[0], skin[0], is_static=meta.get("is_static"))
+        set_compiled_palette(psr_cache_data_ready, model, modelscale, 0, meta.get("skin_families", 1))
+        psr_cache_data_ready[model]["source_hash"] = source_hash
+        variant_store.fetched += 1
+    if len(scales_left) != len(scales.split()):
+        print_and_log(Fore.GREEN + f"{get_file_name(model)}.mdl: {len(scales.split()) - len(scales_left)} scales fetched from the variant store without compiling.")
+        save_global_cache(psr_cache_data_ready)
+    return " ".join(scales_left)
+
+def store_compiled_variants(source_hash, compiler_path, game_folder, subfolders, hammer_mdl_path, scales, convert_to_static, psr_cache_data_ready):
+    if not variant_store.is_enabled():
+        return
+    model = hammer_mdl_path.lower()
+    model_data = psr_cache_data_ready.get(model, {})
+    tool_version = variant_store.get_tool_version(compiler_path)
+    for scale in scales:
+        modelscale = str(float(scale))
+        if modelscale not in model_data.get("scales", []) or model_data.get("palette_sizes", {}).get(modelscale, 0):
+            continue
+        base_path = os.path.splitext(os.path.join(game_folder, get_scaled_hammer_model(model, modelscale, subfolders)))[0]
+        files = {"model" + ext: base_path + ext for ext in compiled_model_extensions if os.path.isfile(base_path + ext)}
+        if "model.mdl" not in files:
+            continue
+        meta = {"model": model, "scale": modelscale, "is_static": model_data.get("is_static"), "skin_families": model_data.get("skin_families", 1)}
+        variant_store.upload(get_variant_key(source_hash, modelscale, convert_to_static, tool_version), files, meta)
+
+class WorkQueue:
+    # Shared-folder job queue for compiling on several machines. A coordinator (a normal map compile with a queue)
+    # puts every model it would decompile into jobs/ together with its source files; workers move a job to
+    # running/ (the rename is the lock), touch its heartbeat while they work and move it to done/ with the
+    # compiled files, the cache data and the logs. Jobs whose heartbeat stopped are put back into jobs/.
+    __slots__ = ("root", "worker_id", "pending", "counter", "heartbeat_interval", "dead_after")
+
+    def __init__(self):
+        self.root = None
+        self.worker_id = None
+        self.pending = {}
+        self.counter = 0
+        self.heartbeat_interval = 10
+        self.dead_after = 120
+
+    def configure(self, root):
+        self.root = root
+        if root:
+            for folder in ("jobs", "running", "done"):
+                os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    def is_coordinator(self):
+        return bool(self.root) and self.worker_id is None
+
+    def submit(self, hammer_mdl_path, mdl_path, scales, convert_to_static, subfolders, fingerprint, psr_cache_data_todo, psr_cache_data_ready):
+        model = hammer_mdl_path.lower()
+        self.counter += 1
+        # Workers take the jobs in name order, which is the submit order
+        job_id = re.sub(r'[^\w.-]', '_', f"{socket.gethostname()}_{os.getpid()}_{self.counter:05d}_{get_file_name(model)}")
+        temp_path = os.path.join(self.root, "jobs", job_id + ".tmp")
+        os.makedirs(os.path.join(temp_path, "source"), exist_ok=True)
+        base_path = os.path.splitext(mdl_path)[0]
+        for ext in compiled_model_extensions + (".ani",):
+            if os.path.isfile(base_path + ext):
+                shutil.copyfile(base_path + ext, os.path.join(temp_path, "source", get_file_name(model) + ext))
+        job = {
+            "model": model,
+            "scales": scales,
+            "convert_to_static": convert_to_static,
+            "subfolders": subfolders,
+            "fingerprint": fingerprint,
+            "min_feature_size": mesh_min_feature_size,
+            "collision_hulls": [collision_hulls, max_collision_hulls, max_hull_vertices],
+            "todo": psr_cache_data_todo.get(model, {}),
+            "ready": psr_cache_data_ready.get(model),
+        }
+        with open(os.path.join(temp_path, "job.json"), 'w', encoding='utf-8') as job_file:
+            json.dump(job, job_file)
+        # Workers only see the job once it is complete
+        os.replace(temp_path, os.path.join(self.root, "jobs", job_id))
+        self.pending[job_id] = model
+        print_and_log(f"{get_file_name(model)}.mdl queued for the workers ({len(scales.split())} scales).")
+        return job_id
+
+    def claim(self):
+        for job_id in sorted(os.listdir(os.path.join(self.root, "jobs"))):
+            if job_id.endswith(".tmp"):
+                continue
+            job_path = os.path.join(self.root, "running", job_id)
+            try:
+                os.rename(os.path.join(self.root, "jobs", job_id), job_path)
+            except OSError:
+                # Taken by another worker
+                continue
+            with open(os.path.join(job_path, "worker.json"), 'w', encoding='utf-8') as worker_file:
+                json.dump({"worker": self.worker_id, "time": time.time()}, worker_file)
+            self.heartbeat(job_path)
+            return job_path
+        return None
+
+    def heartbeat(self, job_path):
+        try:
+            with open(os.path.join(job_path, "heartbeat"), 'w') as heartbeat_file:
+                heartbeat_file.write(str(time.time()))
+        except OSError:
+            pass
+
+    def owns(self, job_path):
+        # False once the job was given to another worker: a requeued job gets a new id, so the folder of a stalled
+        # worker is gone (or has no worker.json naming it) and it must not write into it or publish it
+        try:
+            with open(os.path.join(job_path, "worker.json"), 'r', encoding='utf-8') as worker_file:
+                return json.load(worker_file).get("worker") == self.worker_id
+        except (OSError, ValueError):
+            return False
+
+    def publish(self, job_path):
+        if not self.owns(job_path):
+            log_debug("Job was taken back by the coordinator: %s", job_path)
+            return False
+        try:
+            os.rename(job_path, os.path.join(self.root, "done", os.path.basename(job_path)))
+        except OSError:
+            # The coordinator thought this worker was dead and gave the job to another one
+            log_debug("Job was taken back by the coordinator: %s", job_path)
+            return False
+        return True
+
+    def requeue_dead(self):
+        for job_id in list(self.pending):
+            job_path = os.path.join(self.root, "running", job_id)
+            try:
+                silence = time.time() - os.path.getmtime(os.path.join(job_path, "heartbeat"))
+            except OSError:
+                continue
+            if silence < self.dead_after:
+                continue
+            # A new id, so a worker that was only stalled finds its folder gone instead of sharing it with the next one
+            match = re.match(r'(.*)_r(\d+)$', job_id)
+            new_job_id = f"{match.group(1)}_r{int(match.group(2)) + 1}" if match else f"{job_id}_r1"
+            new_job_path = os.path.join(self.root, "jobs", new_job_id)
+            try:
+                os.rename(job_path, new_job_path)
+            except OSError:
+                continue
+            shutil.rmtree(os.path.join(new_job_path, "result"), ignore_errors=True)
+            for name in ("worker.json", "heartbeat"):
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(new_job_path, name))
+            self.pending[new_job_id] = self.pending.pop(job_id)
+            print_and_log(Fore.YELLOW + f"The worker of {get_file_name(self.pending[new_job_id])}.mdl stopped responding, the job is queued again.")
+
+    def wait(self, game_folder, psr_cache_data_ready, poll_interval=1.0):
+        # Returns once every job of this coordinator came back, results are merged as they arrive
+        if not self.pending:
+            return
+        print_and_log(f" ")
+        print_and_log(f"Waiting for the workers, {len(self.pending)} jobs queued in {self.root}...")
+        last_report = time.monotonic()
+        while self.pending:
+            for job_id in list(self.pending):
+                job_path = os.path.join(self.root, "done", job_id)
+                if os.path.isdir(job_path):
+                    merge_queue_result(job_path, game_folder, psr_cache_data_ready)
+                    shutil.rmtree(job_path, ignore_errors=True)
+                    del self.pending[job_id]
+            if not self.pending:
+                break
+            self.requeue_dead()
+            if time.monotonic() - last_report > 30:
+                running = sum(1 for job_id in self.pending if os.path.isdir(os.path.join(self.root, "running", job_id)))
+                print_and_log(f"{len(self.pending)} jobs left, {running} of them running on workers.")
+                last_report = time.monotonic()
+            time.sleep(poll_interval)
+
+work_queue = WorkQueue()
+
+def run_queue_job(job_path, ccld_path, gameinfo_path, compiler_path):
+    # Worker side: the job is compiled with its own cache and negative cache files in result/, so the
+    # worker's own files are not touched and the coordinator gets exactly what this job produced.
+    # Returns None when the job was given to another worker in the meantime.
+    global cache_file, job_outputs, job_logs, mesh_min_feature_size, collision_hulls, max_collision_hulls, max_hull_vertices
+    if not work_queue.owns(job_path):
+        return None
+    with open(os.path.join(job_path, "job.json"), 'r', encoding='utf-8') as job_file:
+        job = json.load(job_file)
+    model = job["model"]
+    mdl_name = get_file_name(model)
+    result_path = os.path.join(job_path, "result")
+    shutil.rmtree(result_path, ignore_errors=True)
+    os.makedirs(result_path)
+    cache_file = os.path.join(result_path, "cache.pkl")
+    negative_cache.path = os.path.join(result_path, "negative_cache.pkl")
+    negative_cache.load()
+    job_outputs = []
+    job_logs = []
+    # The variants must be the same as the coordinator would compile
+    mesh_min_feature_size = job.get("min_feature_size")
+    collision_hulls, max_collision_hulls, max_hull_vertices = job.get("collision_hulls", [False, 0, 0])
+
+    psr_cache_data_todo = {model: job["todo"]}
+    psr_cache_data_ready = {model: job["ready"]} if job["ready"] else {}
+    game_folder = os.path.dirname(gameinfo_path)
+    start_time = time.time()
+    print_and_log(f" ")
+    print_and_log(f"Job {os.path.basename(job_path)}: {mdl_name}.mdl, scales {job['scales']}")
+    job_dir = scratch.create_job(mdl_name)
+    job_ok = False
+    try:
+        job_ok = decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, os.path.join(job_path, "source", mdl_name + ".mdl"), job["scales"],
+                                                     job["convert_to_static"], job["subfolders"], model, psr_cache_data_todo, psr_cache_data_ready, job_dir=job_dir)
+    finally:
+        scratch.release_job(job_dir, failed=not job_ok)
+
+    if not work_queue.owns(job_path):
+        job_outputs = None
+        job_logs = None
+        return None
+    model_data = (load_global_cache() or {}).get(model, {})
+    compiled = [modelscale for modelscale in job["scales"].split() if str(float(modelscale)) in model_data.get("scales", [])]
+    for output_path in set(job_outputs):
+        if os.path.isfile(output_path):
+            target_path = os.path.join(result_path, "files", os.path.relpath(output_path, game_folder))
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            shutil.copyfile(output_path, target_path)
+    for log_path in set(job_logs):
+        if os.path.isfile(log_path):
+            os.makedirs(os.path.join(result_path, "logs"), exist_ok=True)
+            shutil.copyfile(log_path, os.path.join(result_path, "logs", os.path.basename(log_path)))
+    failures = {kind: entry["reason"] for (entry_model, kind), entry in negative_cache.entries.items() if entry_model == model}
+    with open(os.path.join(result_path, "result.json"), 'w', encoding='utf-8') as result_file:
+        json.dump({"worker": work_queue.worker_id, "ok": job_ok, "compiled": compiled, "failures": failures, "duration": time.time() - start_time}, result_file)
+    job_outputs = None
+    job_logs = None
+    return job_ok
+
+def merge_queue_result(job_path, game_folder, psr_cache_data_ready):
+    # Coordinator side: installs the compiled files and takes over the cache data and failures of a finished job
+    try:
+        with open(os.path.join(job_path, "job.json"), 'r', encoding='utf-8') as job_file:
+            job = json.load(job_file)
+    except (OSError, ValueError) as e:
+        print_and_log(Fore.RED + f"Broken job {os.path.basename(job_path)} is ignored: {e}", level=LOG_ERROR)
+        return
+    result_path = os.path.join(job_path, "result")
+    try:
+        with open(os.path.join(result_path, "result.json"), 'r', encoding='utf-8') as result_file:
+            result = json.load(result_file)
+    except (OSError, ValueError):
+        result = {"worker": "?", "ok": False, "compiled": [], "failures": {}}
+    model = job["model"]
+    mdl_name = get_file_name(model)
+
+    files_path = os.path.join(result_path, "files")
+    for root, dirs, files in os.walk(files_path):
+        for file in files:
+            target_path = os.path.join(game_folder, os.path.relpath(os.path.join(root, file), files_path))
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            link_or_copy(os.path.join(root, file), target_path)
+    logs_path = os.path.join(result_path, "logs")
+    for log_name in os.listdir(logs_path) if os.path.isdir(logs_path) else []:
+        shutil.copyfile(os.path.join(logs_path, log_name), get_job_log_path(os.path.splitext(log_name)[0]))
+
+    model_data = None
+    if os.path.isfile(os.path.join(result_path, "cache.pkl")):
+        with open(os.path.join(result_path, "cache.pkl"), 'rb') as f:
+            model_data = pickle.load(f).get(model)
+    if model_data is not None and result["compiled"]:
+        # The worker only knew the path of its copy of the source
+        model_data["real_mdl_path"] = psr_cache_data_ready.get(model, {}).get("real_mdl_path", model_data.get("real_mdl_path"))
+        psr_cache_data_ready[model] = model_data
+        save_global_cache(psr_cache_data_ready)
+    for kind, reason in result["failures"].items():
+        negative_cache.record(model, kind, job["fingerprint"], reason)
+    for modelscale in result["compiled"]:
+        negative_cache.forget(model, f"compile {float(modelscale)}")
+
+    if len(result["compiled"]) == len(job["scales"].split()):
+        print_and_log(Fore.GREEN + f"{mdl_name}.mdl compiled by {result['worker']}: {len(result['compiled'])} scales.")
+    else:
+        print_and_log(Fore.RED + f"{mdl_name}.mdl: {len(job['scales'].split()) - len(result['compiled'])} of {len(job['scales'].split())} scales failed on {result['worker']}, see the job logs.", level=LOG_ERROR)
+
+def decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, mdl_path, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, job_dir=None):
+    log_debug("ccld_path: %s", ccld_path)
+    log_debug("gameinfo_path: %s", gameinfo_path)
+    log_debug("compiler_path: %s", compiler_path)
+    log_debug("mdl_path: %s", mdl_path)
+    log_debug("scales: %s", scales)
+
+    mdl_name = get_file_name(hammer_mdl_path)
+    game_folder = os.path.dirname(gameinfo_path)
+    source_hash = get_source_hash(mdl_path)
+    source_fingerprint = get_source_fingerprint(mdl_path, ccld_path, compiler_path)
+    reason = negative_cache.check(hammer_mdl_path, "decompile", source_fingerprint)
+    if reason is not None:
+        print_and_log(Fore.YELLOW + f"{mdl_name}.mdl is skipped, it failed last time and nothing changed since ({reason}).")
+        return True
+    failed_before = [scale for scale in scales.split() if negative_cache.check(hammer_mdl_path, f"compile {float(scale)}", source_fingerprint) is not None]
+    if failed_before:
+        print_and_log(Fore.YELLOW + f"{mdl_name}.mdl scales {' '.join(failed_before)} are skipped, they failed to compile last time and nothing changed since.")
+        scales = " ".join(scale for scale in scales.split() if scale not in failed_before)
+        if not scales: return True
+
+    scales = share_identical_variants(source_hash, game_folder, subfolders, hammer_mdl_path, scales, psr_cache_data_todo, psr_cache_data_ready)
+    if not scales: return True
+    scales = fetch_stored_variants(source_hash, compiler_path, game_folder, subfolders, hammer_mdl_path, scales, convert_to_static, psr_cache_data_todo, psr_cache_data_ready)
+    if not scales: return True
+
+    if work_queue.is_coordinator():
+        work_queue.submit(hammer_mdl_path, mdl_path, scales, convert_to_static, subfolders, source_fingerprint, psr_cache_data_todo, psr_cache_data_ready)
+        return True
+
+    qc_path = journal.get_decompiled(hammer_mdl_path, source_fingerprint)
+    if qc_path is not None:
+        print_and_log(Fore.GREEN + f"{mdl_name}.mdl was already decompiled by the interrupted run, reusing it.")
+    else:
+        journal.write("decompile", hammer_mdl_path, "started", fingerprint=source_fingerprint)
+        qc_path = decompile_dialog(mdl_path, ccld_path, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, job_dir)
+        if qc_path is None:
+            journal.write("decompile", hammer_mdl_path, "failed", fingerprint=source_fingerprint)
+            if os.path.exists(mdl_path):
+                negative_cache.record(hammer_mdl_path, "decompile", source_fingerprint, "decompilation failed")
+            return False
+        journal.write("decompile", hammer_mdl_path, "completed", fingerprint=source_fingerprint, qc_path=os.path.abspath(qc_path))
+    negative_cache.forget(hammer_mdl_path, "decompile")
+    log_debug("qc_path: %s", qc_path)
+    log_debug("game_folder: %s", game_folder)
+    failed_scales, lod_count, triangles = rescale_and_compile_models(qc_path, compiler_path, game_folder, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready)
+    if hammer_mdl_path.lower() in psr_cache_data_ready:
+        psr_cache_data_ready[hammer_mdl_path.lower()]["source_hash"] = source_hash
+        psr_cache_data_ready[hammer_mdl_path.lower()]["vertices"] = get_vvd_vertex_count(mdl_path)
+        # For the compile time estimate of the next runs, the entry exists only once a scale was compiled
+        psr_cache_data_ready[hammer_mdl_path.lower()]["triangles"] = triangles
+        psr_cache_data_ready[hammer_mdl_path.lower()]["lod_count"] = lod_count
+        save_global_cache(psr_cache_data_ready)
+    store_compiled_variants(source_hash, compiler_path, game_folder, subfolders, hammer_mdl_path, [scale for scale in map(float, scales.split()) if scale not in failed_scales], convert_to_static, psr_cache_data_ready)
+    for scale in map(float, scales.split()):
+        if scale in failed_scales:
+            negative_cache.record(hammer_mdl_path, f"compile {scale}", source_fingerprint, failed_scales[scale])
+        else:
+            negative_cache.forget(hammer_mdl_path, f"compile {scale}")
+    return not failed_scales
+
+def get_vpkeditcli_tree(vpkeditcli_path, vpk_file, cancel=None):
+    timeout, idle_timeout = get_tool_timeout("vpkeditcli", get_files_size([vpk_file]))
+    result = process_runner.run([vpkeditcli_path, '--file-tree', vpk_file], timeout=timeout, idle_timeout=idle_timeout, input_size=get_files_size([vpk_file]), capture=True, check=True, cancel=cancel)
     return result.stdout, result.stderr
 
 def extract_mdl(vpkeditcli_path, hammer_mdl_path, vpk_extract_folder, vpk_files):
@@ -852,10 +3681,10 @@ def extract_mdl(vpkeditcli_path, hammer_mdl_path, vpk_extract_folder, vpk_files)
     if mdl_folder_path_without_name_and_last_folder == "/":
         mdl_folder_path_without_name_and_last_folder = ''
     
-    vpk_extract_folder_model = os.path.join(os.path.join(get_script_path(), extracted_vpks_folder_name), mdl_folder_path_without_name_and_last_folder)
-    vpk_extract_folder_model_with_last_folder = os.path.join(os.path.join(get_script_path(), extracted_vpks_folder_name), mdl_folder_path)
+    vpk_extract_folder_model = os.path.join(vpk_extract_folder, mdl_folder_path_without_name_and_last_folder)
+    vpk_extract_folder_model_with_last_folder = os.path.join(vpk_extract_folder, mdl_folder_path)
     
-    if debug_mode: print_and_log(Fore.YELLOW + f"6. vpk_extract_folder_model: {vpk_extract_folder_model}")
+    log_debug(Fore.YELLOW + "6. vpk_extract_folder_model: %s", vpk_extract_folder_model)
     
     os.makedirs(vpk_extract_folder_model, exist_ok=True)
     os.makedirs(vpk_extract_folder_model_with_last_folder, exist_ok=True)
@@ -864,7 +3693,7 @@ def extract_mdl(vpkeditcli_path, hammer_mdl_path, vpk_extract_folder, vpk_files)
     
     for vpk_file in vpk_files:
         try:
-            vpkeditcli_tree_out, vpkeditcli_tree_err = get_vpkeditcli_tree(vpkeditcli_path, vpk_file)
+            vpkeditcli_tree_out, vpkeditcli_tree_err = get_vpkeditcli_tree(vpkeditcli_path, vpk_file, cancel=lambda: not is_variant_wanted(hammer_mdl_path))
             #print_and_log(f"vpkeditcli_tree_out: {vpkeditcli_tree_out}")
             #print_and_log(f"vpkeditcli_tree_err: {vpkeditcli_tree_err}")
             
@@ -907,11 +3736,11 @@ def extract_mdl(vpkeditcli_path, hammer_mdl_path, vpk_extract_folder, vpk_files)
                     vpk_with_mdl = vpk_file
                     break
 
-                if debug_mode: print_and_log(f"mdl_name_with_ext: {mdl_name_with_ext}")
-                if debug_mode: print_and_log(f"os.path.dirname(hammer_mdl_path): {os.path.dirname(hammer_mdl_path)}")
-                if debug_mode: print_and_log(f"hammer_mdl_path: {hammer_mdl_path}")
-                if debug_mode: print_and_log(f"mdl_folder_path: {mdl_folder_path}")
-                if debug_mode: print_and_log(f"vpk_extract_folder_model_with_last_folder: {vpk_extract_folder_model_with_last_folder}")
+                log_debug("mdl_name_with_ext: %s", mdl_name_with_ext)
+                log_debug("os.path.dirname(hammer_mdl_path): %s", os.path.dirname(hammer_mdl_path))
+                log_debug("hammer_mdl_path: %s", hammer_mdl_path)
+                log_debug("mdl_folder_path: %s", mdl_folder_path)
+                log_debug("vpk_extract_folder_model_with_last_folder: %s", vpk_extract_folder_model_with_last_folder)
 
         except subprocess.CalledProcessError as e:
             print_and_log(Fore.RED + f"Error executing vpkeditcli: {e}")
@@ -920,7 +3749,7 @@ def extract_mdl(vpkeditcli_path, hammer_mdl_path, vpk_extract_folder, vpk_files)
     if vpk_with_mdl != None:
         print_and_log(Fore.GREEN + f"vpk with {mdl_name}.mdl found:\n{vpk_with_mdl}")
         try:
-            if debug_mode: print_and_log(Fore.YELLOW + f"Extracting {mdl_name}.mdl from vpk...")
+            log_debug(Fore.YELLOW + "Extracting %s.mdl from vpk...", mdl_name)
             
             extract_paths = []
             extract_paths.append(mdl_folder_path + mdl_name + ".mdl")
@@ -930,32 +3759,34 @@ def extract_mdl(vpkeditcli_path, hammer_mdl_path, vpk_extract_folder, vpk_files)
             extract_paths.append(mdl_folder_path + mdl_name + ".vvd")
             extract_paths.append(mdl_folder_path + mdl_name + ".phy")
             
-            if debug_mode: print_and_log(f"extract_paths: {extract_paths}")
-            if debug_mode: print_and_log(f" ")
+            log_debug("extract_paths: %s", extract_paths)
+            log_debug(" ")
             
+            extract_calls = []
+            cancel = lambda: not is_variant_wanted(hammer_mdl_path)
             for extract_path in extract_paths:
-                if debug_mode: print_and_log(f"extract_path: {extract_path}")
-                if debug_mode: print_and_log(f"vpk_extract_folder_model: {vpk_extract_folder_model}")
+                log_debug("extract_path: %s", extract_path)
+                log_debug("vpk_extract_folder_model: %s", vpk_extract_folder_model)
                 
                 if ".mdl" in extract_path:
-                    vpk_extract_model_path = os.path.join(os.path.join(get_script_path(), extracted_vpks_folder_name), mdl_folder_path) + mdl_name + ".mdl"
+                    vpk_extract_model_path = os.path.join(vpk_extract_folder, mdl_folder_path) + mdl_name + ".mdl"
                 if ".dx80.vtx" in extract_path:
-                    vpk_extract_model_path = os.path.join(os.path.join(get_script_path(), extracted_vpks_folder_name), mdl_folder_path) + mdl_name + ".dx80.vtx"
+                    vpk_extract_model_path = os.path.join(vpk_extract_folder, mdl_folder_path) + mdl_name + ".dx80.vtx"
                 if ".dx90.vtx" in extract_path:
-                    vpk_extract_model_path = os.path.join(os.path.join(get_script_path(), extracted_vpks_folder_name), mdl_folder_path) + mdl_name + ".dx90.vtx"
+                    vpk_extract_model_path = os.path.join(vpk_extract_folder, mdl_folder_path) + mdl_name + ".dx90.vtx"
                 if ".sw.vtx" in extract_path:
-                    vpk_extract_model_path = os.path.join(os.path.join(get_script_path(), extracted_vpks_folder_name), mdl_folder_path) + mdl_name + ".sw.vtx"
+                    vpk_extract_model_path = os.path.join(vpk_extract_folder, mdl_folder_path) + mdl_name + ".sw.vtx"
                 if ".vvd" in extract_path:
-                    vpk_extract_model_path = os.path.join(os.path.join(get_script_path(), extracted_vpks_folder_name), mdl_folder_path) + mdl_name + ".vvd"
+                    vpk_extract_model_path = os.path.join(vpk_extract_folder, mdl_folder_path) + mdl_name + ".vvd"
                 if ".phy" in extract_path:
-                    vpk_extract_model_path = os.path.join(os.path.join(get_script_path(), extracted_vpks_folder_name), mdl_folder_path) + mdl_name + ".phy"
+                    vpk_extract_model_path = os.path.join(vpk_extract_folder, mdl_folder_path) + mdl_name + ".phy"
 
-                if debug_mode: print_and_log(Fore.YELLOW + f"vpk_extract_model_path: {vpk_extract_model_path}")
+                log_debug(Fore.YELLOW + "vpk_extract_model_path: %s", vpk_extract_model_path)
                 
-                vpkeditcli_extract_result = subprocess.run([vpkeditcli_path, '--output', vpk_extract_model_path, '--extract', extract_path, vpk_with_mdl], check=True)
+                extract_calls.append(([vpkeditcli_path, '--output', vpk_extract_model_path, '--extract', extract_path, vpk_with_mdl], {"timeout": get_tool_timeout("vpkeditcli")[0], "capture": True, "check": True, "cancel": cancel}))
             
-            #print_and_log(f"vpkeditcli_extract_result.stdout {vpkeditcli_extract_result.stdout}")
-            #print_and_log(f"vpkeditcli_extract_result.stderr {vpkeditcli_extract_result.stderr}")
+            # All files of the model are extracted at the same time
+            process_runner.run_many(extract_calls)
             
         except subprocess.CalledProcessError as e:
             print_and_log(Fore.RED + f"Error executing vpkeditcli: {e}")
@@ -966,13 +3797,13 @@ def extract_mdl(vpkeditcli_path, hammer_mdl_path, vpk_extract_folder, vpk_files)
         
     extracted_mdl_path = find_file_in_subfolders(vpk_extract_folder_model, f"{mdl_name}.mdl")
     
-    if debug_mode: print_and_log(Fore.YELLOW + f"7. extracted_mdl_path: {extracted_mdl_path}")
+    log_debug(Fore.YELLOW + "7. extracted_mdl_path: %s", extracted_mdl_path)
 
     extracted_mdl_path = extracted_mdl_path[0]
-    if debug_mode: print_and_log(Fore.YELLOW + f"8. extracted_mdl_path: {extracted_mdl_path}")
+    log_debug(Fore.YELLOW + "8. extracted_mdl_path: %s", extracted_mdl_path)
 
     if os.path.isfile(extracted_mdl_path):
-        if debug_mode: print_and_log(f"9. extracted_mdl_path: {extracted_mdl_path}")
+        log_debug("9. extracted_mdl_path: %s", extracted_mdl_path)
         return extracted_mdl_path
     else:
         print_and_log(Fore.RED + f"Extracted {mdl_name}.mdl file not found in: {extracted_mdl_path}")
@@ -1109,7 +3940,7 @@ def find_mdl_in_paths_from_gameinfo(search_paths, hammer_mdl_path):
     hammer_mdl_path = os.path.normpath(hammer_mdl_path)
     hammer_parts = hammer_mdl_path.split(os.sep)
     
-    if debug_mode: print_and_log(f"hammer_parts: {hammer_parts}")
+    log_debug("hammer_parts: %s", hammer_parts)
     
     if "models" not in hammer_parts:
         print_and_log(Fore.RED + f"[find_mdl_in_paths_from_gameinfo] ERROR! Path must contain 'models' directory")
@@ -1129,7 +3960,7 @@ def find_mdl_in_paths_from_gameinfo(search_paths, hammer_mdl_path):
             if rel_parts[-len(hammer_dirs):] == hammer_dirs:
                 if mdl_filename in files:
                     founded_mdl = os.path.join(root, mdl_filename)
-                    if debug_mode: print_and_log(f"!!!!!!!!!!!!! founded_mdl: {founded_mdl}")
+                    log_debug("!!!!!!!!!!!!! founded_mdl: %s", founded_mdl)
                     return founded_mdl
         return None
 
@@ -1191,105 +4022,253 @@ def only_vpk_paths_from_gameinfo(search_paths):
 
     return existing_vpk_files
 
-def delete_temp_vpks_content_folder():
-    vpk_extract_folder = os.path.join(get_script_path(), extracted_vpks_folder_name)
-    if os.path.exists(vpk_extract_folder):
-        try:
-            shutil.rmtree(vpk_extract_folder)
-            print_and_log(f" ")
-            print_and_log(f"Folder with temp extracted VPKs content deleted:\n{vpk_extract_folder}")
-        except Exception as e:
-            print_and_log(Fore.RED + f"ERROR! Folder with extracted vpks content ({vpk_extract_folder}) cant be deleted: {e}")
-    else:
-            if debug_mode: print_and_log(f"{vpk_extract_folder}' does not exist.")
-
-def entities_todo_processor(entities_raw, entities_ready, entities_todo, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo, ccld_path, gameinfo_path, compiler_path, game_dir, convert_to_static, subfolders, vpkeditcli_path):
-    #vpk_extract_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mdl_scaler_vpk_extract")
-    vpk_extract_folder = os.path.join(get_script_path(), extracted_vpks_folder_name)
-
+def entities_todo_processor(entity_table, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo, ccld_path, gameinfo_path, compiler_path, game_dir, convert_to_static, subfolders, vpkeditcli_path):
     print_and_log(f" ")
     print_and_log(f"Extracting paths from gameinfo.txt...")
     
-    all_source_engine_paths = os.path.abspath(os.path.join(get_script_path(), ".."))
+    # studiomdl lies in the bin folder of the Source Engine install
+    all_source_engine_paths = os.path.abspath(os.path.join(os.path.dirname(compiler_path), ".."))
     search_paths = parse_search_paths(gameinfo_path)
     search_paths = search_paths_cleanup(search_paths, remove_gameinfo_path=False, remove_all_source_engine_paths=False)
     search_paths = update_search_paths(search_paths, game_dir, all_source_engine_paths)
     
     vpk_paths_from_gameinfo = only_vpk_paths_from_gameinfo(search_paths)
-    if debug_mode: print_and_log(f"vpk_paths_from_gameinfo: \n{vpk_paths_from_gameinfo}")
+    log_debug("vpk_paths_from_gameinfo: \n%s", vpk_paths_from_gameinfo)
+
+    negative_cache.load()
+    search_fingerprint = get_search_fingerprint(game_dir, search_paths, vpk_paths_from_gameinfo)
+
+    for hammer_mdl_path, model_data in psr_cache_data_todo.items():
+        for modelscale in model_data.get('scales', []):
+            journal.write("compile", hammer_mdl_path, "planned", scale=str(float(modelscale)))
+
+    if variant_store.is_enabled():
+        prefetch_stored_variants(compiler_path, convert_to_static, psr_cache_data_todo, psr_cache_data_ready)
+
+    planned_models, estimated_time = plan_compile_order(game_dir, psr_cache_data_todo, psr_cache_data_ready)
+    print_and_log(f" ")
+    print_and_log(f"Estimated compile time: about {estimated_time / 60:.1f} minutes, done around {time.strftime('%H:%M', time.localtime(time.time() + estimated_time))}{' (less with several workers)' if work_queue.is_coordinator() else ', one model at a time'}.")
 
     print_and_log(f" ")
     print_and_log(f"Searching for models real paths...")
     #real_mdl_paths_len = len(psr_cache_data_todo.keys())
     #real_mdl_paths_progress = 0
     real_mdl_paths = []
-    for hammer_mdl_path in psr_cache_data_todo.keys():
-        if debug_mode: print_and_log(f"hammer_mdl_path: {hammer_mdl_path}")
+    for hammer_mdl_path in planned_models:
+        log_debug("hammer_mdl_path: %s", hammer_mdl_path)
         
         mdl_name = get_file_name(hammer_mdl_path)
         scales_list = psr_cache_data_todo[hammer_mdl_path].get('scales', [])
         #print_and_log(f"scales_list: {scales_list}")
         scales = " ".join(scales_list)  # Преобразуем список scales в строку
         
-        # Проверяем наличие real_mdl_path в кэше
-        if hammer_mdl_path in psr_cache_data_ready:
-            real_mdl_path = psr_cache_data_ready[hammer_mdl_path].get('real_mdl_path', None)
-            if real_mdl_path is not None:
-                print_and_log(Fore.GREEN + f"{mdl_name}.mdl found in cache!")
-                
-                decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, real_mdl_path, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready)
-                continue
-
-        real_mdl_path = find_real_mdl_path(game_dir, hammer_mdl_path)
-        if real_mdl_path:
-            #real_mdl_paths.append(real_mdl_path)
-            is_static = psr_cache_data_ready.get(hammer_mdl_path, {}).get("is_static", None)
-            psr_cache_data_todo = add_to_cache(psr_cache_data_todo, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=real_mdl_path, is_static=is_static)
-            psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=real_mdl_path, is_static=is_static)
-            
-            decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, real_mdl_path, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready)
+        if not is_variant_wanted(hammer_mdl_path):
+            print_and_log(Fore.YELLOW + f"{mdl_name}.mdl is skipped, it is not used anymore.")
             continue
 
-        else:
-            print_and_log(f" ")
-            print_and_log(f"{mdl_name}.mdl not found in project content, trying to find in paths from GameInfo...")
+        job_dir = scratch.create_job(mdl_name)
+        job_ok = False
+        try:
+            # Проверяем наличие real_mdl_path в кэше
+            if hammer_mdl_path in psr_cache_data_ready:
+                real_mdl_path = psr_cache_data_ready[hammer_mdl_path].get('real_mdl_path', None)
+                if real_mdl_path is not None:
+                    print_and_log(Fore.GREEN + f"{mdl_name}.mdl found in cache!")
+                    lookup_stats.record_source("cache")
+                
+                    job_ok = decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, real_mdl_path, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, job_dir=job_dir)
+                    continue
 
-            mdl_path_from_other_contents = find_mdl_in_paths_from_gameinfo(search_paths, hammer_mdl_path)
-            
-            if mdl_path_from_other_contents != None:
+            if negative_cache.check(hammer_mdl_path, "missing", search_fingerprint) is not None and not is_mdl_in_search_roots(game_dir, search_paths, hammer_mdl_path):
+                print_and_log(Fore.YELLOW + f"{mdl_name}.mdl was not found last time and search paths and VPKs did not change, skipping")
+                lookup_stats.record_source("negative cache")
+                job_ok = True
+                continue
+            negative_cache.forget(hammer_mdl_path, "missing")
+
+            real_mdl_path = find_real_mdl_path(game_dir, hammer_mdl_path)
+            if real_mdl_path:
+                #real_mdl_paths.append(real_mdl_path)
+                lookup_stats.record_source("project")
                 is_static = psr_cache_data_ready.get(hammer_mdl_path, {}).get("is_static", None)
-                psr_cache_data_todo = add_to_cache(psr_cache_data_todo, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=mdl_path_from_other_contents, is_static=is_static)
-                psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=mdl_path_from_other_contents, is_static=is_static)
-                print_and_log(Fore.GREEN + f"{mdl_name}.mdl found!")
-                
-                decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, mdl_path_from_other_contents, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready)
+                psr_cache_data_todo = add_to_cache(psr_cache_data_todo, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=real_mdl_path, is_static=is_static)
+                psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=real_mdl_path, is_static=is_static)
+            
+                job_ok = decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, real_mdl_path, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, job_dir=job_dir)
                 continue
-            else:
-                if debug_mode: print_and_log(f"{mdl_name}.mdl not found in paths from gameinfo.txt")
-                print_and_log(f"Trying to find {mdl_name}.mdl in vpks...")
 
-                extracted_mdl_path = extract_mdl(vpkeditcli_path, hammer_mdl_path, vpk_extract_folder, vpk_paths_from_gameinfo)
-                if debug_mode: print_and_log(Fore.YELLOW + f"extracted_mdl_path: {extracted_mdl_path}")
+            else:
+                print_and_log(f" ")
+                print_and_log(f"{mdl_name}.mdl not found in project content, trying to find in paths from GameInfo...")
 
-                if extracted_mdl_path != None:
-                    #real_mdl_paths.append(extracted_mdl_path)
-                    psr_cache_data_todo = add_to_cache(psr_cache_data_todo, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=extracted_mdl_path)
-                    #psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=extracted_mdl_path)
+                mdl_path_from_other_contents = find_mdl_in_paths_from_gameinfo(search_paths, hammer_mdl_path)
+            
+                if mdl_path_from_other_contents != None:
+                    is_static = psr_cache_data_ready.get(hammer_mdl_path, {}).get("is_static", None)
+                    psr_cache_data_todo = add_to_cache(psr_cache_data_todo, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=mdl_path_from_other_contents, is_static=is_static)
+                    psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=mdl_path_from_other_contents, is_static=is_static)
                     print_and_log(Fore.GREEN + f"{mdl_name}.mdl found!")
-                    
-                    decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, extracted_mdl_path, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready)
+                    lookup_stats.record_source("gameinfo path")
+                
+                    job_ok = decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, mdl_path_from_other_contents, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, job_dir=job_dir)
                     continue
                 else:
-                    print_and_log(Fore.RED + f"Can't extract {mdl_name}.mdl from VPKs, skipping")
+                    log_debug("%s.mdl not found in paths from gameinfo.txt", mdl_name)
+                    print_and_log(f"Trying to find {mdl_name}.mdl in vpks...")
+
+                    extracted_mdl_path = extract_mdl(vpkeditcli_path, hammer_mdl_path, os.path.join(job_dir, "vpk"), vpk_paths_from_gameinfo)
+                    log_debug(Fore.YELLOW + "extracted_mdl_path: %s", extracted_mdl_path)
+
+                    if extracted_mdl_path != None:
+                        #real_mdl_paths.append(extracted_mdl_path)
+                        psr_cache_data_todo = add_to_cache(psr_cache_data_todo, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=extracted_mdl_path)
+                        #psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", real_mdl_path=extracted_mdl_path)
+                        print_and_log(Fore.GREEN + f"{mdl_name}.mdl found!")
+                        lookup_stats.record_source("VPK")
+                    
+                        job_ok = decompile_rescale_and_compile_model(ccld_path, gameinfo_path, compiler_path, extracted_mdl_path, scales, convert_to_static, subfolders, hammer_mdl_path, psr_cache_data_todo, psr_cache_data_ready, job_dir=job_dir)
+                        continue
+                    else:
+                        print_and_log(Fore.RED + f"Can't extract {mdl_name}.mdl from VPKs, skipping")
+                        lookup_stats.record_source("not found")
+                        negative_cache.record(hammer_mdl_path, "missing", search_fingerprint, "not found")
+        finally:
+            scratch.release_job(job_dir, failed=not job_ok)
+
+    if work_queue.is_coordinator():
+        work_queue.wait(os.path.dirname(gameinfo_path), psr_cache_data_ready)
+
+    print_mesh_report()
+    lookup_stats.report_sources()
+
+    if negative_cache.hits:
+        print_and_log(f"{negative_cache.hits} known failures skipped thanks to the negative cache.")
+    if variant_store.fetched or variant_store.uploaded:
+        print_and_log(f"Variant store: {variant_store.fetched} variants fetched, {variant_store.uploaded} uploaded.")
 
     psr_cache_data_ready_load = load_global_cache()
     if psr_cache_data_ready_load != None: psr_cache_data_ready = psr_cache_data_ready_load
 
-    delete_temp_vpks_content_folder()
+    journal.finish()
     
-    return entities_todo, entities_ready
+    return entity_table
 
-def convert_vmf(game_dir, vmf_in_path, vmf_out_path, subfolders, entities_ready, psr_cache_data_ready):
+def get_scaled_hammer_model(model, modelscale, subfolders):
+    base_name, ext = os.path.splitext(model)
+    
+    if float(modelscale) == 1.0:
+        new_model = f"{base_name}_static{ext}"
+    else:
+        new_model = f"{base_name}_scaled_{int(float(modelscale) * 100)}{ext}"
+    
+    if subfolders == True and float(modelscale) != 1.0:
+        new_model = os.path.join(os.path.dirname(new_model), 'scaled', os.path.basename(new_model)).replace('\\', '/')
+
+    return new_model
+
+def rewrite_scalable_entities(content, new_models, new_skins):
+    # One pass over the top-level keyvalues of every entity (everything before its first sub-block),
+    # so the keyvalues of one entity are never matched past its own block.
+    entity_keyvalues_pattern = re.compile(r'(entity\s*\{)([^{}]*)')
+    entity_id_pattern = re.compile(r'"id"\s*"(\d+)"')
+    classname_pattern = re.compile(r'"classname"\s*"prop_static_scalable"')
+    model_pattern = re.compile(r'"model"\s*"[^"]*"')
+    skin_pattern = re.compile(r'"skin"\s*"[^"]*"')
+
+    def replacer(match):
+        keyvalues = match.group(2)
+        id_match = entity_id_pattern.search(keyvalues)
+        if id_match is None or id_match.group(1) not in new_models:
+            return match.group(0)
+        if classname_pattern.search(keyvalues) is None:
+            return match.group(0)
+        new_model = new_models[id_match.group(1)]
+        keyvalues = classname_pattern.sub('"classname" "prop_static"', keyvalues, count=1)
+        keyvalues = model_pattern.sub(lambda m: f'"model" "{new_model}"', keyvalues, count=1)
+        if id_match.group(1) in new_skins:
+            new_skin = f'"skin" "{new_skins[id_match.group(1)]}"'
+            if skin_pattern.search(keyvalues):
+                keyvalues = skin_pattern.sub(new_skin, keyvalues, count=1)
+            else:
+                keyvalues = model_pattern.sub(lambda m: f'{m.group(0)}\n\t{new_skin}', keyvalues, count=1)
+        return match.group(1) + keyvalues
+
+    return entity_keyvalues_pattern.sub(replacer, content)
+
+def rewrite_instance_files(content, new_files):
+    # Points the func_instance entities to other instance VMFs: {old "file" value: new one}
+    if not new_files:
+        return content
+    entity_keyvalues_pattern = re.compile(r'(entity\s*\{)([^{}]*)')
+    classname_pattern = re.compile(r'"classname"\s*"func_instance"')
+    file_pattern = re.compile(r'("file"\s*")([^"]+)(")')
+
+    def replacer(match):
+        keyvalues = match.group(2)
+        if classname_pattern.search(keyvalues) is None:
+            return match.group(0)
+        keyvalues = file_pattern.sub(lambda m: m.group(1) + new_files.get(m.group(2), m.group(2)) + m.group(3), keyvalues, count=1)
+        return match.group(1) + keyvalues
+
+    return entity_keyvalues_pattern.sub(replacer, content)
+
+def rewrite_instance_vmfs(vmf_tree, instances_dir, new_models, new_skins):
+    # Writes a converted copy of every instance VMF that has scalable entities (or uses such an instance) into instances_dir.
+    # Returns the new "file" values for the func_instance entities of the main VMF.
+    index_by_path = {os.path.normcase(vmf_instance.path): index for index, vmf_instance in enumerate(vmf_tree)}
+
+    def get_child_indices(vmf_instance):
+        return [index_by_path.get(os.path.normcase(instance_path)) for instance_file, instance_path in vmf_instance.instance_files if instance_path is not None]
+
+    changed = {index for index in range(1, len(vmf_tree)) if any(entity.id in new_models for entity in vmf_tree[index].entities)}
+    grown = True
+    while grown:
+        grown = False
+        for index in range(1, len(vmf_tree)):
+            if index not in changed and any(child in changed for child in get_child_indices(vmf_tree[index])):
+                changed.add(index)
+                grown = True
+    if not changed:
+        return {}
+
+    copy_names = {index: f"{get_file_name(vmf_tree[index].path)}_{vmf_tree[index].content_hash[:8]}.vmf" for index in changed}
+
+    def get_new_files(vmf_instance, folder, prefix=""):
+        new_files = {}
+        for instance_file, instance_path in vmf_instance.instance_files:
+            if instance_path is None:
+                continue
+            child = index_by_path.get(os.path.normcase(instance_path))
+            if child in changed:
+                new_files[instance_file] = prefix + copy_names[child]
+            elif folder is not None:
+                # The copy is in another folder, so the instances it keeps are pointed to relative to it
+                try:
+                    new_files[instance_file] = os.path.relpath(instance_path, folder).replace(os.sep, "/")
+                except ValueError:
+                    new_files[instance_file] = instance_path
+        return new_files
+
+    def write_copy(index):
+        vmf_instance = vmf_tree[index]
+        prefix = f"{index}:"
+        instance_models = {entity_id[len(prefix):]: new_model for entity_id, new_model in new_models.items() if entity_id.startswith(prefix)}
+        instance_skins = {entity_id[len(prefix):]: new_skin for entity_id, new_skin in new_skins.items() if entity_id.startswith(prefix)}
+        with open(vmf_instance.path, 'r', encoding='utf-8', errors='replace') as vmf_file:
+            content = vmf_file.read()
+        content = rewrite_scalable_entities(content, instance_models, instance_skins)
+        content = rewrite_instance_files(content, get_new_files(vmf_instance, instances_dir))
+        with open_atomic(os.path.join(instances_dir, copy_names[index]), 'w', encoding='utf-8') as file:
+            file.write(content)
+
+    os.makedirs(instances_dir, exist_ok=True)
+    # Mostly file I/O, threads are enough
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(changed))) as executor:
+        list(executor.map(write_copy, sorted(changed)))
+    print_and_log(f"{len(changed)} instance VMFs converted into {instances_dir}")
+    return get_new_files(vmf_tree[0], None, f"{os.path.basename(instances_dir)}/")
+
+def convert_vmf(game_dir, vmf_in_path, vmf_out_path, subfolders, entity_table, psr_cache_data_ready, instances=True, vmf_tree=None):
     #print_and_log(f"convert_vmf start...")
     print_and_log(f"vmf_in_path: {vmf_in_path}")
     print_and_log(f"vmf_out_path: {vmf_out_path}")
@@ -1298,46 +4277,31 @@ def convert_vmf(game_dir, vmf_in_path, vmf_out_path, subfolders, entities_ready,
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    shutil.copy2(vmf_in_path, vmf_out_path)
-
-    with open(vmf_out_path, 'r') as file:
+    with open(vmf_in_path, 'r') as file:
         content = file.read()
 
-    entities_ready_scaled = []
-    #entities_ready_scaled_len = len(entities_ready)
-    #entities_ready_scaled_progress = 0
-    for entity in entities_ready:
-        model = entity['model']
-        modelscale = entity['modelscale']
-        base_name, ext = os.path.splitext(model)
-        
-        if float(modelscale) == 1.0:
-            new_model = f"{base_name}_static{ext}"
-        else:
-            new_model = f"{base_name}_scaled_{int(float(modelscale) * 100)}{ext}"
-        
-        if subfolders == True and float(modelscale) != 1.0:
-            new_model = os.path.join(os.path.dirname(new_model), 'scaled', os.path.basename(new_model)).replace('\\', '/')
-
-        entity['model'] = new_model
-
-        entities_ready_scaled.append(entity)
-
-    entities_ready_scaled_len = len(entities_ready_scaled)
+    entities_ready_scaled_len = len(entity_table)
     print_and_log(f"{entities_ready_scaled_len} entities to insert into the VMF.")
 
-    entities_progress = 0
+    progress = ProgressReporter("convert_vmf", entities_ready_scaled_len)
+    new_models = {}
+    new_skins = {}
     
-    for entity in entities_ready_scaled:
-        if debug_mode: print_and_log(Fore.YELLOW + f"inserting to vmf: {entity}")
-        entity_id = entity['id']
-        new_model = entity['model']
-        modelscale = entity['modelscale']
+    for row in range(entities_ready_scaled_len):
+        entity_id = entity_table.ids[row]
+        modelscale = entity_table.scales[row]
+        new_model = get_scaled_hammer_model(entity_table.models[row], modelscale, subfolders)
+        log_debug(Fore.YELLOW + "inserting to vmf: %s", entity_id)
+        log_debug(Fore.YELLOW + "new_model: %s", new_model)
+        log_debug(Fore.YELLOW + "modelscale: %s", modelscale)
+
+        # Tinted colors are skins of the scaled model
+        model_data = psr_cache_data_ready.get(entity_table.models[row].lower(), {})
+        skin_index = get_entity_skin_index(model_data, entity_table.modelscale(row), entity_table.rendercolor(row), entity_table.skin(row))
+        if skin_index is not None:
+            new_skins[entity_id] = skin_index
         
-        if debug_mode: print_and_log(Fore.YELLOW + f"new_model: {new_model}")
-        if debug_mode: print_and_log(Fore.YELLOW + f"modelscale: {modelscale}")
-        
-        if float(modelscale) == 1.0:
+        if float(modelscale) == 1.0 and skin_index is None:
             #psr_cache_data_ready = add_to_cache(psr_cache_data_ready, hammer_mdl_path, modelscale="1.0", rendercolor="255 255 255", skin="0", is_static=True)
             #save_global_cache(psr_cache_data_ready)
             
@@ -1362,32 +4326,26 @@ def convert_vmf(game_dir, vmf_in_path, vmf_out_path, subfolders, entities_ready,
                     #если в имени нет _static значит либо оригинальная модель статичная либо компиляция сдохла, предполагаем первое
                     new_model = new_model.replace('_static', '')
         
-        if debug_mode: print_and_log(Fore.YELLOW + f"new_model: {new_model}")
+        log_debug(Fore.YELLOW + "new_model: %s", new_model)
 
-        pattern = re.compile(
-            r'entity\s*\{\s*"id"\s*"' + re.escape(entity_id) + r'"\s*("classname"\s*"prop_static_scalable"\s*)(".*?"\s*)*?("model"\s*".*?"\s*)(".*?"\s*)*\}', re.DOTALL
-        )
+        new_models[entity_id] = new_model
+        progress.update()
 
-        def replacer(match):
-            updated_block = match.group(0)
-            updated_block = re.sub(r'"classname"\s*"prop_static_scalable"', '"classname" "prop_static"', updated_block)
-            updated_block = re.sub(r'"model"\s*".*?"', f'"model" "{new_model}"', updated_block)
-            return updated_block
+    progress.done()
 
-        content = pattern.sub(replacer, content)
-        
-        entities_progress += 1
-        
-        if entities_progress >= entities_ready_scaled_len:
-            print_and_log(f"Progress: Done!")
-        else:
-            print(f"Progress: {int(entities_progress*100/entities_ready_scaled_len)}%", end="\r")
+    content = rewrite_scalable_entities(content, new_models, new_skins)
+    if instances:
+        # Instance copies go next to the output VMF, the output VMF is pointed to them. The tree read by plan() is reused.
+        if vmf_tree is None:
+            vmf_tree = read_vmf_tree(vmf_in_path, None, ["prop_static_scalable"])
+        instances_dir = os.path.join(out_dir or ".", "psr_instances")
+        content = rewrite_instance_files(content, rewrite_instance_vmfs(vmf_tree, instances_dir, new_models, new_skins))
     
-    with open(vmf_out_path, 'w') as file:
-        if debug_mode: print_and_log(Fore.YELLOW + f"writing vmf...")
+    with open_atomic(vmf_out_path, 'w') as file:
+        log_debug(Fore.YELLOW + "writing vmf...")
         file.write(content)
 
-def lightsrad_updater(game_dir, entities_ready):
+def lightsrad_updater(game_dir, entity_table, subfolders=True):
     lights_rad_path = os.path.join(game_dir, 'lights.rad')
     if not os.path.exists(lights_rad_path):
         print_and_log(f" ")
@@ -1407,36 +4365,35 @@ def lightsrad_updater(game_dir, entities_ready):
         lines.append(header_line)  # Add a line to the end if there is none
 
     entities_scaled = []
-    for entity in entities_ready:
-        model = entity['model']
+    for row in range(len(entity_table)):
+        model = get_scaled_hammer_model(entity_table.models[row], entity_table.scales[row], subfolders)
         if '_scaled_' in model:
-            entities_scaled.append(entity)
+            entities_scaled.append(model)
     
     # Checking that entities_scaled is not empty
     if not entities_scaled:
         print_and_log(f"No scaled models were found to add to lights.rad")
         return
 
-    for entity in entities_scaled:
-        model = entity['model']
+    for model in entities_scaled:
         model_noroot = '/'.join(model.split('/')[1:])
         model_noroot_original_subf = re.sub(r'_scaled_\d+', '', model_noroot)
         model_noroot_original = model_noroot_original_subf.replace('/scaled/', '/')
         
-        if debug_mode: print_and_log(Fore.YELLOW + f"model_noroot: \t\t\t{model_noroot}")
-        if debug_mode: print_and_log(Fore.YELLOW + f"model_noroot_original_subf: \t{model_noroot_original_subf}")
-        if debug_mode: print_and_log(Fore.YELLOW + f"model_noroot_original: \t\t{model_noroot_original}")
+        log_debug(Fore.YELLOW + "model_noroot: \t\t\t%s", model_noroot)
+        log_debug(Fore.YELLOW + "model_noroot_original_subf: \t%s", model_noroot_original_subf)
+        log_debug(Fore.YELLOW + "model_noroot_original: \t\t%s", model_noroot_original)
 
         # Check if the forcetextureshadow string is present for the original model
         found_original_line = any(f"forcetextureshadow {model_noroot_original}" in line for line in lines)
         
-        if debug_mode: print_and_log(Fore.YELLOW + f"found_original_line: {found_original_line}")
+        log_debug(Fore.YELLOW + "found_original_line: %s", found_original_line)
         
         if found_original_line:
             # If the line is present for the original, check if it is present for the scaled model
             found_scaled_line = any(f"forcetextureshadow {model_noroot}" in line for line in lines)
             
-            if debug_mode: print_and_log(Fore.YELLOW + f"[A] found_scaled_line: {found_scaled_line}")
+            log_debug(Fore.YELLOW + "[A] found_scaled_line: %s", found_scaled_line)
             
             if not found_scaled_line:
                 # Add a line for the scaled model
@@ -1448,7 +4405,7 @@ def lightsrad_updater(game_dir, entities_ready):
             
             found_scaled_lines = [line for line in lines if re.search(scaled_pattern, line)]
             
-            if debug_mode: print_and_log(Fore.YELLOW + f"[B] found_scaled_lines: {found_scaled_lines}")
+            log_debug(Fore.YELLOW + "[B] found_scaled_lines: %s", found_scaled_lines)
             
             if found_scaled_lines:
                 # Delete the line for the scaled model
@@ -1461,9 +4418,533 @@ def lightsrad_updater(game_dir, entities_ready):
     print_and_log(f" ")
     print_and_log(f"lights.rad updated successfully.")
 
+def lower_process_priority():
+    # Background work should not slow Hammer down, the tools started later inherit the priority.
+    # Returns the previous priority for restore_process_priority, None if it was not changed.
+    try:
+        if os.name == 'nt':
+            import ctypes
+            below_normal_priority_class = 0x4000
+            process = ctypes.windll.kernel32.GetCurrentProcess()
+            previous = ctypes.windll.kernel32.GetPriorityClass(process)
+            ctypes.windll.kernel32.SetPriorityClass(process, below_normal_priority_class)
+            return previous
+        previous = os.getpriority(os.PRIO_PROCESS, 0)
+        os.nice(10)
+        return previous
+    except Exception as e:
+        log_debug("Process priority can't be lowered: %s", e)
+        return None
+
+def restore_process_priority(previous):
+    # Without privileges Linux and macOS don't let a process raise its priority again, it then stays lowered
+    if previous is None:
+        return
+    try:
+        if os.name == 'nt':
+            import ctypes
+            ctypes.windll.kernel32.SetPriorityClass(ctypes.windll.kernel32.GetCurrentProcess(), previous)
+        else:
+            os.setpriority(os.PRIO_PROCESS, 0, previous)
+    except Exception as e:
+        log_debug("Process priority can't be restored: %s", e)
+
+def harvest_vmf_usage(folder, classnames=["prop_static_scalable"]):
+    # (model, modelscale, rendercolor, skin) -> number of entities in all VMFs of the folder
+    usage = {}
+    vmf_count = 0
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            if not file.lower().endswith(".vmf"):
+                continue
+            vmf_count += 1
+            with open(os.path.join(root, file), 'r', encoding='utf-8', errors='replace') as vmf_file:
+                content = vmf_file.read()
+            for entity in extract_scalable_entities(content, classnames):
+                variant = (entity.model.lower(), entity.modelscale, entity.rendercolor, entity.skin)
+                usage[variant] = usage.get(variant, 0) + 1
+    print_and_log(f"{len(usage)} model variants found in {vmf_count} VMFs.")
+    return usage
+
+def read_prewarm_manifest(manifest_path):
+    # JSON: {"models/props/rock.mdl": [0.5, 2]} or {"models/props/rock.mdl": {"0.5": 12, "2": 3}} (scale: usage count)
+    # Text: one model per line followed by its scales, "//" and "#" start a comment
+    # Wrong scales and entries are reported and skipped, the rest of the manifest is used
+    usage = {}
+    skipped = 0
+
+    def add_variant(model, modelscale, count, where=""):
+        nonlocal skipped
+        try:
+            scale = float(modelscale)
+        except (TypeError, ValueError):
+            scale = None
+        try:
+            usage_count = int(count)
+        except (TypeError, ValueError):
+            usage_count = None
+        if scale is None or not math.isfinite(scale) or scale < 0.01 or usage_count is None:
+            problem = f"usage count '{count}'" if scale is not None and math.isfinite(scale) and scale >= 0.01 else f"scale '{modelscale}'"
+            print_and_log(Fore.YELLOW + f"Warning! Wrong {problem} of {model} in the manifest{where}, skipping it.")
+            skipped += 1
+            return
+        variant = (model.lower(), str(modelscale), white_rendercolor, "0")
+        usage[variant] = usage.get(variant, 0) + usage_count
+
+    if manifest_path.lower().endswith(".json"):
+        with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+        if not isinstance(manifest, dict):
+            print_and_log(Fore.RED + f"ERROR! The manifest {manifest_path} is not a JSON object of models.", level=LOG_ERROR)
+            return usage
+        for model, scales in manifest.items():
+            if isinstance(scales, dict):
+                counts = list(scales.items())
+            elif isinstance(scales, list):
+                counts = [(scale, 1) for scale in scales]
+            else:
+                print_and_log(Fore.YELLOW + f"Warning! The scales of {model} in the manifest are not a list, skipping it.")
+                skipped += 1
+                continue
+            for modelscale, count in counts:
+                add_variant(model, modelscale, count)
+    else:
+        with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+            for line_number, line in enumerate(manifest_file, 1):
+                parts = re.split(r'//|#', line, maxsplit=1)[0].split()
+                for modelscale in parts[1:]:
+                    add_variant(parts[0], modelscale, 1, f" (line {line_number})")
+    print_and_log(f"{len(usage)} model variants found in the manifest" + (f", {skipped} wrong entries skipped." if skipped else "."))
+    return usage
+
+def get_prewarm_entities(usage):
+    # Most used models first, and their most used variants first
+    model_usage = {}
+    for (model, modelscale, rendercolor, skin), count in usage.items():
+        model_usage[model] = model_usage.get(model, 0) + count
+    variants = sorted(usage.items(), key=lambda item: (-model_usage[item[0][0]], item[0][0], -item[1]))
+    return [ScalableEntity(str(index), "prop_static_scalable", model, modelscale, rendercolor, skin, "")
+            for index, ((model, modelscale, rendercolor, skin), count) in enumerate(variants)]
+
+class VmfWatcher:
+    # Polls the VMF and its instance VMFs. A change is reported once the files stopped changing
+    # for debounce seconds, so a burst of (auto)saves is read once.
+    __slots__ = ("vmf_path", "debounce", "paths", "stats", "changed_at")
+
+    def __init__(self, vmf_path, debounce=2.0):
+        self.vmf_path = os.path.abspath(vmf_path)
+        self.debounce = debounce
+        self.paths = [self.vmf_path]
+        self.stats = None
+        # The first poll reads the VMF as it is now
+        self.changed_at = 0.0
+
+    def poll(self):
+        stats = [get_file_stat(path) for path in self.paths]
+        now = time.monotonic()
+        if stats != self.stats:
+            if self.stats is not None:
+                self.changed_at = now
+            self.stats = stats
+            return False
+        if self.changed_at is not None and now - self.changed_at >= self.debounce:
+            self.changed_at = None
+            return True
+        return False
+
+    def read_entities(self, classnames=["prop_static_scalable"]):
+        vmf_tree = read_vmf_tree(self.vmf_path, None, classnames)
+        entities = [entity for vmf_instance in vmf_tree for entity in vmf_instance.entities]
+        paths = [vmf_instance.path for vmf_instance in vmf_tree] or [self.vmf_path]
+        if paths != self.paths:
+            self.paths = paths
+            self.stats = [get_file_stat(path) for path in paths]
+        return entities
+
+def get_cache_stats(game_dir, psr_cache_data_ready, subfolders, cache_dir):
+    # Size of the cache, variants per model, disk usage of the variants and the lookup history
+    variants_per_model = {model: len(model_data.get("scales", [])) for model, model_data in psr_cache_data_ready.items()}
+    variant_files = 0
+    variant_bytes = 0
+    for model, model_data in psr_cache_data_ready.items():
+        for modelscale in model_data.get("scales", []):
+            base_path = os.path.splitext(os.path.join(game_dir, get_scaled_hammer_model(model, modelscale, subfolders)))[0]
+            for ext in compiled_model_extensions:
+                size = get_file_stat(base_path + ext)[1]
+                if size is not None:
+                    variant_files += 1
+                    variant_bytes += size
+    pack_bytes = 0
+    if variant_pack.dir_path:
+        pack_prefix = variant_pack.dir_path[:-len('_dir.vpk')]
+        pack_folder = os.path.dirname(pack_prefix)
+        if os.path.isdir(pack_folder):
+            for name in os.listdir(pack_folder):
+                if os.path.join(pack_folder, name).startswith(pack_prefix) and name.endswith(".vpk"):
+                    pack_bytes += os.path.getsize(os.path.join(pack_folder, name))
+    cache_bytes = 0
+    for root, dirs, files in os.walk(cache_dir):
+        for name in files:
+            if root != cache_dir or name.startswith("props_scaling_recompiler"):
+                cache_bytes += os.path.getsize(os.path.join(root, name))
+        # Only the folders of the cache, not whatever else is in the same folder
+        if root == cache_dir:
+            dirs[:] = [name for name in dirs if name.startswith("props_scaling_recompiler")]
+
+    lookup_days = {}
+    outcomes = {}
+    sources = {}
+    runs = 0
+    for record in lookup_stats.load_history():
+        counts = record.get("counts", {})
+        if record.get("kind") == "lookup":
+            runs += 1
+            day = lookup_days.setdefault(time.strftime('%Y-%m-%d', time.localtime(record.get("time", 0))), [0, 0])
+            day[0] += sum(counts.get(outcome, 0) for outcome in LookupStats.hit_outcomes)
+            day[1] += sum(counts.values())
+            totals = outcomes
+        else:
+            totals = sources
+        for key, count in counts.items():
+            totals[key] = totals.get(key, 0) + count
+
+    return {
+        "models": len(psr_cache_data_ready),
+        "variants": sum(variants_per_model.values()),
+        "variants_per_model": variants_per_model,
+        "cache_bytes": cache_bytes,
+        "variant_files": variant_files,
+        "variant_bytes": variant_bytes,
+        "pack_bytes": pack_bytes,
+        "runs": runs,
+        "lookup_days": lookup_days,
+        "outcomes": outcomes,
+        "sources": sources,
+    }
+
+def print_cache_stats(stats):
+    megabyte = 1024 * 1024
+    print_and_log(f" ")
+    print_and_log(Fore.CYAN + f"Cache: {stats['models']} models, {stats['variants']} variants, {stats['cache_bytes'] / megabyte:.1f} MB of cache files.")
+    if stats["models"]:
+        busiest = sorted(stats["variants_per_model"].items(), key=lambda item: -item[1])[:5]
+        print_and_log(f"Variants per model: {stats['variants'] / stats['models']:.1f} on average, most: " + ", ".join(f"{model} ({count})" for model, count in busiest))
+    print_and_log(f"Variants on disk: {stats['variant_files']} files, {stats['variant_bytes'] / megabyte:.1f} MB" + (f", VPK: {stats['pack_bytes'] / megabyte:.1f} MB." if stats["pack_bytes"] else "."))
+
+    print_and_log(f" ")
+    if not stats["runs"]:
+        print_and_log(f"No lookups recorded yet.")
+        return
+    lookups = sum(stats["outcomes"].values())
+    hits = sum(stats["outcomes"].get(outcome, 0) for outcome in LookupStats.hit_outcomes)
+    print_and_log(Fore.CYAN + f"Hit rate: {hits * 100 / lookups if lookups else 0:.0f}% of {lookups} lookups in {stats['runs']} runs.")
+    for day, (day_hits, day_lookups) in sorted(stats["lookup_days"].items())[-14:]:
+        print_and_log(f"  {day}: {day_hits * 100 / day_lookups if day_lookups else 0:.0f}% of {day_lookups}")
+    misses = {outcome: count for outcome, count in stats["outcomes"].items() if outcome not in LookupStats.hit_outcomes}
+    if misses:
+        print_and_log(f"Recompiled because of: " + ", ".join(f"{count} {outcome}" for outcome, count in sorted(misses.items(), key=lambda item: -item[1])))
+    if stats["sources"]:
+        print_and_log(f"Source models found in: " + ", ".join(f"{count} {stage}" for stage, count in sorted(stats["sources"].items(), key=lambda item: -item[1])))
+
+class RecompilePlan(NamedTuple):
+    vmf_in_path: str
+    entity_table: EntityTable
+    psr_cache_data_raw: dict
+    psr_cache_data_ready: dict
+    psr_cache_data_todo: dict
+    # The VMF and its instances as read by plan(), None without instances
+    vmf_tree: list = None
+
+# Seconds watch() waits for the background compile to stop after Ctrl+C
+watch_stop_timeout = 30
+
+class Recompiler:
+    # Library API: explicit tool paths, cache location and options, reusable for many maps in one process.
+    # plan() reads the VMF, compile() builds what is missing, rewrite() writes the output VMF; run() does all three.
+    # Settings are module-wide, so only one Recompiler should work at a time. Errors raise RecompilerError
+    # unless interactive=True (the CLI), where the user is asked to press Enter.
+    def __init__(self, game_dir, studiomdl_path, ccld_path, vpkeditcli_path, cache_dir=".", subfolders=True, force_recompile=False,
+                 scale_policy=None, scratch_dir=None, keep_failed_scratch=False, timeout_scale=1.0, max_concurrency=None, interactive=False,
+                 variant_store_path=None, store_mirror_mb=2048, queue_dir=None, pack_vpk=False, pack_remove_loose=False,
+                 min_feature_size=None, collision_hulls=False, max_hulls=0, max_hull_vertices=0, instances=True,
+                 parallel_scan_mb=64):
+        self.game_dir = game_dir
+        self.gameinfo_path = os.path.join(game_dir, "GameInfo.txt")
+        self.studiomdl_path = studiomdl_path
+        self.ccld_path = ccld_path
+        self.vpkeditcli_path = vpkeditcli_path
+        self.cache_dir = cache_dir
+        self.subfolders = subfolders
+        self.force_recompile = force_recompile
+        self.scale_policy = scale_policy
+        self.scratch_dir = scratch_dir
+        self.keep_failed_scratch = keep_failed_scratch
+        self.timeout_scale = timeout_scale if timeout_scale > 0 else 1.0
+        self.max_concurrency = max_concurrency
+        self.interactive = interactive
+        self.variant_store_path = variant_store_path
+        self.store_mirror_mb = store_mirror_mb
+        self.queue_dir = queue_dir
+        self.pack_vpk = pack_vpk
+        self.pack_remove_loose = pack_remove_loose
+        self.min_feature_size = min_feature_size if min_feature_size and min_feature_size > 0 else None
+        self.collision_hulls = collision_hulls
+        self.instances = instances
+        self.parallel_scan_mb = parallel_scan_mb
+        self.max_hulls = max_hulls
+        self.max_hull_vertices = max_hull_vertices
+
+        if not os.path.isfile(self.gameinfo_path):
+            raise RecompilerError(f"GameInfo.txt not found in the game directory: {game_dir}")
+        for tool_name, tool_path in (("studiomdl", studiomdl_path), ("CrowbarCommandLineDecomp", ccld_path), ("vpkeditcli", vpkeditcli_path)):
+            if not os.path.isfile(tool_path):
+                raise RecompilerError(f"{tool_name} not found: {tool_path}")
+
+    def activate(self):
+        global interactive, timeout_scale, cache_file, mesh_min_feature_size
+        global collision_hulls, max_collision_hulls, max_hull_vertices, hull_cache_dir, parallel_scan_threshold
+        interactive = self.interactive
+        timeout_scale = self.timeout_scale
+        mesh_min_feature_size = self.min_feature_size
+        collision_hulls = self.collision_hulls
+        max_collision_hulls = self.max_hulls
+        max_hull_vertices = self.max_hull_vertices
+        parallel_scan_threshold = max(self.parallel_scan_mb, 0) * 1024 * 1024
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_file = os.path.join(self.cache_dir, 'props_scaling_recompiler_cache.pkl')
+        negative_cache.path = os.path.join(self.cache_dir, 'props_scaling_recompiler_negative_cache.pkl')
+        journal.path = os.path.join(self.cache_dir, 'props_scaling_recompiler_journal.jsonl')
+        instance_cache.path = os.path.join(self.cache_dir, 'props_scaling_recompiler_instances.pkl')
+        lookup_stats.path = os.path.join(self.cache_dir, 'props_scaling_recompiler_stats.jsonl')
+        process_runner.durations_path = os.path.join(self.cache_dir, f"{get_script_name()}_tool_durations.csv")
+        if self.max_concurrency:
+            process_runner.max_concurrency = self.max_concurrency
+            process_runner.semaphore = None
+        scratch.configure(self.scratch_dir, keep_on_failure=self.keep_failed_scratch)
+        hull_cache_dir = os.path.join(self.cache_dir, "props_scaling_recompiler_hulls")
+        mirror_dir = os.path.join(self.cache_dir, "props_scaling_recompiler_store_mirror")
+        if self.variant_store_path:
+            os.makedirs(mirror_dir, exist_ok=True)
+        variant_store.configure(self.variant_store_path, mirror_dir, self.store_mirror_mb * 1024 * 1024)
+        work_queue.configure(self.queue_dir)
+        variant_pack.configure(os.path.join(os.path.dirname(self.gameinfo_path), f"{variant_pack_name}_dir.vpk"))
+
+    def plan(self, vmf_in_path):
+        self.activate()
+        if not os.path.isfile(vmf_in_path):
+            raise RecompilerError(f"VMF not found: {vmf_in_path}")
+
+        # Before the VMF is read, so half-written models of an interrupted run are not found as ready ones
+        journal.recover()
+
+        psr_cache_data_ready = {}
+        psr_cache_data_ready_load = load_global_cache()
+        print_and_log(f" ")
+        if psr_cache_data_ready_load != None: 
+            psr_cache_data_ready = psr_cache_data_ready_load
+            print_and_log(f"Cache loaded: {cache_file}")
+        else:
+            print_and_log(f"Cache not found.")
+
+        vmf_tree = read_vmf_tree(vmf_in_path, None, ["prop_static_scalable"]) if self.instances else None
+        entity_table, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo = process_vmf(self.game_dir, vmf_in_path, psr_cache_data_ready, self.force_recompile, classnames = ["prop_static_scalable"], scale_policy=self.scale_policy, instances=self.instances, vmf_tree=vmf_tree)
+        return RecompilePlan(vmf_in_path, entity_table, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo, vmf_tree)
+
+    def compile(self, plan):
+        self.activate()
+        if len(plan.entity_table.todo) != 0:
+            print_and_log(f" ")
+            print_and_log(f"There's something to do...")
+            convert_to_static = False
+            entities_todo_processor(plan.entity_table, plan.psr_cache_data_raw, plan.psr_cache_data_ready, plan.psr_cache_data_todo, self.ccld_path, self.gameinfo_path, self.studiomdl_path, self.game_dir, convert_to_static, self.subfolders, self.vpkeditcli_path)
+        else:
+            print_and_log(Fore.GREEN + f"Nothing to recompile!")
+            journal.finish()
+
+        log_debug("\n entities_ready: %s", list(plan.entity_table.ready))
+
+        psr_cache_data_ready_load = load_global_cache()
+        if psr_cache_data_ready_load != None:
+            plan = plan._replace(psr_cache_data_ready=psr_cache_data_ready_load)
+        if self.pack_vpk:
+            pack_variants(os.path.dirname(self.gameinfo_path), self.gameinfo_path, self.subfolders, plan.psr_cache_data_ready, self.pack_remove_loose)
+        return plan
+
+    def rewrite(self, plan, vmf_out_path):
+        self.activate()
+        if len(plan.entity_table.todo) == 0:
+            # plan() without compile(): nothing was left to resume from an interrupted run
+            journal.finish()
+        if len(plan.entity_table) == 0:
+            print_and_log(f"Copying VMF...")
+            print_and_log(f"vmf_in_path: {plan.vmf_in_path}")
+            print_and_log(f"vmf_out_path: {vmf_out_path}")
+        
+            out_dir = os.path.dirname(vmf_out_path)
+            if out_dir and not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+        
+            shutil.copy2(plan.vmf_in_path, vmf_out_path)
+            print_and_log(f"Done.")
+            return
+
+        # all rows of the table are rewritten, not only entity_table.ready
+        print_and_log(f" ")
+        print_and_log(f"Processing output VMF, please wait...")
+        convert_vmf(self.game_dir, plan.vmf_in_path, vmf_out_path, self.subfolders, plan.entity_table, plan.psr_cache_data_ready, self.instances, plan.vmf_tree)
+
+    def prewarm(self, source, low_priority=True):
+        # Compiles every missing variant listed in a manifest, or used by the VMFs of a folder, so map compiles find them in the cache
+        self.activate()
+        if low_priority:
+            lower_process_priority()
+        if os.path.isdir(source):
+            usage = harvest_vmf_usage(source)
+        elif os.path.isfile(source):
+            usage = read_prewarm_manifest(source)
+        else:
+            raise RecompilerError(f"Prewarm manifest or VMF folder not found: {source}")
+
+        journal.recover()
+        return self.compile_entities(get_prewarm_entities(usage), source)
+
+    def compile_entities(self, entities, source, record_history=True):
+        entity_table, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo = process_entities(self.game_dir, entities, {}, scale_policy=self.scale_policy,
+                                                                                                       record_history=record_history)
+        plan = RecompilePlan(source, entity_table, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo)
+        if len(entity_table) == 0:
+            journal.finish()
+            return plan
+        return self.compile(plan)
+
+    def watch(self, vmf_path, interval=1.0, debounce=2.0, low_priority=True, stop_event=None):
+        # Compiles new variants in the background every time the VMF (or one of its instances) is saved, so the
+        # map compile finds them in the cache. Jobs of variants removed from the VMF in the meantime are cancelled.
+        global wanted_variants, interactive
+        self.activate()
+        # The compile runs on its own thread, where input() would wait forever: prompts raise instead
+        interactive = False
+        if not os.path.isfile(vmf_path):
+            raise RecompilerError(f"VMF not found: {vmf_path}")
+        previous_priority = lower_process_priority() if low_priority else None
+        journal.recover()
+
+        watcher = VmfWatcher(vmf_path, debounce)
+        stop_event = stop_event or threading.Event()
+        # Set when watch() returns, the worker then resets the wanted variants itself if it outlives the join below
+        watch_stopped = threading.Event()
+        worker = None
+        pending = None
+        print_and_log(f"Watching {vmf_path} for changes, press Ctrl+C to stop...")
+        try:
+            while not stop_event.is_set():
+                if watcher.poll():
+                    entities = watcher.read_entities()
+                    wanted_variants = get_wanted_variants(entities, self.scale_policy)
+                    pending = entities
+                    log_debug("VMF changed: %s entities, %s files watched", len(entities), len(watcher.paths))
+                # One compile at a time, the newest VMF state waits for the running one
+                if pending is not None and (worker is None or not worker.is_alive()):
+                    worker = threading.Thread(target=self.compile_in_background, args=(pending, vmf_path, watch_stopped), name="psr_watch_compile", daemon=True)
+                    worker.start()
+                    pending = None
+                stop_event.wait(interval)
+        except KeyboardInterrupt:
+            print_and_log(f"Watch stopped.")
+        finally:
+            # Nothing is wanted anymore: the running tools are stopped and the worker skips the rest of its models.
+            # A worker still running after watch_stop_timeout keeps "nothing wanted" until it has really exited.
+            wanted_variants = {}
+            watch_stopped.set()
+            if worker is not None:
+                worker.join(watch_stop_timeout)
+            if worker is not None and worker.is_alive():
+                print_and_log(Fore.YELLOW + f"The background compile did not stop within {watch_stop_timeout} seconds, leaving it.")
+            else:
+                wanted_variants = None
+                interactive = self.interactive
+            if not self.interactive:
+                # Library use: the process goes on with other work
+                restore_process_priority(previous_priority)
+
+    def compile_in_background(self, entities, vmf_path, watch_stopped):
+        global wanted_variants, interactive
+        try:
+            self.compile_entities(entities, vmf_path, record_history=False)
+        except RecompilerError as e:
+            print_and_log(Fore.RED + f"ERROR! Background compile stopped: {e}", level=LOG_ERROR)
+        finally:
+            if watch_stopped.is_set():
+                wanted_variants = None
+                interactive = self.interactive
+
+    def work(self, idle_exit=None, stop_event=None, poll_interval=1.0):
+        # Worker of a build farm: compiles the jobs that coordinators put into queue_dir until Ctrl+C,
+        # until stop_event is set or, with idle_exit, after that many seconds without a job
+        self.activate()
+        if not self.queue_dir:
+            raise RecompilerError("A worker needs a queue folder")
+        journal.recover()
+        work_queue.worker_id = f"{socket.gethostname()}_{os.getpid()}"
+        stop_event = stop_event or threading.Event()
+        idle_since = time.monotonic()
+        jobs_done = 0
+        print_and_log(f"Worker {work_queue.worker_id} is waiting for jobs in {self.queue_dir}, press Ctrl+C to stop...")
+        try:
+            while not stop_event.is_set():
+                job_path = work_queue.claim()
+                if job_path is None:
+                    if idle_exit is not None and time.monotonic() - idle_since > idle_exit:
+                        break
+                    stop_event.wait(poll_interval)
+                    continue
+                job_done = threading.Event()
+                def heartbeat():
+                    while not job_done.wait(work_queue.heartbeat_interval):
+                        work_queue.heartbeat(job_path)
+                heartbeat_thread = threading.Thread(target=heartbeat, name="psr_worker_heartbeat", daemon=True)
+                heartbeat_thread.start()
+                try:
+                    job_ok = run_queue_job(job_path, self.ccld_path, self.gameinfo_path, self.studiomdl_path)
+                except OSError as e:
+                    if work_queue.owns(job_path):
+                        raise
+                    job_ok = None
+                finally:
+                    job_done.set()
+                    heartbeat_thread.join()
+                    # Back to the worker's own cache files
+                    self.activate()
+                # Given to another worker in the meantime, its result is not needed anymore
+                if job_ok is None or not work_queue.publish(job_path):
+                    print_and_log(Fore.YELLOW + f"The job {os.path.basename(job_path)} was taken back by the coordinator.")
+                    continue
+                jobs_done += 1
+                idle_since = time.monotonic()
+        except KeyboardInterrupt:
+            print_and_log(f"Worker stopped.")
+        finally:
+            work_queue.worker_id = None
+        return jobs_done
+
+    def stats(self):
+        # Prints and returns what the cache holds and how well it served the past runs
+        self.activate()
+        stats = get_cache_stats(self.game_dir, load_global_cache() or {}, self.subfolders, self.cache_dir)
+        print_cache_stats(stats)
+        return stats
+
+    def run(self, vmf_in_path, vmf_out_path):
+        plan = self.plan(vmf_in_path)
+        if len(plan.entity_table) != 0:
+            plan = self.compile(plan)
+        self.rewrite(plan, vmf_out_path)
+        return plan
+
 def main():
     # init colorama
     init()
+    log_sink.open(f"{get_script_name()}_log.txt")
     
     #Fore.BLACK
     #Fore.RED
@@ -1496,8 +4977,8 @@ def main():
     if check_bin_folder(script_path) == True:
         pass
     else:
-        print(f" ")
-        input("Press Enter to exit...")
+        print_and_log(f" ")
+        prompt_user("Press Enter to exit...")
         return
     
     if find_file(script_path, filename_ext = "CrowbarCommandLineDecomp.exe") == True:
@@ -1505,32 +4986,57 @@ def main():
     else:
         print_and_log(Fore.RED + "ERROR! This tool requires CrowbarCommandLineDecomp.exe lying in the same bin folder! Please download the program from the author's GitHub and place it there:")
         print_and_log(ccld_url)
-        input("\nPress Enter to exit...")
+        prompt_user("\nPress Enter to exit...")
         return
     
     if find_file(script_path, filename_ext = "vpkeditcli.exe") == True:
         vpkeditcli_path = os.path.join(script_path, "vpkeditcli.exe")
-        if debug_mode: print_and_log(f"vpkeditcli_path: {vpkeditcli_path}")
+        log_debug("vpkeditcli_path: %s", vpkeditcli_path)
     else:
         print_and_log(Fore.RED + "ERROR! This tool requires standalone vpkeditcli.exe lying in the same bin folder! Please download the program from the author's GitHub and place it there:")
         print_and_log(vpkedit_url)
-        input("\nPress Enter to exit...")
+        prompt_user("\nPress Enter to exit...")
         return
     
-    # delete temporary shit if it didn't deleted last time on error
-    delete_temp_vpks_content_folder()
-    
     parser = argparse.ArgumentParser(description=f"props_scaling_recompiler usage:")
     
     parser.add_argument('-game', type=str, required=True, help='Path to the game directory')
-    parser.add_argument('-vmf_in', type=str, required=True, help='Path to the input .vmf file')
-    parser.add_argument('-vmf_out', type=str, required=True, help='Path to the output .vmf file')
+    parser.add_argument('-vmf_in', type=str, required=False, help='Path to the input .vmf file')
+    parser.add_argument('-vmf_out', type=str, required=False, help='Path to the output .vmf file')
+    parser.add_argument('-variant_store', type=str, default=None, help='Folder on a shared drive or http:// URL of a variant store shared with other machines (default off)')
+    parser.add_argument('-store_mirror_mb', type=int, default=2048, help='Size of the local copy of fetched variants of the variant store, in MB (default 2048)')
+    parser.add_argument('-queue', type=str, default=None, help='Shared folder of a compile queue: the models of the map are compiled by the workers of this queue (default off)')
+    parser.add_argument('-worker', type=int, choices=[0, 1], default=0, help='Instead of compiling a map, work as a worker of the -queue (1 = yes, 0 = no, default 0)')
+    parser.add_argument('-min_feature_size', type=float, default=0.0, help='In variants scaled below 1, decimate the meshes so details smaller than this many units (after scaling) are merged, and drop LODs that are no lighter (default 0 = off)')
+    parser.add_argument('-collision_hulls', type=int, choices=[0, 1], default=0, help='Replace the $concave collision model of the variants by its convex hulls, computed once per model and cached (1 = yes, 0 = no, default 0)')
+    parser.add_argument('-max_hulls', type=int, default=0, help='With -collision_hulls 1, merge the smallest hulls of the variants scaled below 1 until this many are left (default 0 = no limit)')
+    parser.add_argument('-max_hull_vertices', type=int, default=0, help='With -collision_hulls 1, keep at most this many vertices per hull in the variants scaled below 1 (default 0 = no limit)')
+    parser.add_argument('-instances', type=int, choices=[0, 1], default=1, help='Also convert the scalable props inside func_instance VMFs, into converted copies of the instances next to -vmf_out (1 = yes, 0 = no, default 1)')
+    parser.add_argument('-parallel_scan_mb', type=int, default=64, help='VMFs of this size (MB) or bigger are scanned by several processes (default 64, 0 = never)')
+    parser.add_argument('-stats', type=int, choices=[0, 1], default=0, help='Print the cache size, variants per model, disk usage and the hit rate of past runs, and exit (1 = yes, 0 = no, default 0)')
+    parser.add_argument('-pack_vpk', type=int, choices=[0, 1], default=0, help='Pack all scaled variants into props_scaling_recompiler_variants_dir.vpk and add it to GameInfo.txt (1 = yes, 0 = no, default 0)')
+    parser.add_argument('-pack_remove_loose', type=int, choices=[0, 1], default=0, help='With -pack_vpk 1, remove the loose files of the packed variants (1 = yes, 0 = no, default 0)')
+    parser.add_argument('-watch', type=int, choices=[0, 1], default=0, help='Watch -vmf_in and its instances, and compile new variants in the background every time it is saved (1 = yes, 0 = no, default 0)')
+    parser.add_argument('-watch_debounce', type=float, default=2.0, help='Seconds the VMF must stay unchanged after a save before it is read in watch mode (default 2)')
+    parser.add_argument('-prewarm', type=str, required=False, help='Instead of a map, compile all missing variants from a manifest (.json or .txt) or from all VMFs in a folder')
     parser.add_argument('-subfolders', type=int, required=False, default=1, help='Using subfolders (0 or 1)')
     parser.add_argument('-force_recompile', type=int, required=False, default=0, help='Recompile all props for this map (0 or 1)')
+    parser.add_argument('-scale_step', type=float, required=False, default=0.0, help='Snap model scales to a multiple of this step, e.g. 0.05 (0 = off)')
+    parser.add_argument('-scale_tolerance', type=float, required=False, default=0.0, help='Snap a model scale to an already compiled or used scale of the same model within this relative tolerance, e.g. 0.03 (0 = off)')
+    parser.add_argument('-scale_palette', type=str, required=False, default="", help='Snap model scales to the nearest of these scales, e.g. "0.5 0.75 1 1.25 1.5 2"')
+    parser.add_argument('-scratch_dir', type=str, required=False, default="", help='Folder for temporary decompiled and extracted files, e.g. on a RAM disk (default: props_scaling_recompiler_temp in the bin folder)')
+    parser.add_argument('-keep_failed_scratch', type=int, required=False, default=0, help='Keep temporary files of failed models for debugging (0 or 1)')
+    parser.add_argument('-timeout_scale', type=float, required=False, default=1.0, help='Multiply the timeouts of studiomdl, CrowbarCommandLineDecomp and vpkeditcli, e.g. 2 for slow machines')
+    parser.add_argument('-progress_json', type=int, required=False, default=0, help='Write progress events as JSON lines to stderr (0 or 1)')
 
     try:
         args = parser.parse_args()
+        if args.worker == 1 and args.queue is None:
+            parser.error("-worker 1 needs -queue")
+        if args.prewarm is None and args.worker != 1 and args.stats != 1 and (args.vmf_in is None or (args.vmf_out is None and args.watch != 1)):
+            parser.error("the following arguments are required: -vmf_in, -vmf_out")
     except SystemExit as e:
+        log_sink.flush()
         os.system('cls' if os.name == 'nt' else 'clear')
         print_and_log(Fore.CYAN + f'{psr_description_name}')
         print_and_log(f'{psr_description_author}')
@@ -1539,21 +5045,21 @@ def main():
         print_and_log(f' ')
         print_and_log(Fore.RED + f"ERROR! Input args not found!")
         if e.code != 0:  # if the exit code is not 0, it means there was an error in parsing arguments
+            log_sink.flush()
             parser.print_help()
         print_and_log(f' ')
-        input("Press Enter to exit...")
+        prompt_user("Press Enter to exit...")
         sys.exit(e.code)
 
     game_dir = args.game
-    gameinfo_path = os.path.join(game_dir, "GameInfo.txt")
     vmf_in_path = args.vmf_in
     vmf_out_path = args.vmf_out
     
-    if debug_mode: print_and_log("Game directory:", args.game)
-    if debug_mode: print_and_log("Input VMF file:", args.vmf_in)
-    if debug_mode: print_and_log("Output VMF file:", args.vmf_out)
-    if debug_mode: print_and_log("Subfolders flag:", args.subfolders)
-    if debug_mode: print_and_log("Force recompile:", args.force_recompile)
+    log_debug("Game directory: %s", args.game)
+    log_debug("Input VMF file: %s", args.vmf_in)
+    log_debug("Output VMF file: %s", args.vmf_out)
+    log_debug("Subfolders flag: %s", args.subfolders)
+    log_debug("Force recompile: %s", args.force_recompile)
     
     if args.subfolders == 1:
         subfolders = True
@@ -1565,73 +5071,49 @@ def main():
     else:
         force_recompile = False
 
-    ccld_path = os.path.join(script_path, "CrowbarCommandLineDecomp.exe")
-    compiler_path = os.path.join(script_path, "studiomdl.exe")
-    convert_to_static = False
+    global progress_json
+    progress_json = args.progress_json == 1
 
-    psr_cache_data_ready = {}
-    psr_cache_data_ready_load = load_global_cache()
-    print_and_log(f" ")
-    #print_and_log(f"psr_cache_data_ready_load: {psr_cache_data_ready_load}")
-    if psr_cache_data_ready_load != None: 
-        psr_cache_data_ready = psr_cache_data_ready_load
-        print_and_log(f"Cache loaded: props_scaling_recompiler_cache.pkl")
-    else:
-        print_and_log(f"Cache not found.")
-    
-    #print_and_log(f" ")
-    #print_and_log(f"GLOBAL CACHE ON THE START:")
-    #print_and_log(f"{psr_cache_data_ready}")
+    scale_policy = parse_scale_policy(args.scale_step, args.scale_tolerance, args.scale_palette)
 
-    entities_raw, entities_ready, entities_todo, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo = process_vmf(game_dir, vmf_in_path, psr_cache_data_ready, force_recompile, classnames = ["prop_static_scalable"])
+    ccld_path = os.path.join(script_path, "CrowbarCommandLineDecomp.exe")
+    compiler_path = os.path.join(script_path, "studiomdl.exe")
 
-    if len(entities_raw) == 0:
-        print_and_log(f"Copying VMF...")
-        print_and_log(f"vmf_in_path: {vmf_in_path}")
-        print_and_log(f"vmf_out_path: {vmf_out_path}")
-    
-        out_dir = os.path.dirname(vmf_out_path)
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-    
-        shutil.copy2(vmf_in_path, vmf_out_path)
-        print_and_log(f"Done.")
+    try:
+        recompiler = Recompiler(game_dir, compiler_path, ccld_path, vpkeditcli_path, subfolders=subfolders, force_recompile=force_recompile,
+                                scale_policy=scale_policy, scratch_dir=args.scratch_dir, keep_failed_scratch=args.keep_failed_scratch == 1,
+                                timeout_scale=args.timeout_scale, interactive=True,
+                                variant_store_path=args.variant_store, store_mirror_mb=args.store_mirror_mb, queue_dir=args.queue,
+                                pack_vpk=args.pack_vpk == 1, pack_remove_loose=args.pack_remove_loose == 1,
+                                min_feature_size=args.min_feature_size, collision_hulls=args.collision_hulls == 1,
+                                max_hulls=args.max_hulls, max_hull_vertices=args.max_hull_vertices, instances=args.instances == 1,
+                                parallel_scan_mb=args.parallel_scan_mb)
+        if args.stats == 1:
+            recompiler.stats()
+            return
+        if args.worker == 1:
+            recompiler.work()
+            return
+        if args.prewarm is not None:
+            recompiler.prewarm(args.prewarm)
+            print_and_log(Fore.GREEN + f"Prewarm finished.")
+            return
+        if args.watch == 1:
+            recompiler.watch(vmf_in_path, debounce=args.watch_debounce)
+            return
+        plan = recompiler.plan(vmf_in_path)
+        if len(plan.entity_table) == 0:
+            recompiler.rewrite(plan, vmf_out_path)
+            return
+        plan = recompiler.compile(plan)
+
+        #lightsrad_updater(game_dir, plan.entity_table, subfolders)
+
+        recompiler.rewrite(plan, vmf_out_path)
+    except RecompilerError as e:
+        print_and_log(Fore.RED + f"ERROR! {e}", level=LOG_ERROR)
+        prompt_user("\nPress Enter to exit...")
         return
-
-    if len(entities_todo) != 0:
-        print_and_log(f" ")
-        print_and_log(f"There's something to do...")
-        entities_todo, entities_ready = entities_todo_processor(entities_raw, entities_ready, entities_todo, psr_cache_data_raw, psr_cache_data_ready, psr_cache_data_todo, ccld_path, gameinfo_path, compiler_path, game_dir, convert_to_static, subfolders, vpkeditcli_path)
-    else:
-        print_and_log(Fore.GREEN + f"Nothing to recompile!")
-
-    if debug_mode: print_and_log(f"\n entities_ready: {entities_ready}")
-    
-    psr_cache_data_ready_load = load_global_cache()
-    if psr_cache_data_ready_load != None: psr_cache_data_ready = psr_cache_data_ready_load
-    
-    #print_and_log(f" ")
-    #print_and_log(f"entities_ready: {entities_ready}")
-    #print_and_log(f" ")
-    #print_and_log(f"psr_cache_data_ready: {psr_cache_data_ready}")
-    #print_and_log(f" ")
-    #print_and_log(f"len(entities_raw): {len(entities_raw)}")
-    #print_and_log(f" ")
-    #print_and_log(f"entities_raw: {entities_raw}")
-    #print_and_log(f" ")
-    #print_and_log(f"len(entities_ready): {len(entities_ready)}")
-    #print_and_log(f" ")
-    #print_and_log(f"entities_ready: {entities_ready}")
-    #print_and_log(f" ")
-    #print_and_log(f"psr_cache_data_raw: {psr_cache_data_raw}")
-
-    #lightsrad_updater(game_dir, entities_ready)
-    
-    # entities_ready = entities_raw just because
-    
-    print_and_log(f" ")
-    print_and_log(f"Processing output VMF, please wait...")
-    convert_vmf(game_dir, vmf_in_path, vmf_out_path, subfolders, entities_raw, psr_cache_data_ready)
     
     print_and_log(f" ")
     end_time = time.time()
@@ -1648,14 +5130,16 @@ def main():
 
 try:
     if __name__ == '__main__':
+        # The scan processes of the frozen exe start the exe again
+        multiprocessing.freeze_support()
         main()
 except Exception as e:
     import traceback
     print_and_log(Fore.RED + f"An error occurred: {e}")
     print_and_log(traceback.format_exc())
-    input("\nPress Enter to exit...")
+    prompt_user("\nPress Enter to exit...")
 finally:
-    with open(f"{get_script_name()}_log.txt", 'w', encoding='utf-8') as f:
-        f.write(log_buffer.getvalue())
+    scratch.close()
+    log_sink.close()
     #input("\nPress Enter to exit...")
     pass
\ No newline at end of file
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import props_scaling_recompiler as psr
+
+# Module settings and shared objects that Recompiler.activate() and the queue/journal code change
+module_settings = ("cache_file", "interactive", "timeout_scale", "mesh_min_feature_size", "collision_hulls", "max_collision_hulls",
+                   "max_hull_vertices", "hull_cache_dir", "parallel_scan_threshold", "job_logs", "job_outputs", "wanted_variants")
+module_objects = ("work_queue", "negative_cache", "journal", "instance_cache", "lookup_stats", "process_runner", "scratch",
+                  "variant_store", "variant_pack")
+
+
+@pytest.fixture(autouse=True)
+def restore_module_state(monkeypatch):
+    # Every test starts from the module state of the session and leaves it as it was, so a test that
+    # activated a Recompiler (queue folder, cache paths, scratch) does not turn later tests into coordinators
+    for name in module_settings:
+        monkeypatch.setattr(psr, name, getattr(psr, name))
+    for name in module_objects:
+        shared_object = getattr(psr, name)
+        for attribute in getattr(type(shared_object), "__slots__", None) or list(vars(shared_object)):
+            value = getattr(shared_object, attribute)
+            if isinstance(value, (dict, list, set)):
+                value = type(value)(value)
+            monkeypatch.setattr(shared_object, attribute, value)
+    yield
+    psr.scratch.close()
+    if psr.journal.file is not None:
+        psr.journal.file.close()
+        psr.journal.file = None
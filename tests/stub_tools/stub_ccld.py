@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# Stand-in for CrowbarCommandLineDecomp: "-p <mdl> -o <folder>", writes a QC and one reference SMD.
+# The $modelname is read from the fake .mdl header written by stub_studiomdl.py (or by the tests).
+import os
+import sys
+
+mdl_path, decomp_folder = sys.argv[2], sys.argv[4]
+name = os.path.splitext(os.path.basename(mdl_path))[0]
+with open(mdl_path, 'rb') as mdl_file:
+    header = mdl_file.read(76)
+model_name = header[12:76].rstrip(b"\0").decode() if header.startswith(b"IDST") else f"{name}.mdl"
+os.makedirs(decomp_folder, exist_ok=True)
+with open(os.path.join(decomp_folder, f"{name}_ref.smd"), 'w') as smd_file:
+    smd_file.write("version 1\nnodes\n0 \"root\" -1\nend\nskeleton\ntime 0\n0 0 0 0 0 0 0\nend\ntriangles\nmat\n"
+                   "  0 0 0 0 0 0 1 0 0 1 0 1\n  0 1 0 0 0 0 1 0 0 1 0 1\n  0 0 1 0 0 0 1 0 0 1 0 1\nend\n")
+with open(os.path.join(decomp_folder, f"{name}.qc"), 'w') as qc_file:
+    qc_file.write(f'$modelname "{model_name}"\n$body "body" "{name}_ref.smd"\n$staticprop\n')
+print(f"Decompiled {name}")
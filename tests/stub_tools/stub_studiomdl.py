@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# Stand-in for studiomdl: "-game <folder> -nop4 -verbose <qc>", writes a fake .mdl/.vvd for the $modelname of the QC
+import os
+import re
+import sys
+
+game_folder, qc_path = sys.argv[2], sys.argv[-1]
+with open(qc_path) as qc_file:
+    model_name = re.search(r'\$modelname\s+"([^"]+)"', qc_file.read()).group(1)
+base_path = os.path.join(game_folder, "models", os.path.splitext(model_name)[0])
+os.makedirs(os.path.dirname(base_path), exist_ok=True)
+with open(base_path + ".mdl", 'wb') as mdl_file:
+    mdl_file.write(b"IDST0000CCCC" + model_name.encode().ljust(64, b"\0") + b"body")
+with open(base_path + ".vvd", 'wb') as vvd_file:
+    vvd_file.write(b"IDSV" + bytes(28))
+print(f'Completed "{os.path.basename(qc_path)}"')
@@ -0,0 +1,97 @@
+import props_scaling_recompiler as psr
+from test_mesh_optimization import SMD_HEADER, make_triangle
+
+
+def make_prism(polygon, z0, z1, fan_start=0):
+    # Closed mesh of a polygon (counterclockwise from above) extruded from z0 to z1, faces wound outwards.
+    # The caps are fanned from fan_start, which must see every other corner.
+    polygon = polygon[fan_start:] + polygon[:fan_start]
+    triangles = []
+    for i in range(1, len(polygon) - 1):
+        a, b, c = polygon[0], polygon[i], polygon[i + 1]
+        triangles.append(make_triangle((*a, z1), (*b, z1), (*c, z1)))
+        triangles.append(make_triangle((*a, z0), (*c, z0), (*b, z0)))
+    for i in range(len(polygon)):
+        a, b = polygon[i], polygon[(i + 1) % len(polygon)]
+        triangles.append(make_triangle((*a, z0), (*b, z0), (*b, z1)))
+        triangles.append(make_triangle((*a, z0), (*b, z1), (*a, z1)))
+    return triangles
+
+
+def make_box(x0, y0, z0, x1, y1, z1):
+    return make_prism([(x0, y0), (x1, y0), (x1, y1), (x0, y1)], z0, z1)
+
+
+def make_card():
+    # Flat square, no volume
+    return [make_triangle((0, 0, 0), (10, 0, 0), (10, 10, 0)), make_triangle((0, 0, 0), (10, 10, 0), (0, 10, 0))]
+
+
+# L-shaped prism, fanned from its inner corner
+L_PIECE = make_prism([(0, 0), (20, 0), (20, 10), (10, 10), (10, 20), (0, 20)], 0, 10, fan_start=3)
+
+
+def get_points(triangles):
+    return [tuple(float(value) for value in vertex[1:4]) for _, vertices in triangles for vertex in vertices]
+
+
+def get_faces(triangles):
+    return [[tuple(float(value) for value in vertex[1:4]) for vertex in vertices] for _, vertices in triangles]
+
+
+def test_convex_hull_of_a_cube():
+    corners = list(dict.fromkeys(get_points(make_box(0, 0, 0, 10, 10, 10))))
+    points = corners + [(5.0, 5.0, 5.0), (2.0, 3.0, 4.0)]
+
+    faces = psr.get_convex_hull(points)
+
+    assert len(faces) == 12
+    assert {index for face in faces for index in face} == set(range(len(corners)))
+    assert abs(psr.get_mesh_volume([[points[index] for index in face] for face in faces]) - 1000) < 1e-6
+
+
+def test_convex_hull_of_flat_or_too_few_points():
+    assert psr.get_convex_hull([(0, 0, 0), (1, 0, 0), (0, 1, 0)]) is None
+    assert psr.get_convex_hull([(0, 0, 0), (10, 0, 0), (0, 10, 0), (10, 10, 0), (5, 5, 0)]) is None
+    assert psr.get_convex_hull([(0, 0, 0), (1, 1, 1), (2, 2, 2), (3, 3, 3)]) is None
+
+
+def test_mesh_volume():
+    assert abs(psr.get_mesh_volume(get_faces(make_box(0, 0, 0, 10, 10, 10))) - 1000) < 1e-6
+    assert abs(psr.get_mesh_volume(get_faces(L_PIECE)) - 3000) < 1e-6
+    assert psr.get_mesh_volume(get_faces(make_card())) == 0
+
+
+def test_boxes_touching_at_a_corner_stay_apart():
+    pieces = psr.read_collision_pieces(make_box(0, 0, 0, 10, 10, 10) + make_box(10, 10, 10, 20, 20, 20))
+
+    assert [len(piece_triangles) for _, _, _, piece_triangles in pieces] == [12, 12]
+    assert sorted(min(points) for _, _, points, _ in pieces) == [(0, 0, 0), (10, 10, 10)]
+    assert len(psr.read_collision_pieces(L_PIECE)) == 1
+
+
+def test_hulls_of_pieces():
+    boxes = make_box(0, 0, 0, 10, 10, 10) + make_box(10, 10, 10, 20, 20, 20)
+
+    hull_triangles, hull_count = psr.build_collision_hulls(boxes)
+    assert hull_count == 2 and len(hull_triangles) == 24
+    # Merged into one hull that spans both boxes
+    hull_triangles, hull_count = psr.build_collision_hulls(boxes, max_hulls=1)
+    assert hull_count == 1
+    assert psr.get_mesh_volume(get_faces(hull_triangles)) > 2000
+    # The hull of an L would fill its inner corner
+    assert psr.build_collision_hulls(L_PIECE) == (L_PIECE, 1)
+    assert psr.build_collision_hulls(make_card())[0] == []
+
+
+def test_hulls_only_replace_concave_collision_models(tmp_path, monkeypatch):
+    monkeypatch.setattr(psr, "collision_hulls", True)
+    psr.write_smd(str(tmp_path / "rock_physics.smd"), [SMD_HEADER], make_box(0, 0, 0, 10, 10, 10) + make_box(10, 10, 10, 20, 20, 20), [])
+    collision_block = '$collisionmodel "rock_physics.smd"\n{\n\t$mass 40\n%s}\n'
+    (tmp_path / "rock.qc").write_text('$modelname "props/rock.mdl"\n' + collision_block % "")
+    (tmp_path / "rock_concave.qc").write_text('$modelname "props/rock.mdl"\n' + collision_block % "\t$concave\n")
+
+    assert psr.get_collision_hulls(psr.QcDocument.parse(str(tmp_path / "rock.qc")), 1.0) is None
+    old_name, new_name = psr.get_collision_hulls(psr.QcDocument.parse(str(tmp_path / "rock_concave.qc")), 1.0)
+    assert old_name == "rock_physics.smd"
+    assert len(psr.read_smd(str(tmp_path / new_name))[1]) == 24
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+import props_scaling_recompiler as psr
+from test_queue_workers import make_game, stub_ccld, stub_studiomdl
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason="the stub tools are run as executable scripts")
+
+
+def test_interrupted_run_resumes_from_its_decompile(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    game_dir = make_game(tmp_path / "game", ["models/props/rock.mdl"])
+    vmf_path = tmp_path / "map.vmf"
+    vmf_path.write_text('entity\n{\n\t"id" "1"\n\t"classname" "prop_static_scalable"\n\t"model" "models/props/rock.mdl"\n\t"modelscale" "2"\n\t"origin" "0 0 0"\n}\n')
+    recompiler = psr.Recompiler(game_dir, stub_studiomdl, stub_ccld, stub_ccld, cache_dir=str(tmp_path / "cache"), scratch_dir=str(tmp_path / "scratch"))
+    compile_model = psr.compile_model
+    run_ccld = psr.run_ccld
+    decompiles = []
+
+    def interrupt(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    def count_decompiles(*args, **kwargs):
+        decompiles.append(args[0])
+        return run_ccld(*args, **kwargs)
+
+    # Ctrl+C while the decompiled model is compiled
+    monkeypatch.setattr(psr, "run_ccld", count_decompiles)
+    monkeypatch.setattr(psr, "compile_model", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        recompiler.run(str(vmf_path), str(tmp_path / "out" / "map.vmf"))
+    # What atexit does, then a new process
+    psr.scratch.close()
+    psr.journal.file.close()
+    monkeypatch.setattr(psr, "journal", psr.Journal(psr.journal.path))
+    monkeypatch.setattr(psr, "scratch", psr.ScratchManager())
+    assert len(decompiles) == 1
+
+    monkeypatch.setattr(psr, "compile_model", compile_model)
+    plan = recompiler.run(str(vmf_path), str(tmp_path / "out" / "map.vmf"))
+
+    assert len(decompiles) == 1
+    assert "models/props/rock.mdl" in plan.psr_cache_data_ready
+    assert os.path.isfile(os.path.join(game_dir, "models", "props", "scaled", "rock_scaled_200.mdl"))
+    assert not os.path.exists(psr.journal.path)
@@ -0,0 +1,27 @@
+import props_scaling_recompiler as psr
+
+
+def test_miss_reasons():
+    white = psr.white_rendercolor
+    red = "255 0 0"
+    psr_cache_data_ready = psr.add_to_cache({}, "models/props/rock.mdl", "2", white, "0")
+    psr.add_to_cache(psr_cache_data_ready, "models/props/rock.mdl", "2", red, "0")
+
+    assert psr.get_lookup_miss_reason(psr_cache_data_ready, "models/props/tree.mdl", "2", white, "0") == "not in cache"
+    assert psr.get_lookup_miss_reason(psr_cache_data_ready, "models/props/rock.mdl", "3", white, "0") == "scale mismatch"
+    assert psr.get_lookup_miss_reason(psr_cache_data_ready, "models/props/rock.mdl", "2", white, "1") == "color mismatch"
+    # Red is known but the model of scale 2 was compiled without tinted skins
+    assert psr.get_lookup_miss_reason(psr_cache_data_ready, "models/props/rock.mdl", "2", red, "0") == "palette mismatch"
+
+
+def test_watch_lookups_are_not_counted_as_runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(psr.lookup_stats, "path", str(tmp_path / "stats.jsonl"))
+    psr.lookup_stats.record_outcome("cache hit")
+    psr.lookup_stats.report_outcomes()
+    psr.lookup_stats.record_outcome("not in cache")
+    psr.lookup_stats.report_outcomes(save=False)
+
+    stats = psr.get_cache_stats(str(tmp_path), {}, True, str(tmp_path))
+    assert stats["runs"] == 1
+    assert stats["outcomes"] == {"cache hit": 1}
+    assert psr.lookup_stats.outcomes == {}
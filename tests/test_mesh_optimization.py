@@ -0,0 +1,115 @@
+import os
+
+import props_scaling_recompiler as psr
+
+
+SMD_HEADER = "version 1\nnodes\n0 \"root\" -1\nend\nskeleton\ntime 0\n0 0 0 0 0 0 0\nend\n"
+
+
+def make_vertex(x, y, z):
+    return ["0", f"{x:.6f}", f"{y:.6f}", f"{z:.6f}", "0", "0", "1", "0", "0"]
+
+
+def make_triangle(a, b, c, material="rock"):
+    return (material, [make_vertex(*a), make_vertex(*b), make_vertex(*c)])
+
+
+def make_grid(size, step):
+    # Flat square of size x size units, two triangles per step x step quad
+    triangles = []
+    count = int(size / step)
+    for i in range(count):
+        for j in range(count):
+            x0, y0, x1, y1 = i * step, j * step, (i + 1) * step, (j + 1) * step
+            triangles.append(make_triangle((x0, y0, 0), (x1, y0, 0), (x1, y1, 0)))
+            triangles.append(make_triangle((x0, y0, 0), (x1, y1, 0), (x0, y1, 0)))
+    return triangles
+
+
+def write_mesh(path, triangles):
+    psr.write_smd(str(path), [SMD_HEADER], triangles, [])
+
+
+def test_smd_round_trip(tmp_path):
+    triangles = make_grid(2, 1)
+    write_mesh(tmp_path / "mesh.smd", triangles)
+    header, read_triangles, trailer = psr.read_smd(str(tmp_path / "mesh.smd"))
+
+    assert "".join(header) == SMD_HEADER
+    assert read_triangles == triangles
+    assert trailer == []
+
+
+def test_decimation_keeps_both_faces_of_a_double_sided_card():
+    front = make_triangle((0, 0, 0), (10, 0, 0), (0, 10, 0))
+    back = make_triangle((0, 0, 0), (0, 10, 0), (10, 0, 0))
+
+    assert len(psr.decimate_triangles([front, back], 1.0)) == 2
+    # The same face twice is one face
+    assert len(psr.decimate_triangles([front, front], 1.0)) == 1
+
+
+def test_decimation_merges_small_details():
+    triangles = make_grid(20, 1)
+
+    assert len(psr.decimate_triangles(triangles, 0.5)) == len(triangles)
+    decimated = psr.decimate_triangles(triangles, 4.0)
+    assert 0 < len(decimated) < len(triangles) / 4
+    # A triangle inside one cell disappears
+    assert psr.decimate_triangles([make_triangle((0.1, 0.1, 0), (0.2, 0.1, 0), (0.1, 0.2, 0))], 4.0) == []
+
+
+def test_redundant_lods_are_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(psr, "mesh_min_feature_size", 2.0)
+    write_mesh(tmp_path / "mesh.smd", make_grid(20, 1))
+    # Heavier than the decimated mesh: useless for the small variant
+    write_mesh(tmp_path / "mesh_lod1.smd", make_grid(20, 2))
+    # Lighter than the decimated mesh: kept
+    write_mesh(tmp_path / "mesh_lod2.smd", make_grid(20, 20))
+    (tmp_path / "mesh.qc").write_text(
+        '$modelname "props/mesh.mdl"\n'
+        '$body "mesh" "mesh.smd"\n'
+        '$lod 20\n{\n\treplacemodel "mesh.smd" "mesh_lod1.smd"\n}\n'
+        '$lod 40\n{\n\treplacemodel "mesh.smd" "mesh_lod2.smd"\n}\n'
+    )
+    qc_document = psr.QcDocument.parse(str(tmp_path / "mesh.qc"))
+
+    mesh_optimization = psr.optimize_variant_meshes(qc_document, 0.5, "50")
+
+    assert mesh_optimization.triangles_before == 800
+    assert mesh_optimization.triangles_after < 200
+    (start, end), = mesh_optimization.dropped_ranges
+    assert "mesh_lod1.smd" in "".join(qc_document.lines[start:end])
+    (index, (old_name, new_name)), = mesh_optimization.replacements.items()
+    assert old_name == "mesh.smd" and os.path.isfile(tmp_path / new_name)
+    lines = qc_document.emit("props/mesh_scaled_50.mdl", 0.5, mesh_optimization=mesh_optimization)
+    assert f'$body "mesh" "{new_name}"\n' in lines
+    assert '// \treplacemodel "mesh.smd" "mesh_lod1.smd"\n' in lines
+    assert '\treplacemodel "mesh.smd" "mesh_lod2.smd"\n' in lines
+
+
+def test_variants_scaled_up_are_not_optimized(tmp_path, monkeypatch):
+    monkeypatch.setattr(psr, "mesh_min_feature_size", 2.0)
+    write_mesh(tmp_path / "mesh.smd", make_grid(20, 1))
+    (tmp_path / "mesh.qc").write_text('$modelname "props/mesh.mdl"\n$body "mesh" "mesh.smd"\n')
+
+    assert psr.optimize_variant_meshes(psr.QcDocument.parse(str(tmp_path / "mesh.qc")), 2.0, "200") is None
+
+
+def test_triangle_count_of_meshes_and_lods(tmp_path, monkeypatch):
+    monkeypatch.setattr(psr, "mesh_min_feature_size", 2.0)
+    write_mesh(tmp_path / "mesh.smd", make_grid(20, 1))
+    write_mesh(tmp_path / "mesh_lod1.smd", make_grid(20, 2))
+    write_mesh(tmp_path / "idle.smd", [])
+    (tmp_path / "mesh.qc").write_text(
+        '$modelname "props/mesh.mdl"\n'
+        '$body "mesh" "mesh.smd"\n'
+        '$lod 20\n{\n\treplacemodel "mesh.smd" "mesh_lod1"\n}\n'
+        '$sequence "idle" "idle.smd"\n'
+    )
+    qc_document = psr.QcDocument.parse(str(tmp_path / "mesh.qc"))
+
+    assert qc_document.get_triangle_count() == 800 + 200
+    # Decimated meshes written next to the QC are not part of the model
+    psr.optimize_variant_meshes(qc_document, 0.5, "50")
+    assert qc_document.get_triangle_count() == 800 + 200
@@ -0,0 +1,60 @@
+import os
+
+import props_scaling_recompiler as psr
+
+
+MAIN_QC = """$modelname "props/rock.mdl"
+$include "parts/body.qci"
+$cdmaterials "models/props/"
+$texturegroup "skinfamilies"
+{
+	{ "rock" }
+	{ "rock_mossy" }
+}
+$bbox -10 -10 0 10 10 20
+"""
+
+BODY_QCI = """$body "rock" "rock_ref.smd"
+$lod 20
+{
+	replacemodel "rock_ref.smd" "lod1/rock_lod1.smd"
+}
+$collisionmodel "rock_physics.smd"
+{
+	$mass 40
+}
+"""
+
+
+def write_qc(tmp_path):
+    os.makedirs(tmp_path / "parts")
+    (tmp_path / "rock.qc").write_text(MAIN_QC)
+    (tmp_path / "parts" / "body.qci").write_text(BODY_QCI)
+    return str(tmp_path / "rock.qc")
+
+
+def test_include_paths_are_relative_to_main_qc(tmp_path):
+    qc_document = psr.QcDocument.parse(write_qc(tmp_path))
+
+    assert list(qc_document.mesh_indices.values()) == ["parts/rock_ref.smd"]
+    assert [replacements for _, _, replacements in qc_document.lod_blocks] == [[("parts/rock_ref.smd", "parts/lod1/rock_lod1.smd")]]
+    assert qc_document.collision_smd == "parts/rock_physics.smd"
+    start, end = qc_document.texturegroup_range
+    assert qc_document.lines[start].startswith("$texturegroup") and qc_document.lines[end - 1].strip() == "}"
+
+
+def test_emit_variant(tmp_path):
+    qc_document = psr.QcDocument.parse(write_qc(tmp_path))
+    lines = qc_document.emit("props/scaled/rock_scaled_200.mdl", 2.0, [["rock"], ["rock_mossy"], ["rock_tint_ff0000"]])
+    text = "".join(lines)
+
+    assert '$modelname "props/scaled/rock_scaled_200.mdl"\n' in lines
+    assert "$scale 2.0\n" in lines
+    assert "$staticprop\n" in lines
+    assert '// $include "parts/body.qci"\n' in lines
+    assert "$lod 40.0\n" in lines
+    assert '// $bbox' in text
+    assert '\t{ "rock_tint_ff0000" }\n' in lines
+    assert text.count("$texturegroup") == 1
+    # The emitted QC must compile from the main QC folder
+    assert '$body "rock" "parts/rock_ref.smd"\n' in lines
@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import props_scaling_recompiler as psr
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason="the stub tools are run as executable scripts")
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+stub_ccld = os.path.join(repo_path, "tests", "stub_tools", "stub_ccld.py")
+stub_studiomdl = os.path.join(repo_path, "tests", "stub_tools", "stub_studiomdl.py")
+
+
+def make_game(game_dir, models=()):
+    os.makedirs(game_dir)
+    with open(os.path.join(game_dir, "GameInfo.txt"), 'w') as gameinfo_file:
+        gameinfo_file.write('"GameInfo"\n{\n\tFileSystem\n\t{\n\t\tSearchPaths\n\t\t{\n\t\t\tgame |gameinfo_path|.\n\t\t}\n\t}\n}\n')
+    for model in models:
+        mdl_path = os.path.join(game_dir, model)
+        os.makedirs(os.path.dirname(mdl_path), exist_ok=True)
+        with open(mdl_path, 'wb') as mdl_file:
+            mdl_file.write(b"IDST0000CCCC" + model[len("models/"):].encode().ljust(64, b"\0") + b"body")
+    return str(game_dir)
+
+
+def make_recompiler(tmp_path, name, game_dir, queue_dir):
+    return psr.Recompiler(game_dir, stub_studiomdl, stub_ccld, stub_ccld, cache_dir=str(tmp_path / f"cache_{name}"),
+                          scratch_dir=str(tmp_path / f"scratch_{name}"), queue_dir=queue_dir)
+
+
+def test_job_ships_only_its_own_logs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    queue_dir = str(tmp_path / "queue")
+    coordinator_game = make_game(tmp_path / "game", ["models/props/rock.mdl"])
+    worker = make_recompiler(tmp_path, "worker", make_game(tmp_path / "worker_game"), queue_dir)
+    worker.activate()
+
+    todo = psr.add_to_cache({}, "models/props/rock.mdl", "2.0", "255 255 255", "0")
+    psr.work_queue.submit("models/props/rock.mdl", os.path.join(coordinator_game, "models/props/rock.mdl"), "2.0", False, True, "fingerprint", todo, {})
+    # Log of another model with a similar name, written while this job runs
+    other_log_path = psr.get_job_log_path("studiomdl_rock_large_scaled_200", "other/rock_large.qc")
+    with open(other_log_path, 'w') as other_log:
+        other_log.write("not this job")
+
+    psr.work_queue.worker_id = "worker"
+    try:
+        job_path = psr.work_queue.claim()
+        assert psr.run_queue_job(job_path, stub_ccld, worker.gameinfo_path, stub_studiomdl)
+    finally:
+        psr.work_queue.worker_id = None
+        psr.work_queue.pending = {}
+
+    log_names = sorted(os.listdir(os.path.join(job_path, "result", "logs")))
+    assert [log_name.rsplit("_", 1)[0] for log_name in log_names] == ["ccld_rock", "studiomdl_rock_scaled_200"]
+    assert os.path.isfile(os.path.join(job_path, "result", "files", "models", "props", "scaled", "rock_scaled_200.mdl"))
+
+
+def test_coordinator_with_local_worker_process(tmp_path, monkeypatch):
+    queue_dir = str(tmp_path / "queue")
+    coordinator_game = make_game(tmp_path / "game", ["models/props/rock.mdl", "models/props/rock_large.mdl"])
+    worker_game = make_game(tmp_path / "worker_game")
+    worker_cwd = tmp_path / "worker_cwd"
+    worker_cwd.mkdir()
+    worker_code = (f"import sys; sys.path.insert(0, {repo_path!r}); import props_scaling_recompiler as psr; "
+                   f"psr.Recompiler({worker_game!r}, {stub_studiomdl!r}, {stub_ccld!r}, {stub_ccld!r}, cache_dir={str(tmp_path / 'cache_worker')!r}, "
+                   f"scratch_dir={str(tmp_path / 'scratch_worker')!r}, queue_dir={queue_dir!r}).work(idle_exit=60, poll_interval=0.2)")
+    worker_process = subprocess.Popen([sys.executable, "-c", worker_code], cwd=str(worker_cwd), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    vmf_path = tmp_path / "map.vmf"
+    vmf_path.write_text(''.join(f'entity\n{{\n\t"id" "{entity_id}"\n\t"classname" "prop_static_scalable"\n\t"model" "{model}"\n\t"modelscale" "2"\n\t"origin" "0 0 0"\n}}\n'
+                                for entity_id, model in ((1, "models/props/rock.mdl"), (2, "models/props/rock_large.mdl"))))
+    monkeypatch.chdir(tmp_path)
+    try:
+        plan = make_recompiler(tmp_path, "coordinator", coordinator_game, queue_dir).run(str(vmf_path), str(tmp_path / "out" / "map.vmf"))
+    finally:
+        worker_process.terminate()
+        worker_process.wait(timeout=30)
+
+    assert sorted(plan.psr_cache_data_ready) == ["models/props/rock.mdl", "models/props/rock_large.mdl"]
+    for model in ("rock", "rock_large"):
+        assert os.path.isfile(os.path.join(coordinator_game, "models", "props", "scaled", f"{model}_scaled_200.mdl"))
+    out_content = (tmp_path / "out" / "map.vmf").read_text()
+    assert '"model" "models/props/scaled/rock_scaled_200.mdl"' in out_content
+    assert '"model" "models/props/scaled/rock_large_scaled_200.mdl"' in out_content
+    assert os.listdir(os.path.join(queue_dir, "done")) == []
@@ -0,0 +1,83 @@
+import os
+import zlib
+
+import props_scaling_recompiler as psr
+
+
+GAMEINFO = """"GameInfo"
+{
+	game	"Half-Life 2"
+	type	singleplayer_only
+
+	FileSystem
+	{
+		SteamAppId	220
+
+		SearchPaths
+		{
+			game+mod			|gameinfo_path|custom/*
+			game_lv				hl2/hl2_lv.vpk
+			game+mod+mod_write+default_write_path		|gameinfo_path|.
+			gamebin				|gameinfo_path|bin
+			game				|all_source_engine_paths|hl2
+			platform			|all_source_engine_paths|platform
+		}
+	}
+}
+"""
+
+ROCK = "models/props/scaled/rock_scaled_50.mdl"
+ROCK_VVD = "models/props/scaled/rock_scaled_50.vvd"
+TREE = "models/props/scaled/tree_scaled_200.mdl"
+
+
+def write_loose(folder, name, data):
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as loose_file:
+        loose_file.write(data)
+    return path
+
+
+def test_pack_round_trip(tmp_path):
+    dir_path = str(tmp_path / "variants_dir.vpk")
+    files = {ROCK: write_loose(tmp_path, "rock.mdl", b"r" * 40), ROCK_VVD: write_loose(tmp_path, "rock.vvd", b"v" * 40)}
+    assert psr.VariantPack(dir_path, archive_size=100).append(files) == 2
+
+    pack = psr.VariantPack(dir_path, archive_size=100)
+    assert pack.read(ROCK) == b"r" * 40
+    assert pack.read(ROCK_VVD) == b"v" * 40
+    assert pack.entries[ROCK][0] == zlib.crc32(b"r" * 40)
+    assert pack.find_name("ROCK_SCALED_50.MDL") == ROCK
+    # Unchanged loose files are not packed again
+    assert pack.append(files) == 0
+
+    # A recompiled variant and a new one, the archive is full: both go into the next one
+    files[ROCK] = write_loose(tmp_path, "rock.mdl", b"R" * 30)
+    files[TREE] = write_loose(tmp_path, "tree.mdl", b"t" * 20)
+    assert pack.append(files) == 2
+    assert os.path.getsize(pack.get_archive_path(0)) == 80
+    assert os.path.getsize(pack.get_archive_path(1)) == 50
+
+    pack = psr.VariantPack(dir_path, archive_size=100)
+    assert pack.read(ROCK) == b"R" * 30
+    assert pack.read(ROCK_VVD) == b"v" * 40
+    assert pack.read(TREE) == b"t" * 20
+    assert pack.entries[ROCK][0] == zlib.crc32(b"R" * 30)
+    assert pack.entries[ROCK][1] == 1 and pack.entries[ROCK_VVD][1] == 0
+    assert pack.append(files) == 0
+
+
+def test_pack_is_mounted_after_the_mod_folder(tmp_path):
+    gameinfo_path = tmp_path / "gameinfo.txt"
+    gameinfo_path.write_text(GAMEINFO)
+
+    assert psr.register_variant_pack(str(gameinfo_path), psr.variant_pack_name)
+
+    lines = gameinfo_path.read_text().splitlines()
+    mod_index = next(index for index, line in enumerate(lines) if line.endswith("|gameinfo_path|."))
+    assert lines[mod_index + 1] == f"\t\t\tgame+mod\t\t\t|gameinfo_path|{psr.variant_pack_name}.vpk"
+    assert lines[:mod_index + 1] + lines[mod_index + 2:] == GAMEINFO.splitlines()
+    assert (tmp_path / "gameinfo.txt.psr_backup").read_text() == GAMEINFO
+    # Registered once
+    assert not psr.register_variant_pack(str(gameinfo_path), psr.variant_pack_name)
+    assert gameinfo_path.read_text().count(psr.variant_pack_name) == 1
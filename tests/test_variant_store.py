@@ -0,0 +1,71 @@
+import json
+import os
+import socket
+import threading
+import time
+import urllib.error
+
+import pytest
+
+import props_scaling_recompiler as psr
+
+
+KEY = "ab" + "0" * 38
+
+
+def make_store(location, mirror_dir):
+    store = psr.VariantStore()
+    store.configure(str(location), str(mirror_dir), 100 * 1024 * 1024)
+    return store
+
+
+def test_fetch_refuses_paths_in_meta(tmp_path):
+    store_path = tmp_path / "store" / KEY[:2] / KEY
+    os.makedirs(store_path)
+    (store_path / "model.mdl").write_bytes(b"mdl")
+    (store_path / "meta.json").write_text(json.dumps({"files": ["model.mdl", "../../escaped.txt"]}))
+    os.makedirs(tmp_path / "mirror")
+    store = make_store(tmp_path / "store", tmp_path / "mirror")
+
+    assert store.fetch(KEY) is None
+    assert os.listdir(tmp_path / "mirror") == []
+
+    (store_path / "meta.json").write_text(json.dumps({"files": ["model.mdl"]}))
+    mirror_path, meta = store.fetch(KEY)
+    assert meta["files"] == ["model.mdl"]
+    assert open(os.path.join(mirror_path, "model.mdl"), 'rb').read() == b"mdl"
+
+
+@pytest.fixture
+def store_server(tmp_path):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    threading.Thread(target=psr.serve_variant_store, args=(str(tmp_path / "served"), port, "127.0.0.1"), daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return make_store(f"http://127.0.0.1:{port}", tmp_path / "mirror"), tmp_path / "served"
+
+
+def test_concurrent_uploads_do_not_mix(store_server):
+    store, served = store_server
+    first = {"X-Upload-Id": "first"}
+    second = {"X-Upload-Id": "second"}
+    store.request("PUT", f"/objects/{KEY}/model.mdl", b"first", headers=first)
+    store.request("PUT", f"/objects/{KEY}/model.mdl", b"second", headers=second)
+    store.request("PUT", f"/objects/{KEY}/model.vvd", b"second", headers=second)
+    store.request("PUT", f"/objects/{KEY}/meta.json", json.dumps({"files": ["model.mdl"]}).encode(), headers=first)
+
+    published = served / KEY[:2] / KEY
+    assert sorted(os.listdir(published)) == ["meta.json", "model.mdl"]
+    assert (published / "model.mdl").read_bytes() == b"first"
+
+
+def test_server_refuses_other_file_names(store_server):
+    store, served = store_server
+    with pytest.raises(urllib.error.HTTPError):
+        store.request("PUT", f"/objects/{KEY}/notes.txt", b"text")
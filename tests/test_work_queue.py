@@ -0,0 +1,72 @@
+import json
+import os
+import time
+
+import props_scaling_recompiler as psr
+
+
+def make_job(queue_root, job_id):
+    job_path = os.path.join(queue_root, "jobs", job_id)
+    os.makedirs(job_path)
+    with open(os.path.join(job_path, "job.json"), 'w', encoding='utf-8') as job_file:
+        json.dump({"model": "models/a/rock.mdl", "scales": "2.0"}, job_file)
+    return job_path
+
+
+def make_queue(queue_root, worker_id=None):
+    queue = psr.WorkQueue()
+    queue.configure(str(queue_root))
+    queue.worker_id = worker_id
+    return queue
+
+
+def test_stalled_worker_loses_requeued_job(tmp_path):
+    coordinator = make_queue(tmp_path)
+    stalled = make_queue(tmp_path, "stalled")
+    other = make_queue(tmp_path, "other")
+    make_job(str(tmp_path), "host_1_00001_rock")
+    coordinator.pending["host_1_00001_rock"] = "models/a/rock.mdl"
+
+    job_path = stalled.claim()
+    assert stalled.owns(job_path)
+    silent_since = time.time() - coordinator.dead_after - 1
+    os.utime(os.path.join(job_path, "heartbeat"), (silent_since, silent_since))
+    coordinator.requeue_dead()
+
+    assert list(coordinator.pending) == ["host_1_00001_rock_r1"]
+    assert not stalled.owns(job_path)
+    assert not stalled.publish(job_path)
+
+    new_job_path = other.claim()
+    assert os.path.basename(new_job_path) == "host_1_00001_rock_r1"
+    assert other.owns(new_job_path) and not stalled.owns(new_job_path)
+    assert psr.run_queue_job(job_path, "ccld", "gameinfo", "studiomdl") is None
+    assert not os.path.exists(job_path)
+    assert other.publish(new_job_path)
+    assert os.path.isdir(os.path.join(str(tmp_path), "done", "host_1_00001_rock_r1"))
+
+
+def test_requeued_again_counts_up(tmp_path):
+    coordinator = make_queue(tmp_path)
+    worker = make_queue(tmp_path, "worker")
+    make_job(str(tmp_path), "host_1_00002_rock_r1")
+    coordinator.pending["host_1_00002_rock_r1"] = "models/a/rock.mdl"
+    job_path = worker.claim()
+    os.utime(os.path.join(job_path, "heartbeat"), (0, 0))
+    coordinator.requeue_dead()
+    assert list(coordinator.pending) == ["host_1_00002_rock_r2"]
+    assert not os.path.exists(os.path.join(str(tmp_path), "jobs", "host_1_00002_rock_r2", "worker.json"))
+
+
+def test_compile_order_uses_the_time_of_every_variant(tmp_path):
+    psr_cache_data_ready = {
+        "models/a/rock.mdl": {"compile_times": {"0.5": 10.0, "2.0": 30.0}},
+        # Cache written before the times were kept per scale
+        "models/a/tree.mdl": {"compile_time": 15.0},
+    }
+    psr_cache_data_todo = {"models/a/rock.mdl": {"scales": ["3.0"]}, "models/a/tree.mdl": {"scales": ["2.0", "3.0"]}}
+
+    order, total = psr.plan_compile_order(str(tmp_path), psr_cache_data_todo, psr_cache_data_ready)
+
+    assert order == ["models/a/tree.mdl", "models/a/rock.mdl"]
+    assert total == 20.0 + 2 * 15.0